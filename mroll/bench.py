@@ -0,0 +1,193 @@
+"""
+Benchmarks for the mroll planning and apply pipeline.
+
+Synthetic work directories of a given size are generated in a temporary
+directory and the main steps of an upgrade are timed. Results are plain
+dicts, ready to be dumped as JSON and compared across mroll versions.
+"""
+import os
+import sys
+import time
+import shutil
+import subprocess
+import platform
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+from mroll import __version__
+from mroll.migration import Revision, WorkDirectory, MigrationCtxConfig
+from mroll.planner import make_plan
+
+BENCH_SCHEMA = 'mroll_bench'
+BENCH_TBL_NAME = 'mroll_bench_revisions'
+# number of statements per revision, per body size
+BODY_SIZES = {'small': 2, 'huge': 1000}
+# python code timed in a fresh interpreter, per startup measurement
+STARTUP_CODE = {
+    'interpreter': 'pass',
+    'import_commands': 'import mroll.commands',
+    'version_command': 'from mroll.commands import cli; cli(["version"], standalone_mode=False)',
+}
+
+def generate_work_dir(path, count, body='small'):
+    """
+    Creates work directory at path with count synthetic revisions. Every
+    revision creates its own table in the bench schema and fills it.
+    """
+    from mroll.commands import get_templates_dir
+    versions = os.path.join(path, 'versions')
+    os.makedirs(versions)
+    shutil.copy(os.path.join(get_templates_dir(), 'mroll.ini'), path)
+    n_stmts = BODY_SIZES[body]
+    ts = datetime(2020, 1, 1)
+    for i in range(count):
+        tbl = '{}.t{}'.format(BENCH_SCHEMA, i)
+        upgrade_sql = '\n'.join(['create table {} (i int, s string);'.format(tbl)] +
+            ["insert into {} values ({}, 'row {}');".format(tbl, j, j) for j in range(n_stmts - 1)])
+        rev = Revision('{:012x}'.format(i), 'bench revision {}'.format(i), (ts + timedelta(seconds=i)).isoformat(),
+            upgrade_sql=upgrade_sql, downgrade_sql='drop table {};'.format(tbl))
+        fn = os.path.join(versions, '{}_bench_revision_{}.sql'.format(rev.id, i))
+        with open(fn, 'w') as f:
+            f.write(rev.serialize())
+    return path
+
+def measure(fn, repeat=3):
+    """
+    Runs fn repeat times, returns dict with min, median and max wall-clock seconds.
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+def summarize(samples):
+    return dict(min=min(samples), median=statistics.median(samples), max=max(samples), repeat=len(samples))
+
+def bench_work_dir(path, repeat=3):
+    """
+    Times revision loading and planning on an existing work directory.
+    """
+    res = {}
+    files = [os.path.join(path, 'versions', f) for f in os.listdir(os.path.join(path, 'versions'))]
+
+    def from_file():
+        for f in files:
+            Revision.from_file(f)
+
+    def from_file_split():
+        for f in files:
+            rev = Revision.from_file(f)
+            rev.upgrade_stmts
+            rev.downgrade_stmts
+
+    def load_uncached():
+        WorkDirectory(path, use_cache=False).load_revisions()
+
+    def load_cold_cache():
+        from mroll.cache import CACHE_FILE
+        cache_file = os.path.join(path, CACHE_FILE)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        WorkDirectory(path).load_revisions()
+
+    def load_warm_cache():
+        WorkDirectory(path).load_revisions()
+
+    res['revision_from_file'] = measure(from_file, repeat)
+    res['revision_from_file_split'] = measure(from_file_split, repeat)
+    res['load_revisions_uncached'] = measure(load_uncached, repeat)
+    res['load_revisions_cold_cache'] = measure(load_cold_cache, repeat)
+    # let files age past the cache's racy window, so the warm run trusts stat info
+    from mroll.cache import RACY_WINDOW_NS
+    time.sleep(RACY_WINDOW_NS / 10**9)
+    load_warm_cache()
+    res['load_revisions_warm_cache'] = measure(load_warm_cache, repeat)
+
+    revisions = WorkDirectory(path).load_revisions()
+    applied_ids = [rev.id for rev in revisions[:len(revisions) // 2]]
+    # pending set computation as done by upgrade
+    res['pending_set'] = measure(lambda: make_plan(revisions, applied_ids).pending, repeat)
+    return res
+
+def bench_apply(path, ctx_config, repeat=1, batch_size=None):
+    """
+    Times applying and removing all revisions of work directory against a
+    live database. Uses its own revisions table and schema, both dropped afterwards.
+    """
+    from mroll.databases import create_migration_ctx
+    from mroll.databases.common import state_table
+    revisions = WorkDirectory(path).load_revisions()
+    add_samples = []
+    remove_samples = []
+    with create_migration_ctx(ctx_config) as ctx:
+        conn = ctx.conn
+        conn.execute('create schema if not exists {}'.format(BENCH_SCHEMA))
+        conn.commit()
+        try:
+            ctx.create_revisions_tbl()
+            for _ in range(repeat):
+                start = time.perf_counter()
+                ctx.add_revisions(revisions, batch_size=batch_size)
+                add_samples.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                ctx.remove_revisions(list(reversed(revisions)), batch_size=batch_size)
+                remove_samples.append(time.perf_counter() - start)
+        finally:
+            conn.rollback()
+            conn.execute('drop table if exists sys."{}"'.format(ctx_config.tbl_name))
+            conn.execute('drop table if exists sys."{}"'.format(state_table(ctx_config.tbl_name)))
+            conn.execute('drop schema if exists {} cascade'.format(BENCH_SCHEMA))
+            conn.commit()
+    return dict(add_revisions=summarize(add_samples), remove_revisions=summarize(remove_samples))
+
+def bench_startup(repeat=3):
+    """
+    Times CLI startup, each run in a fresh interpreter. The interpreter
+    measurement is the floor mroll adds its imports to.
+    """
+    res = {}
+    for name, code in STARTUP_CODE.items():
+        res[name] = measure(lambda: subprocess.run([sys.executable, '-c', code], check=True,
+            stdout=subprocess.DEVNULL), repeat)
+    return res
+
+def run(sizes, bodies=('small',), repeat=3, ctx_config=None, batch_size=None, base_dir=None):
+    """
+    Runs benchmarks for every combination of size and body, applying against
+    the database described by ctx_config when given.
+    """
+    report = dict(
+        mroll_version=__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        started_at=datetime.now().isoformat(),
+        startup=bench_startup(repeat),
+        results=[])
+    for body in bodies:
+        for size in sizes:
+            tmp = tempfile.mkdtemp(prefix='mroll_bench_', dir=base_dir)
+            try:
+                path = os.path.join(tmp, 'migrations')
+                start = time.perf_counter()
+                generate_work_dir(path, size, body)
+                result = dict(revisions=size, body=body, statements_per_revision=BODY_SIZES[body],
+                    generate_seconds=time.perf_counter() - start)
+                result['timings'] = bench_work_dir(path, repeat)
+                if ctx_config is not None:
+                    result['timings'].update(bench_apply(path, ctx_config, batch_size=batch_size))
+                report['results'].append(result)
+            finally:
+                shutil.rmtree(tmp)
+    return report
+
+def ctx_config_for(db_name, hostname='127.0.0.1', port=50000, username='monetdb', password='monetdb'):
+    config = MigrationCtxConfig()
+    config.db_name = db_name
+    config.hostname = hostname
+    config.port = port
+    config.username = username
+    config.password = password
+    config.tbl_name = BENCH_TBL_NAME
+    return config
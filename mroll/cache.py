@@ -0,0 +1,280 @@
+"""
+On-disk cache of parsed revision files.
+
+The cache lives inside the work directory as a single sqlite file. Entries are
+keyed by file name and validated against the file's mtime, size and content
+hash, so only new or changed revision files get parsed again. Revision headers
+and sort order are loaded in bulk, split statements and checksums are kept
+once computed and stored together by flush(), they are fetched per revision on
+demand.
+"""
+import os
+import json
+import time
+import hashlib
+try:
+    import sqlite3
+except ImportError:  # python built without sqlite support
+    sqlite3 = None
+
+# errors on which callers should fall back to uncached loading
+CACHE_ERRORS = (sqlite3.Error,) if sqlite3 is not None else ()
+
+CACHE_FILE = '.mroll_cache.sqlite'
+CACHE_VERSION = '7'
+# files modified this close (in ns) to the last scan are re-hashed even when
+# their stat info matches, as coarse mtime resolution could hide an edit.
+RACY_WINDOW_NS = 2 * 10**9
+
+def file_digest(path):
+    """
+    Returns sha1 hex digest of file content.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class CacheEntry:
+    __slots__ = ('fname', 'mtime_ns', 'size', 'digest', 'id', 'description', 'ts', 'depends_on', 'squashes', 'pos',
+        'directives')
+
+    def __init__(self, fname, mtime_ns, size, digest, id_, description, ts, depends_on=None, squashes=None,
+        pos=None, directives=None):
+        self.fname = fname
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        self.id = id_
+        self.description = description
+        self.ts = ts
+        self.depends_on = depends_on
+        self.squashes = squashes
+        self.pos = pos
+        self.directives = directives
+
+    def __repr__(self):
+        return "<CacheEntry fname={} id={}>".format(self.fname, self.id)
+
+class RevisionCache:
+    """
+    Persistent cache of parsed revisions stored in <work_dir>/.mroll_cache.sqlite
+    """
+    def __init__(self, conn, path):
+        self.conn = conn
+        self.path = path
+        self.last_scan_ns = int(self._get_meta('last_scan_ns') or 0)
+        self.dirty = False
+        # checksums and statements by file name not yet stored, see flush
+        self.pending_checksums = {}
+        self.pending_statements = {}
+
+    @classmethod
+    def open(cls, work_dir):
+        """
+        Opens (creating if needed) the cache of a work directory. Returns None
+        when the cache can not be used, e.g. read-only work directory.
+        """
+        if sqlite3 is None:
+            return None
+        path = os.path.join(work_dir, CACHE_FILE)
+        try:
+            return cls._open(path)
+        except sqlite3.DatabaseError:
+            # corrupt cache file, start over
+            try:
+                os.remove(path)
+                return cls._open(path)
+            except (OSError, sqlite3.Error):
+                return None
+        except (OSError, sqlite3.Error):
+            return None
+
+    @classmethod
+    def _open(cls, path):
+        # fan-out workers prefetch one at a time, see commands.fan_out
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("create table if not exists meta (key text primary key, value text)")
+        row = conn.execute("select value from meta where key='version'").fetchone()
+        if row is None or row[0] != CACHE_VERSION:
+            conn.execute("drop table if exists entries")
+            conn.execute("delete from meta")
+            conn.execute("insert into meta values ('version', ?)", (CACHE_VERSION,))
+        conn.execute("""
+        create table if not exists entries (
+            fname text primary key, mtime_ns integer, size integer, digest text,
+            id text, description text, ts text, depends_on text, squashes text, pos integer, directives text,
+            upgrade_stmts text, downgrade_stmts text, checksum text)
+        """)
+        # kept across cache versions, durations do not depend on parsing
+        conn.execute("""
+        create table if not exists durations (
+            id text, upgrade integer, duration real, stmt_count integer, primary key (id, upgrade))
+        """)
+        conn.commit()
+        return cls(conn, path)
+
+    def _get_meta(self, key):
+        row = self.conn.execute("select value from meta where key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def entries(self):
+        """
+        Returns dict of all cached entries keyed by file name. Statements are not loaded.
+        """
+        res = {}
+        sql = """select fname, mtime_ns, size, digest, id, description, ts, depends_on, squashes, pos, directives
+            from entries"""
+        for row in self.conn.execute(sql):
+            entry = CacheEntry(*row)
+            if entry.depends_on is not None:
+                entry.depends_on = tuple(json.loads(entry.depends_on))
+            if entry.squashes is not None:
+                entry.squashes = tuple(json.loads(entry.squashes))
+            if entry.directives is not None:
+                entry.directives = json.loads(entry.directives)
+            res[entry.fname] = entry
+        return res
+
+    def is_fresh(self, entry, stat):
+        """
+        True when stat info matches the entry and the file was not modified
+        too close to the previous scan to trust its mtime.
+        """
+        return (entry.mtime_ns == stat.st_mtime_ns
+            and entry.size == stat.st_size
+            and stat.st_mtime_ns < self.last_scan_ns - RACY_WINDOW_NS)
+
+    def put(self, entry, upgrade_stmts=None, downgrade_stmts=None):
+        """
+        Stores an entry, with its split statements when already known.
+        """
+        sql = "insert or replace into entries values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, null)"
+        depends_on = json.dumps(entry.depends_on) if entry.depends_on is not None else None
+        squashes = json.dumps(entry.squashes) if entry.squashes is not None else None
+        directives = json.dumps(entry.directives) if entry.directives is not None else None
+        if upgrade_stmts is not None:
+            upgrade_stmts, downgrade_stmts = json.dumps(upgrade_stmts), json.dumps(downgrade_stmts)
+        self.conn.execute(sql, (entry.fname, entry.mtime_ns, entry.size, entry.digest,
+            entry.id, entry.description, entry.ts, depends_on, squashes, entry.pos, directives, upgrade_stmts,
+            downgrade_stmts))
+        self.dirty = True
+
+    def get_statements(self, rev):
+        """
+        Returns cached (upgrade_stmts, downgrade_stmts) of a revision or None.
+        """
+        fname = os.path.basename(rev.path)
+        if fname in self.pending_statements:
+            return self.pending_statements[fname]
+        try:
+            row = self.conn.execute("select upgrade_stmts, downgrade_stmts from entries where fname=?",
+                (fname,)).fetchone()
+        except CACHE_ERRORS:
+            return None
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put_statements(self, rev, upgrade_stmts, downgrade_stmts):
+        """
+        Keeps split statements of a revision until flush() stores those of
+        many revisions in one transaction.
+        """
+        self.pending_statements[os.path.basename(rev.path)] = (upgrade_stmts, downgrade_stmts)
+
+    def get_checksum(self, rev):
+        """
+        Returns cached checksum of a revision's sql or None.
+        """
+        fname = os.path.basename(rev.path)
+        if fname in self.pending_checksums:
+            return self.pending_checksums[fname]
+        try:
+            row = self.conn.execute("select checksum from entries where fname=?", (fname,)).fetchone()
+        except CACHE_ERRORS:
+            return None
+        return row[0] if row else None
+
+    def put_checksum(self, rev, checksum):
+        """
+        Keeps checksum of a revision's sql until flush() stores those of many
+        revisions in one transaction.
+        """
+        self.pending_checksums[os.path.basename(rev.path)] = checksum
+
+    def flush(self):
+        """
+        Stores pending statements and checksums in one transaction, errors are ignored.
+        """
+        if not self.pending_statements and not self.pending_checksums:
+            return
+        try:
+            self.conn.executemany("update entries set upgrade_stmts=?, downgrade_stmts=? where fname=?",
+                [(json.dumps(up), json.dumps(down), fname) for fname, (up, down) in self.pending_statements.items()])
+            self.conn.executemany("update entries set checksum=? where fname=?",
+                [(checksum, fname) for fname, checksum in self.pending_checksums.items()])
+            self.conn.commit()
+        except CACHE_ERRORS:
+            self.conn.rollback()
+        self.pending_statements.clear()
+        self.pending_checksums.clear()
+
+    def get_durations(self, upgrade=True):
+        """
+        Returns last recorded duration of applying, or rolling back, revisions keyed by id.
+        """
+        try:
+            return dict(self.conn.execute("select id, duration from durations where upgrade=?", (int(upgrade),)))
+        except CACHE_ERRORS:
+            return {}
+
+    def put_durations(self, timings, upgrade=True):
+        """
+        Records durations of RevisionTiming's, errors are ignored.
+        """
+        try:
+            self.conn.executemany("insert or replace into durations values (?, ?, ?, ?)",
+                [(t.revision.id, int(upgrade), t.duration, t.stmt_count) for t in timings if t.duration is not None])
+            self.conn.commit()
+        except CACHE_ERRORS:
+            pass
+
+    def touch(self, entry, stat):
+        """
+        Content unchanged but stat info differs (e.g. fresh checkout), refresh stat info.
+        """
+        entry.mtime_ns = stat.st_mtime_ns
+        entry.size = stat.st_size
+        self.conn.execute("update entries set mtime_ns=?, size=? where fname=?",
+            (entry.mtime_ns, entry.size, entry.fname))
+        self.dirty = True
+
+    def remove(self, fnames):
+        self.conn.executemany("delete from entries where fname=?", [(f,) for f in fnames])
+        self.dirty = True
+
+    def set_order(self, fnames):
+        """
+        Stores sort order of revision files.
+        """
+        self.conn.executemany("update entries set pos=? where fname=?", [(i, f) for i, f in enumerate(fnames)])
+        self.dirty = True
+
+    def save(self, scan_ns=None):
+        """
+        Commits pending changes, scan_ns should be taken before files were stat'ed.
+        """
+        scan_ns = scan_ns or time.time_ns()
+        try:
+            self.conn.execute("insert or replace into meta values ('last_scan_ns', ?)", (str(scan_ns),))
+            self.last_scan_ns = scan_ns
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+        self.dirty = False
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -2,15 +2,13 @@
 
 import click
 import os
-import shutil
-import configparser 
-from datetime import datetime
-import importlib.util
-import importlib.machinery
+from datetime import datetime, timedelta
+from contextlib import contextmanager
 from mroll.config import *
-from mroll.migration import Revision, MigrationContext, WorkDirectory
 from mroll.exceptions import RevisionOperationError
-from mroll.databases import create_migration_ctx
+
+# Work dir parsing, database drivers and the like are imported by the commands
+# using them, so that e.g. `mroll version` starts without loading pymonetdb.
 
 def get_templates_dir():
     dir_ = os.path.dirname(__file__)
@@ -24,6 +22,7 @@ def gen_rev_id():
     return uuid.uuid4().hex[-12:]
 
 def ensure_setup():
+    from mroll.migration import WorkDirectory
     try:
         config = Config.from_file(MROLL_CONFIG_FILE)
         wd = WorkDirectory(config.work_dir)
@@ -33,15 +32,201 @@ def ensure_setup():
     except ValueError as e:
         raise SystemExit(e)
 
-def ensure_init():
+def check_init(ctx, upgrade_tbl=False):
+    """
+    Exits, closing ctx, if its mroll revisions table is missing or outdated.
+    With upgrade_tbl a revisions table of an older mroll version is upgraded
+    first, read only commands leave it alone.
+    """
+    try:
+        if upgrade_tbl:
+            ctx.upgrade_revisions_tbl()
+        ctx.head
+    except RuntimeError as e:
+        # names the table and how to fix it
+        ctx.close()
+        raise SystemExit(e)
+    except:
+        ctx.close()
+        raise SystemExit("Error: mroll not initialized! Run init command first.")
+
+def ensure_init(upgrade_tbl=False):
+    """
+    Returns configured work directory and its migration context, see check_init.
+    """
+    from mroll.migration import WorkDirectory
+    from mroll.databases import create_migration_ctx
     ensure_setup()
     config = Config.from_file(MROLL_CONFIG_FILE)
     wd = WorkDirectory(config.work_dir)
     try:
         ctx = create_migration_ctx(wd.get_migration_ctx_config())
-        head = ctx.head
     except:
         raise SystemExit("Error: mroll not initialized! Run init command first.")
+    check_init(ctx, upgrade_tbl)
+    return wd, ctx
+
+def open_session(mdir=None, upgrade_tbl=False):
+    """
+    Returns work directory and migration context. The context holds one
+    connection reused by every operation of an mroll invocation, close it when
+    done. upgrade_tbl is as for check_init.
+    """
+    if mdir:
+        from mroll.migration import WorkDirectory
+        from mroll.databases import create_migration_ctx
+        wd = WorkDirectory(mdir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        check_init(ctx, upgrade_tbl)
+        return wd, ctx
+    return ensure_init(upgrade_tbl)
+
+def load_work_dir(mdir=None):
+    from mroll.migration import WorkDirectory
+    if mdir:
+        return WorkDirectory(mdir)
+    ensure_setup()
+    config = Config.from_file(MROLL_CONFIG_FILE)
+    return WorkDirectory(config.work_dir)
+
+def fan_out(mdir, targets, targets_file, jobs, fn, working_set=None, upgrade_tbl=False, require_init=True):
+    """
+    Runs fn(revisions, migr_ctx) against every target database concurrently.
+    The work directory is parsed once and shared by all targets. Only the
+    revisions working_set(revisions, migr_ctx) returns for a target are
+    prefetched, all when not given. upgrade_tbl is as for check_init, without
+    require_init targets need no revisions table. Prints status per target and
+    a summary, exits with 1 when all targets failed and 2 on partial failure.
+    """
+    import threading
+    from mroll.databases import create_migration_ctx
+    from mroll.fanout import run_targets, exit_code
+    from mroll.migration import prefetch_revisions
+    wd = load_work_dir(mdir)
+    try:
+        configs = wd.get_target_configs(targets, targets_file)
+    except ValueError as e:
+        raise SystemExit(e)
+    revisions = wd.revisions
+    if working_set is None:
+        # split statements up front, workers then only read shared revisions
+        prefetch_revisions(revisions)
+    # one target at a time splits statements and uses the revision cache
+    prefetch_lock = threading.Lock()
+
+    def work(name, config):
+        with create_migration_ctx(config) as migr_ctx:
+            if require_init:
+                check_init(migr_ctx, upgrade_tbl)
+            if working_set is not None:
+                needed = working_set(revisions, migr_ctx)
+                with prefetch_lock:
+                    prefetch_revisions(needed)
+            return fn(revisions, migr_ctx)
+
+    def report(result):
+        status = 'ok' if result.ok else 'FAILED'
+        print('[{}] {} ({:.2f}s) {}'.format(result.name, status, result.duration, result.message or ''))
+
+    results = run_targets(configs, work, jobs=jobs, on_result=report)
+    failed = [r.name for r in results if not r.ok]
+    print('{} targets: {} ok, {} failed{}'.format(
+        len(results), len(results) - len(failed), len(failed),
+        ' ({})'.format(', '.join(failed)) if failed else ''))
+    code = exit_code(results)
+    if code:
+        raise SystemExit(code)
+
+def target_options(fn):
+    fn = click.option('-j', '--jobs', default=4, help="max number of targets processed concurrently")(fn)
+    fn = click.option('--targets-file', type=click.Path(exists=True, dir_okay=False),
+        help="ini file with [db:<target>] sections")(fn)
+    fn = click.option('-t', '--target', 'targets', multiple=True,
+        help="run against [db:<target>] section of mroll.ini, 'all' for every one")(fn)
+    return fn
+
+def make_plan(revisions, migr_ctx, warn=True):
+    """
+    Splits revisions in applied and pending ones, printing anomalies to stderr.
+    """
+    from mroll.planner import plan_for
+    try:
+        plan = plan_for(revisions, migr_ctx)
+    except ValueError as e:
+        raise SystemExit(e)
+    if warn:
+        for msg in plan.warnings():
+            click.echo(msg, err=True)
+    return plan
+
+def sync_squashed(revisions, migr_ctx):
+    """
+    Replaces records of squashed revisions by their baseline's, for databases
+    migrated before the squash.
+    """
+    if not any(rev.squashes for rev in revisions):
+        return
+    from mroll.migration import resolve_squashed
+    try:
+        pairs = resolve_squashed(revisions, set(migr_ctx.applied_ids()))
+    except ValueError as e:
+        raise SystemExit(e)
+    for baseline, recorded in pairs:
+        migr_ctx.replace_revisions(recorded, baseline)
+
+def check_targets(wd, replaced):
+    """
+    Refuses to replace revisions by a baseline while a [db:<name>] target of
+    mroll.ini holds only part of them, once their files are archived it could
+    neither upgrade nor roll back.
+    """
+    from mroll.databases import create_migration_ctx
+    try:
+        configs = wd.get_target_configs(['all'])
+    except ValueError:
+        # no target sections
+        return
+    for name, config in configs:
+        try:
+            with create_migration_ctx(config) as migr_ctx:
+                recorded = set(migr_ctx.applied_ids())
+        except Exception as e:
+            raise SystemExit("Error: can not read revisions of target {}: {}".format(name, e))
+        held = [rev for rev in replaced
+            if rev.id in recorded or (rev.squashes and recorded.issuperset(rev.squashes))]
+        if held and len(held) != len(replaced):
+            raise SystemExit("Error: target {} holds only part of the revisions up to {}, "
+                "upgrade or rollback it first".format(name, replaced[-1].id))
+
+def replace_by_baseline(wd, migr_ctx, baseline, replaced, applied_ids=None):
+    """
+    Records baseline in place of applied_ids, unless None, then adds its file
+    and archives the files of the replaced revisions. The file is written
+    pending first, so a failing database update leaves the work dir as it was.
+    Returns the archive directory.
+    """
+    from mroll.migration import SQUASHED_DIR
+    pending = wd.add_revision(baseline, pending=True)
+    if applied_ids is not None:
+        try:
+            migr_ctx.replace_revisions(applied_ids, baseline)
+        except BaseException:
+            os.remove(pending)
+            raise
+    try:
+        wd.publish_revision(pending)
+        return wd.archive_revisions(replaced)
+    except OSError as e:
+        raise SystemExit("Error: the database records baseline {} but the work dir could not be updated: {}\n"
+            "Remove the .pending suffix of {} and move the files of the revisions it squashes to versions/{}".format(
+            baseline.id, e, pending, SQUASHED_DIR))
+
+def commit_every_option(ctx, param, value):
+    from mroll.migration import parse_commit_every
+    try:
+        return parse_commit_every(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 # ----------------------------------
 
@@ -57,6 +242,9 @@ def setup(dir_, path):
     """
     Set up work directory. Should be run once.
     """
+    import shutil
+    import configparser
+    from mroll.cache import CACHE_FILE
     directory = path or os.path.join(os.getcwd(), dir_)
     if os.access(directory, os.F_OK) and os.listdir(directory):
         raise SystemExit("Error: Directory %s already exists and it is not empty" % directory)
@@ -65,6 +253,9 @@ def setup(dir_, path):
     os.mkdir(versions)
     tmpl_dir = get_templates_dir()
     shutil.copy(os.path.join(tmpl_dir, 'mroll.ini'), directory)
+    # keep revision cache out of version control
+    with open(os.path.join(directory, '.gitignore'), 'w') as f:
+        f.write('{}\n'.format(CACHE_FILE))
     #  setup config file
     if not os.path.exists(SYS_CONFIG):
         os.mkdir(SYS_CONFIG)
@@ -83,6 +274,7 @@ def config(path):
     """
     Set up mroll configuration under $HOME/.config/mroll
     """
+    import configparser
     directory = path or os.path.join(os.getcwd(), 'migrations')
     dir_list = os.listdir(directory)
     check = ('mroll.ini' in dir_list) and ('versions' in dir_list)
@@ -101,35 +293,54 @@ def config(path):
     print('ok')
 
 @cli.command(name='init')
-def init():
+@click.option('-d', '--dir', 'mdir', help="the migrations directory")
+@target_options
+def init(mdir, targets, targets_file, jobs):
     """
     Creates mroll_revisions tbl. Should be run once.
     """
-    ensure_setup()
-    config = Config.from_file(MROLL_CONFIG_FILE)
-    wd = WorkDirectory(config.work_dir)
-    migr_ctx_config = wd.get_migration_ctx_config()
-    migr_ctx = create_migration_ctx(migr_ctx_config)
+    from mroll.databases import create_migration_ctx
+    if targets or targets_file:
+        return fan_out(mdir, targets, targets_file, jobs, lambda revisions, migr_ctx: _init(migr_ctx),
+            lambda revisions, migr_ctx: [], require_init=False)
+    wd = load_work_dir(mdir)
+    with create_migration_ctx(wd.get_migration_ctx_config()) as migr_ctx:
+        print(_init(migr_ctx))
+    print('Done')
+
+def _init(migr_ctx):
+    """
+    Creates the revisions table, or upgrades one of an older mroll version.
+    Returns what was done.
+    """
+    tbl_name = migr_ctx.config.tbl_name
+    # only here and on upgrade tables of older mroll versions are upgraded
+    added = migr_ctx.upgrade_revisions_tbl()
     try:
         # if following succeeds then mroll revisons tbl exist.
         migr_ctx.head
-        return print("Nothing to do! Mroll revisions table already exist.")
     except:
         pass
+    else:
+        if added:
+            return '{} table upgraded, added columns: {}'.format(tbl_name, ', '.join(added))
+        return "Nothing to do! Mroll revisions table already exist."
     try:
         migr_ctx.create_revisions_tbl()
     except Exception as e:
         raise SystemExit(e)
-    print('{} table created'.format(migr_ctx_config.tbl_name))
-    print('Done')
-    
+    return '{} table created'.format(tbl_name)
+
 @cli.command(name='revision')
 @click.option('-m', '--message', help='gets added to revision name')
 @click.option('-d', '--dir', 'mdir', help="the migrations directory")
-def revision(message, mdir):
+@click.option('--depends-on', 'depends_on', multiple=True,
+    help="id of revision this one depends on, revision then only waits for those")
+def revision(message, mdir, depends_on):
     """
     Creates new revision from a template.
     """
+    from mroll.migration import Revision, WorkDirectory
     if mdir:
         wd = WorkDirectory(mdir)
     else:
@@ -139,23 +350,35 @@ def revision(message, mdir):
     ts = datetime.now().isoformat()
     id_ = gen_rev_id()
     description = message or ''
-    wd.add_revision(Revision(id_, description, ts))
+    wd.add_revision(Revision(id_, description, ts, depends_on=depends_on or None))
     kebab = description.strip().replace(' ', '_')
     fn = os.path.join(wd.path, 'versions', '{}_{}.sql'.format(id_, kebab))
     assert os.path.exists(fn)
     print('ok')
 
+HISTORY_FORMATS = ('text', 'json', 'ndjson')
+
+def history_options(fn):
+    fn = click.option('-f', '--format', 'format_', type=click.Choice(HISTORY_FORMATS), default='text',
+        help="output format, json and ndjson include timings")(fn)
+    fn = click.option('--last', type=int, help="show only the last n applied revisions")(fn)
+    fn = click.option('--limit', type=int, help="show at most n applied revisions")(fn)
+    fn = click.option('--since', help="show revisions applied after revision id or since timestamp")(fn)
+    return fn
+
 @cli.command(name='history')
 @click.option('-d', '--dir', 'mdir', help="the migrations directory")
-def history(mdir):
+@click.option('-t', '--timings', 'show_timings', is_flag=True, help="show when and how long revisions were applied")
+@history_options
+def history(mdir, show_timings, since, limit, last, format_):
     """
     Shows applied revisions.
     """
-    if not mdir:
-        ensure_init()
-    return applied_revisions(mdir=mdir)
+    return applied_revisions(mdir=mdir, show_timings=show_timings, since=since, limit=limit, last=last,
+        format_=format_)
     
 def all_revisions(show_patch=False, mdir=None):
+    from mroll.migration import WorkDirectory
     if mdir:
         wd = WorkDirectory(mdir)
     else:
@@ -168,46 +391,89 @@ def all_revisions(show_patch=False, mdir=None):
         else:
             print(rev)
 
-def applied_revisions(show_patch=False, mdir=None):
-    if mdir:
-        wd = WorkDirectory(mdir)
-    else:
-        config = Config.from_file(MROLL_CONFIG_FILE)
-        wd = WorkDirectory(config.work_dir)
+def format_timing(timing):
+    applied_at, duration, stmt_count = timing or (None, None, None)
+    return 'applied_at={} duration={} statements={}'.format(
+        applied_at or '-',
+        '-' if duration is None else '{:.3f}s'.format(duration),
+        '-' if stmt_count is None else stmt_count)
 
-    migr_ctx = create_migration_ctx(wd.get_migration_ctx_config())
-    if migr_ctx.head is None:
-        print('No revisions have being applied yet!')
-        return
-    # create lookup
-    lookup = {}
-    for r in migr_ctx.revisions:
-        lookup[r.id] = r
+def parse_since(value):
+    """
+    Returns datetime for timestamps, e.g. 2020-05-04 or 2020-05-04T23:14, else
+    the value as revision id.
+    """
+    if value is None or ('-' not in value and ':' not in value):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise SystemExit("Error: invalid timestamp {}".format(value))
 
-    working_set: List[Revision] = list(filter(lambda rev: rev.id in lookup, wd.revisions))
-    for rev in working_set:
-        if show_patch:
-            print(rev.serialize())
+def history_record(row) -> dict:
+    id_, description, ts, applied_at, duration, stmt_count = row
+    iso = lambda v: v.isoformat() if isinstance(v, datetime) else v
+    return dict(id=id_, description=description, ts=iso(ts), applied_at=iso(applied_at), duration=duration,
+        statements=stmt_count)
+
+def print_history(rows, format_='text', show_timings=False, patches=None):
+    """
+    Prints history rows as they are fetched. patches maps ids to work dir
+    revisions whose sql is printed instead.
+    """
+    import json
+    if format_ == 'ndjson':
+        for row in rows:
+            print(json.dumps(history_record(row)))
+        return
+    if format_ == 'json':
+        sep = '['
+        for row in rows:
+            print(sep + json.dumps(history_record(row)))
+            sep = ','
+        print('[]' if sep == '[' else ']')
+        return
+    from mroll.migration import Revision
+    for row in rows:
+        rev = Revision(*row[:3])
+        if patches is not None:
+            print(patches.get(rev.id, rev).serialize())
+        elif show_timings:
+            print(rev, format_timing(row[3:]))
         else:
             print(rev)
 
+def applied_revisions(show_patch=False, mdir=None, show_timings=False, since=None, limit=None, last=None,
+    format_='text'):
+    """
+    Streams applied revisions from the revisions table, filtered by the database.
+    """
+    if limit is not None and last is not None:
+        raise SystemExit("Error: --limit and --last can not be combined")
+    since = parse_since(since)
+    wd, migr_ctx = open_session(mdir)
+    with migr_ctx:
+        if migr_ctx.head is None:
+            if format_ == 'json':
+                print('[]')
+            elif format_ == 'text':
+                print('No revisions have being applied yet!')
+            return
+        patches = {rev.id: rev for rev in wd.revisions} if show_patch else None
+        try:
+            print_history(migr_ctx.history(since, limit, last), format_, show_timings, patches)
+        except ValueError as e:
+            raise SystemExit(e)
+
 def pending_revisions(show_patch=False, mdir=None):
     """
     Shows pending revisions not yet applied.
     """
-    if mdir:
-        wd = WorkDirectory(mdir)
-    else:
-        config = Config.from_file(MROLL_CONFIG_FILE)
-        wd = WorkDirectory(config.work_dir)
-    migr_ctx = create_migration_ctx(wd.get_migration_ctx_config())
-    # create lookup
-    lookup = {}
-    for r in migr_ctx.revisions:
-        lookup[r.id] = r
-
-    working_set: List[Revision] = list(filter(lambda rev: rev.id not in lookup, wd.revisions))
-    for r in working_set:
+    wd, migr_ctx = open_session(mdir)
+    with migr_ctx:
+        plan = make_plan(wd.revisions, migr_ctx)
+
+    for r in plan.pending:
         if show_patch:
             print(r.serialize())
         else:
@@ -222,7 +488,8 @@ def show():
 @click.option('-d', '--dir', 'mdir', help="the migrations directory")
 def all(patch, mdir):
     if not mdir:
-        ensure_init()
+        _, migr_ctx = ensure_init()
+        migr_ctx.close()
 
     return all_revisions(show_patch=patch, mdir=mdir)
 
@@ -230,49 +497,229 @@ def all(patch, mdir):
 @click.option('-p', '--patch', is_flag=True)
 @click.option('-d', '--dir', 'mdir', help="the migrations directory")
 def pending(patch, mdir):
-    if not mdir:
-        ensure_init()
-
     return pending_revisions(show_patch=patch, mdir=mdir)
 
 @show.command(name="applied")
 @click.option('-p', '--patch', is_flag=True)
 @click.option('-d', '--dir', 'mdir', help="the migrations directory")
-def applied(patch, mdir):
-    if not mdir:
-        ensure_init()
+@history_options
+def applied(patch, mdir, since, limit, last, format_):
+    return applied_revisions(show_patch=patch, mdir=mdir, since=since, limit=limit, last=last, format_=format_)
 
-    return applied_revisions(show_patch=patch, mdir=mdir)
+@cli.command(name='status')
+@click.option('-d', '--dir', 'mdir', help="the migrations directory")
+def status(mdir):
+    """
+    Shows head, number of applied revisions and whether the work dir changed since.
+    """
+    from mroll.migration import revisions_fingerprint
+    wd, migr_ctx = open_session(mdir)
+    with migr_ctx:
+        try:
+            state = migr_ctx.state
+        except Exception:
+            raise SystemExit("Error: mroll not initialized! Run init command first.")
+    revisions = wd.revisions
+    print('head: {}'.format(state.head or '-'))
+    print('applied: {}'.format(state.applied_count))
+    if state.fingerprint is None:
+        changed = 'not recorded yet'
+    elif state.fingerprint == revisions_fingerprint(revisions):
+        changed = 'unchanged since last change to the database'
+    else:
+        changed = 'changed since last change to the database'
+    print('work dir: {} revisions, {}'.format(len(revisions), changed))
+
+@cli.command(name='verify')
+@click.option('-d', '--dir', 'mdir', help="the migrations directory")
+@click.option('--record-missing', is_flag=True,
+    help="record checksums of revisions applied before checksums were recorded")
+@target_options
+def verify(mdir, record_missing, targets, targets_file, jobs):
+    """
+    Checks applied revisions against their files in the work dir.
+    """
+    if targets or targets_file:
+        return fan_out(mdir, targets, targets_file, jobs, lambda revisions, migr_ctx:
+            _verify(revisions, migr_ctx, record_missing, quiet=True))
+    wd, migr_ctx = open_session(mdir)
+    with migr_ctx:
+        revisions = wd.revisions
+        # computed once, later runs read them from the revision cache
+        wd.checksums(revisions)
+        print(_verify(revisions, migr_ctx, record_missing))
+
+def _verify(revisions, migr_ctx, record_missing=False, quiet=False):
+    """
+    Compares checksums recorded for applied revisions with those of the work
+    dir, in one pass over the history table. Returns a summary, exits with 1
+    on revisions changed or missing from the work dir.
+    """
+    by_id = {rev.id: rev for rev in revisions}
+    squashed = set(id_ for rev in revisions if rev.squashes for id_ in rev.squashes)
+    recorded = list(migr_ctx.checksums())
+    ok = 0
+    changed = []
+    missing = []
+    unrecorded = {}
+    for id_, checksum in recorded:
+        rev = by_id.get(id_)
+        if rev is None:
+            if id_ not in squashed:
+                missing.append(id_)
+        elif checksum is None:
+            unrecorded[id_] = rev.checksum
+        elif checksum != rev.checksum:
+            changed.append(rev)
+        else:
+            ok += 1
+    if record_missing and unrecorded:
+        migr_ctx.record_checksums(unrecorded)
+    if not quiet:
+        for rev in changed:
+            print('changed: {}'.format(rev))
+        for id_ in missing:
+            print('missing from work dir: {}'.format(id_))
+    summary = '{} applied: {} ok, {} changed, {} missing, {} {}'.format(len(recorded), ok, len(changed), len(missing),
+        len(unrecorded), 'checksums recorded' if record_missing else 'without checksum')
+    if changed or missing:
+        if quiet:
+            raise SystemExit('{} ({})'.format(summary, ', '.join([rev.id for rev in changed] + missing)))
+        print(summary)
+        raise SystemExit(1)
+    return summary
+
+@cli.command(name='plan')
+@click.option('-n', '--num', 'step', type=int, help="plan n number of pending revisions")
+@click.option('-d', '--dir', 'mdir', help="the migrations directory")
+@click.option('--large-rows', 'large_rows', type=int,
+    help="flag expensive operations on tables with at least this many rows (default 10000000)")
+def plan_revisions(step, mdir, large_rows):
+    """
+    Estimates cost of pending revisions with EXPLAIN, without running them.
+    """
+    wd, migr_ctx = open_session(mdir)
+    with migr_ctx:
+        plan = make_plan(wd.revisions, migr_ctx)
+        working_set = plan.pending[:step or len(plan.pending)]
+        if not working_set:
+            print('No pending revisions')
+            return
+        try:
+            costs = migr_ctx.estimate_costs(working_set, large_rows)
+        except ValueError as e:
+            raise SystemExit(e)
+    total = 0
+    for rev_cost in costs:
+        total += rev_cost.cost
+        unknown = ', {} statement(s) not estimated'.format(rev_cost.unknown) if rev_cost.unknown else ''
+        print('{} cost={}{}'.format(rev_cost.revision, rev_cost.cost, unknown))
+        for flag in rev_cost.flags:
+            print('  ! {}'.format(flag))
+    print('{} revisions, estimated cost {} column values'.format(len(costs), total))
 
 @cli.command(name="upgrade")
-@click.option('-n', '--num', 'step', help="run n number of pending revisions")
+@click.option('-n', '--num', 'step', type=int, help="run n number of pending revisions")
 @click.option('-d', '--dir', 'mdir', help="the migrations directory")
-def upgrade(step, mdir):
+@click.option('-b', '--batch-size', 'batch_size', type=int, help="number of statements sent per request")
+@click.option('-c', '--commit-every', 'commit_every', callback=commit_every_option,
+    help="commit after all (default), every revision or every N revisions")
+@click.option('-p', '--parallel', type=int,
+    help="apply independent revisions concurrently over up to N connections")
+@click.option('--progress/--no-progress', 'show_progress', default=True,
+    help="show progress and ETA while running, on stderr")
+@target_options
+def upgrade(step, mdir, batch_size, commit_every, parallel, show_progress, targets, targets_file, jobs):
     """
     Applies revisions in work dir not yet applied.
     """
-    if mdir:
-        wd = WorkDirectory(mdir)
-    else:
-        ensure_init()
-        config = Config.from_file(MROLL_CONFIG_FILE)
-        wd = WorkDirectory(config.work_dir)
-    migr_ctx = create_migration_ctx(wd.get_migration_ctx_config())
-    # create lookup
-    lookup = {}
-    for r in migr_ctx.revisions:
-        lookup[r.id] = r
-    working_set: List[Revision] = list(filter(lambda rev: lookup.get(rev.id, None) is None, wd.revisions))
+    from mroll.migration import revisions_fingerprint
+    from mroll.databases import create_migration_ctx
+    if parallel and (targets or targets_file):
+        raise SystemExit("Error: --parallel can not be combined with --target")
+    if parallel:
+        wd, migr_ctx = open_session(mdir, upgrade_tbl=True)
+        revisions = wd.revisions
+        fingerprint = revisions_fingerprint(revisions)
+        with migr_ctx:
+            config = migr_ctx.config
+            migr_ctx.fingerprint = fingerprint
+            sync_squashed(revisions, migr_ctx)
+            plan = make_plan(revisions, migr_ctx)
+
+        def ctx_factory():
+            ctx = create_migration_ctx(config)
+            ctx.fingerprint = fingerprint
+            # branches committing concurrently would conflict on the state row
+            ctx.defer_state = True
+            return ctx
+
+        return _upgrade_parallel(revisions, plan, ctx_factory, step, parallel, batch_size)
+    if targets or targets_file:
+        return fan_out(mdir, targets, targets_file, jobs, lambda revisions, migr_ctx:
+            'applied {} revisions'.format(_upgrade(revisions, migr_ctx, step, batch_size, commit_every)),
+            lambda revisions, migr_ctx: make_plan(revisions, migr_ctx, warn=False).pending[:step or None],
+            upgrade_tbl=True)
+    wd, migr_ctx = open_session(mdir, upgrade_tbl=True)
+    with migr_ctx:
+        _upgrade(wd.revisions, migr_ctx, step, batch_size, commit_every, wd, show_progress)
+    print('Done')
+
+@contextmanager
+def track_changes(wd, migr_ctx, working_set, upgrade=True, show_progress=True):
+    """
+    Shows progress of add_revisions/remove_revisions when show_progress is
+    set, and records durations in the work dir for ETAs of later runs. The
+    ETA uses these durations, for a rollback also durations of the upgrade
+    from the history table, otherwise seconds per statement of the history table.
+    """
+    progress = None
+    if show_progress:
+        from mroll.progress import Progress
+        expected, stmt_rate = migr_ctx.timing_estimates([] if upgrade else [rev.id for rev in working_set])
+        expected.update(wd.durations(upgrade))
+        progress = migr_ctx.progress = Progress(working_set, upgrade, expected, stmt_rate)
+    try:
+        yield
+    finally:
+        if progress is not None:
+            progress.close()
+            migr_ctx.progress = None
+        wd.record_durations(getattr(migr_ctx, 'last_timings', None) or [], upgrade)
+        wd.save_cache()
+
+def _upgrade(revisions, migr_ctx, step, batch_size=None, commit_every=None, wd=None, show_progress=False):
+    """
+    Applies pending revisions, returns number of applied revisions. With the
+    work dir given progress is tracked, see track_changes.
+    """
+    from mroll.migration import revisions_fingerprint
+    migr_ctx.fingerprint = revisions_fingerprint(revisions)
+    sync_squashed(revisions, migr_ctx)
+    working_set = make_plan(revisions, migr_ctx).pending
     ptr = step or len(working_set)
     # adjust working set
     working_set = working_set[:ptr]
+    ensure_upgrade_sql(working_set)
+    # execute
+    try:
+        if wd is None:
+            migr_ctx.add_revisions(working_set, batch_size=batch_size, commit_every=commit_every)
+        else:
+            with track_changes(wd, migr_ctx, working_set, True, show_progress):
+                migr_ctx.add_revisions(working_set, batch_size=batch_size, commit_every=commit_every)
+    except RevisionOperationError as e:
+        raise SystemExit(repr(e))
+    return len(working_set)
+
+def ensure_upgrade_sql(working_set):
     # ensure idempotency
     for rev in working_set:
-        if rev.upgrade_sql is None:
+        if not rev.has_sql(upgrade=True):
             msg="""
             Error: No upgrade sql script @{}!
             """.format(rev.id)
-            if rev.downgrade_sql is not None:
+            if rev.has_sql(upgrade=False):
                 msg="""
                 Error: No upgrade sql script @{}, while there is a
                 downgrade sql:
@@ -280,35 +727,99 @@ def upgrade(step, mdir):
                 Scripts should be idempotent.
                 """.format(rev.id, rev.downgrade_sql)
             raise SystemExit(msg)
-    # execute
+
+def _upgrade_parallel(revisions, plan, ctx_factory, step, jobs, batch_size=None):
+    """
+    Applies pending revisions following their dependencies, revisions not
+    depending on each other run concurrently, each committed on its own.
+    Failures only stop revisions depending on the failed one.
+    """
+    from mroll import dag
+    from mroll.migration import prefetch_revisions
     try:
-        migr_ctx.add_revisions(working_set)
-    except RevisionOperationError as e:
-        raise SystemExit(repr(e))
+        deps = dag.build_dependencies(revisions)
+    except ValueError as e:
+        raise SystemExit(e)
+    working_set = plan.pending[:step or len(plan.pending)]
+    applied_ids = set(rev.id for rev in plan.applied)
+    ensure_upgrade_sql(working_set)
+    # workers only read shared revisions, split statements up front
+    prefetch_revisions(working_set)
+    pending_ids = set(rev.id for rev in working_set)
+
+    def apply(rev):
+        missing = [id_ for id_ in deps[rev.id] if id_ not in applied_ids and id_ not in pending_ids]
+        if missing:
+            raise SystemExit('depends on revision(s) not applied: {}'.format(', '.join(missing)))
+        migr_ctx = pool.acquire()
+        try:
+            migr_ctx.add_revisions([rev], batch_size=batch_size, commit_every=1)
+        except RevisionOperationError as e:
+            raise SystemExit(repr(e))
+        finally:
+            pool.release(migr_ctx)
+
+    def report(result):
+        if result.status == dag.APPLIED:
+            print('{} ({:.2f}s)'.format(result.revision, result.duration))
+        else:
+            print('{} {}: {}'.format(result.revision, result.status.upper(), result.message))
+
+    try:
+        with dag.ContextPool(ctx_factory) as pool:
+            try:
+                results = dag.run_dag(working_set, deps, apply, jobs=jobs, on_result=report)
+            finally:
+                # once all branches are done, also after failures
+                pool.acquire().rebuild_state()
+    except ValueError as e:
+        raise SystemExit(e)
+    counts = {status: 0 for status in (dag.APPLIED, dag.FAILED, dag.SKIPPED)}
+    for result in results:
+        counts[result.status] += 1
+    print('{} applied, {} failed, {} skipped'.format(counts[dag.APPLIED], counts[dag.FAILED], counts[dag.SKIPPED]))
+    if counts[dag.FAILED] or counts[dag.SKIPPED]:
+        raise SystemExit(1)
     print('Done')
 
 @cli.command(name='rollback')
 @click.option('-n', '--num', 'step', default=1, help="rollbacks n number applied revisions")
 @click.option('-r', '--rev', 'rev_id', help="rollbacks to specific revision id inclusive")
 @click.option('-d', '--dir', 'mdir', help="the migrations directory")
-def rollback(step, rev_id, mdir):
+@click.option('-b', '--batch-size', 'batch_size', type=int, help="number of statements sent per request")
+@click.option('-c', '--commit-every', 'commit_every', callback=commit_every_option,
+    help="commit after all (default), every revision or every N revisions")
+@click.option('--progress/--no-progress', 'show_progress', default=True,
+    help="show progress and ETA while running, on stderr")
+@target_options
+def rollback(step, rev_id, mdir, batch_size, commit_every, show_progress, targets, targets_file, jobs):
     """
     Downgrades to previous revision by default. 
     """
-    if mdir:
-        wd = WorkDirectory(mdir)
-    else:
-        ensure_init()
-        config = Config.from_file(MROLL_CONFIG_FILE)
-        wd = WorkDirectory(config.work_dir)
-    migr_ctx = create_migration_ctx(wd.get_migration_ctx_config())
+    if targets or targets_file:
+        def working_set(revisions, migr_ctx):
+            applied = make_plan(revisions, migr_ctx, warn=False).applied
+            return applied if rev_id is not None else applied[-step:]
+
+        return fan_out(mdir, targets, targets_file, jobs, lambda revisions, migr_ctx:
+            'rolled back {} revisions'.format(_rollback(revisions, migr_ctx, step, rev_id, batch_size, commit_every)),
+            working_set)
+    wd, migr_ctx = open_session(mdir)
+    with migr_ctx:
+        _rollback(wd.revisions, migr_ctx, step, rev_id, batch_size, commit_every, wd, show_progress)
+    print('Done')
+
+def _rollback(revisions, migr_ctx, step, rev_id, batch_size=None, commit_every=None, wd=None, show_progress=False):
+    """
+    Removes applied revisions, returns number of removed revisions. With the
+    work dir given progress is tracked, see track_changes.
+    """
+    from mroll.migration import revisions_fingerprint
     if migr_ctx.head is None:
         raise SystemExit('Nothing to do!')
-    # create lookup
-    lookup = {}
-    for r in migr_ctx.revisions:
-        lookup[r.id] = r
-    working_set: List[Revision] = list(filter(lambda rev: lookup.get(rev.id, None) is not None, wd.revisions))
+    migr_ctx.fingerprint = revisions_fingerprint(revisions)
+    sync_squashed(revisions, migr_ctx)
+    working_set = make_plan(revisions, migr_ctx).applied
     count = 0
     buff=[]
     for rev in reversed(working_set):
@@ -320,14 +831,17 @@ def rollback(step, rev_id, mdir):
                 break
         buff.append(rev)
         count+=1
-    working_set: List[Revision] = [] + buff
+    working_set = [] + buff
      # insure idempotency
     for rev in working_set:
-        if rev.downgrade_sql is None:
+        if rev.chunked and 'online_alter' in rev.directives:
+            # rolled back to the table kept by the online change without downgrade sql
+            continue
+        if not rev.has_sql(upgrade=False):
             msg="""
                 Error: No downgrade sql script @{}!
                 """.format(rev.id)
-            if rev.upgrade_sql is not None:
+            if rev.has_sql(upgrade=True):
                 msg="""
                 Error: No downgrade sql script @{}, while there is a
                 upgrade sql:
@@ -336,10 +850,112 @@ def rollback(step, rev_id, mdir):
                 """.format(rev.id, rev.upgrade_sql)
             raise SystemExit(msg)
     try:
-        migr_ctx.remove_revisions(working_set)
+        if wd is None:
+            migr_ctx.remove_revisions(working_set, batch_size=batch_size, commit_every=commit_every)
+        else:
+            with track_changes(wd, migr_ctx, working_set, False, show_progress):
+                migr_ctx.remove_revisions(working_set, batch_size=batch_size, commit_every=commit_every)
     except RevisionOperationError as e:
         raise SystemExit(repr(e))
-    print('Done')
+    return len(working_set)
+
+@cli.command(name='squash')
+@click.option('-r', '--rev', 'rev_id', required=True, help="squash revisions up to this revision id inclusive")
+@click.option('-m', '--message', help="description of the baseline revision")
+@click.option('-d', '--dir', 'mdir', help="the migrations directory")
+def squash(rev_id, message, mdir):
+    """
+    Collapses revisions up to a revision into one baseline revision.
+    """
+    from mroll.migration import squash as squash_revisions, revisions_fingerprint
+    wd, migr_ctx = open_session(mdir)
+    with migr_ctx:
+        revisions = wd.revisions
+        try:
+            baseline, squashed = squash_revisions(revisions, rev_id, message)
+        except ValueError as e:
+            raise SystemExit(e)
+        migr_ctx.fingerprint = revisions_fingerprint([baseline] + revisions[len(squashed):])
+        sync_squashed(revisions, migr_ctx)
+        recorded = set(migr_ctx.applied_ids())
+        applied = [rev.id for rev in squashed if rev.id in recorded]
+        if applied and len(applied) != len(squashed):
+            raise SystemExit("Error: revisions up to {} are only partially applied, "
+                "upgrade or rollback before squashing".format(rev_id))
+        check_targets(wd, squashed)
+        archive = replace_by_baseline(wd, migr_ctx, baseline, squashed, applied or None)
+    print('Squashed {} revisions into {}, replaced files moved to {}'.format(len(squashed), baseline, archive))
+
+@cli.command(name='baseline')
+@click.option('-m', '--message', help="description of the baseline revision")
+@click.option('-d', '--dir', 'mdir', help="the migrations directory")
+def baseline(message, mdir):
+    """
+    Snapshots database schema into a revision recorded as applied.
+    """
+    from mroll.migration import Revision, squashed_ids, revisions_fingerprint
+    wd, migr_ctx = open_session(mdir)
+    with migr_ctx:
+        revisions = wd.revisions
+        try:
+            migr_ctx.head
+        except Exception:
+            raise SystemExit("Error: mroll not initialized! Run init command first.")
+        sync_squashed(revisions, migr_ctx)
+        recorded = set(migr_ctx.applied_ids())
+        try:
+            upgrade_sql, downgrade_sql = migr_ctx.snapshot_schema()
+        except ValueError as e:
+            raise SystemExit(e)
+        if not upgrade_sql:
+            raise SystemExit("Error: database schema is empty, nothing to snapshot")
+        # applied revisions are part of the snapshot, it replaces them
+        applied = [rev for rev in revisions if rev.id in recorded]
+        if applied:
+            ts = applied[-1].ts
+        elif revisions:
+            ts = (datetime.fromisoformat(revisions[0].ts) - timedelta(seconds=1)).isoformat()
+        else:
+            ts = datetime.now().isoformat()
+        rev = Revision(gen_rev_id(), message or 'baseline', ts, upgrade_sql=upgrade_sql,
+            downgrade_sql=downgrade_sql, squashes=squashed_ids(applied))
+        check_targets(wd, applied)
+        rest = [r for r in revisions if r.id not in recorded]
+        migr_ctx.fingerprint = revisions_fingerprint(sorted([rev] + rest, key=lambda r: datetime.fromisoformat(r.ts)))
+        replace_by_baseline(wd, migr_ctx, rev, applied, [r.id for r in applied])
+    print('Created baseline {} with {} statements, replacing {} applied revisions'.format(
+        rev, len(rev.upgrade_stmts), len(applied)))
+
+@cli.command(name='bench')
+@click.option('-s', '--sizes', default='100,10000', help="comma separated numbers of revisions to generate")
+@click.option('--body', type=click.Choice(['small', 'huge', 'both']), default='small',
+    help="size of generated revision bodies")
+@click.option('-r', '--repeat', default=3, help="runs per measurement")
+@click.option('--db', 'db_name', help="also apply revisions against this MonetDB database")
+@click.option('--hostname', default='127.0.0.1')
+@click.option('--port', default=50000)
+@click.option('--username', default='monetdb')
+@click.option('--password', default='monetdb')
+@click.option('-b', '--batch-size', 'batch_size', type=int, help="number of statements sent per request")
+@click.option('-o', '--output', type=click.File('w'), default='-', help="write JSON report to file")
+def bench(sizes, body, repeat, db_name, hostname, port, username, password, batch_size, output):
+    """
+    Benchmarks loading, planning and applying revisions. Prints JSON report.
+    """
+    import json
+    from mroll import bench as bench_
+    try:
+        sizes = [int(s) for s in sizes.split(',')]
+    except ValueError:
+        raise SystemExit("Error: invalid sizes '{}'".format(sizes))
+    bodies = ('small', 'huge') if body == 'both' else (body,)
+    ctx_config = None
+    if db_name:
+        ctx_config = bench_.ctx_config_for(db_name, hostname=hostname, port=port,
+            username=username, password=password)
+    report = bench_.run(sizes, bodies=bodies, repeat=repeat, ctx_config=ctx_config, batch_size=batch_size)
+    json.dump(report, output, indent=2)
+    output.write('\n')
 
 @cli.command(name='version')
 def version():
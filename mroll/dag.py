@@ -0,0 +1,183 @@
+"""
+Dependency graph of revisions and a scheduler applying independent
+revisions concurrently.
+
+A revision lists the revisions it needs in its `-- depends_on=` header.
+Revisions without the header keep the classic behaviour and depend on every
+revision before them in ts order.
+"""
+import time
+import heapq
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Tuple
+
+APPLIED = 'applied'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+class RevisionResult:
+    __slots__ = ('revision', 'status', 'message', 'duration')
+
+    def __init__(self, revision, status, message=None, duration=0.0):
+        self.revision = revision
+        self.status = status
+        self.message = message
+        self.duration = duration
+
+    def __repr__(self):
+        return "<RevisionResult id={} status={}>".format(self.revision.id, self.status)
+
+def build_dependencies(revisions) -> Dict[str, Tuple[str]]:
+    """
+    Returns ids of direct dependencies per revision id, revisions in ts order.
+    Revisions without depends_on header depend on the revisions no other
+    revision depends on so far, i.e. transitively on all earlier revisions.
+    """
+    ids = set(rev.id for rev in revisions)
+    # dependencies on squashed revisions point to their baseline
+    aliases = {id_: rev.id for rev in revisions for id_ in rev.squashes or ()}
+    deps = {}
+    leaves = {}
+    for rev in revisions:
+        if rev.depends_on is None:
+            deps[rev.id] = tuple(leaves)
+            leaves.clear()
+        else:
+            depends_on = tuple(dict.fromkeys(aliases.get(id_, id_) for id_ in rev.depends_on))
+            unknown = [id_ for id_ in depends_on if id_ not in ids]
+            if unknown:
+                raise ValueError("Error: revision {} depends on unknown revision(s) {}".format(
+                    rev.id, ', '.join(unknown)))
+            deps[rev.id] = depends_on
+            for id_ in depends_on:
+                leaves.pop(id_, None)
+        leaves[rev.id] = None
+    return deps
+
+def topological_order(revisions, deps) -> List:
+    """
+    Orders revisions so that every revision comes after its dependencies,
+    keeping ts order among independent ones. Raises ValueError on cycles.
+    """
+    by_id = {rev.id: rev for rev in revisions}
+    pos = {rev.id: i for i, rev in enumerate(revisions)}
+    indegree = {rev.id: 0 for rev in revisions}
+    children = {rev.id: [] for rev in revisions}
+    for rev in revisions:
+        for id_ in deps[rev.id]:
+            if id_ in by_id:
+                indegree[rev.id] += 1
+                children[id_].append(rev.id)
+    ready = [pos[id_] for id_, n in indegree.items() if n == 0]
+    heapq.heapify(ready)
+    res = []
+    while ready:
+        rev = revisions[heapq.heappop(ready)]
+        res.append(rev)
+        for child in children[rev.id]:
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                heapq.heappush(ready, pos[child])
+    if len(res) != len(revisions):
+        cycle = [id_ for id_, n in indegree.items() if n > 0]
+        raise ValueError("Error: dependency cycle among revisions {}".format(', '.join(cycle)))
+    return res
+
+def run_dag(revisions, deps, fn, jobs=4, on_result=None) -> List[RevisionResult]:
+    """
+    Calls fn(revision) for every revision as soon as all its dependencies
+    succeeded, at most jobs at a time. Dependencies not in revisions count as
+    satisfied. When a revision fails, revisions depending on it are skipped,
+    independent branches carry on. on_result(result) is called as revisions
+    complete. Returns results in ts order.
+    """
+    by_id = {rev.id: rev for rev in revisions}
+    pos = {rev.id: i for i, rev in enumerate(revisions)}
+    waiting = {}
+    children = {rev.id: [] for rev in revisions}
+    for rev in revisions:
+        waiting[rev.id] = 0
+        for id_ in deps[rev.id]:
+            if id_ in by_id:
+                waiting[rev.id] += 1
+                children[id_].append(rev.id)
+    # fail early on cycles, nothing would run otherwise
+    topological_order(revisions, deps)
+    results = {}
+
+    def done(result):
+        results[result.revision.id] = result
+        if on_result is not None:
+            on_result(result)
+
+    def skip_descendants(failed_id):
+        stack = list(children[failed_id])
+        while stack:
+            id_ = stack.pop()
+            if id_ in results:
+                continue
+            done(RevisionResult(by_id[id_], SKIPPED, 'depends on failed revision {}'.format(failed_id)))
+            stack.extend(children[id_])
+
+    def run_one(rev):
+        start = time.perf_counter()
+        try:
+            fn(rev)
+            return RevisionResult(rev, APPLIED, duration=time.perf_counter() - start)
+        except SystemExit as e:
+            return RevisionResult(rev, FAILED, str(e.code).strip(), time.perf_counter() - start)
+        except Exception as e:
+            return RevisionResult(rev, FAILED, repr(e), time.perf_counter() - start)
+
+    ready = sorted((id_ for id_, n in waiting.items() if n == 0), key=pos.get)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        running = set(pool.submit(run_one, by_id[id_]) for id_ in ready)
+        while running:
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                result = future.result()
+                done(result)
+                if result.status != APPLIED:
+                    skip_descendants(result.revision.id)
+                    continue
+                unblocked = []
+                for child in children[result.revision.id]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0 and child not in results:
+                        unblocked.append(child)
+                for id_ in sorted(unblocked, key=pos.get):
+                    running.add(pool.submit(run_one, by_id[id_]))
+    return [results[rev.id] for rev in revisions]
+
+class ContextPool:
+    """
+    Migration contexts shared by scheduler workers, each holding its own
+    connection. Contexts are opened on demand and closed by close().
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.idle = queue.Queue()
+        self.opened = []
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            ctx = self.factory()
+            self.opened.append(ctx)
+            return ctx
+
+    def release(self, ctx):
+        self.idle.put(ctx)
+
+    def close(self):
+        for ctx in self.opened:
+            ctx.close()
+        self.opened = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,15 +1,20 @@
-from .monetdb import MonetMigrCtx
 from mroll.migration import MigrationContext
 
 __all__ = (
     'create_migration_ctx'
 )
 
-def create_migration_ctx(config, database='monetdb') -> MigrationContext:
+def create_migration_ctx(config, database=None) -> MigrationContext:
     """
     Factory method to create specific database engine context.
-    Defaults to monetdb.
+    Engine is taken from the backend option in mroll.ini, defaults to monetdb.
     """
+    database = database or getattr(config, 'backend', None) or 'monetdb'
+    # engines are imported on use, pymonetdb takes longer to load than the rest of mroll
     if database == 'monetdb':
+        from .monetdb import MonetMigrCtx
         return MonetMigrCtx(config)
-        
\ No newline at end of file
+    if database == 'sqlite':
+        from .sqlite import SqliteMigrCtx
+        return SqliteMigrCtx(config)
+    raise ValueError("Error: unknown backend '{}'".format(database))
@@ -0,0 +1,179 @@
+"""
+Chunked, resumable backfills of large MonetDB tables
+
+A revision with a `-- backfill=<table>` header holds UPDATE or DELETE
+statements on that table. They are run over successive ranges of
+`-- batch_rows=` rows ordered by `-- batch_key=`, the range condition added to
+their WHERE clause, and every range is committed on its own together with the
+last key done, kept in the <revisions table>_progress table. An interrupted
+run resumes after that key. The last range is committed with the revision
+record. Ranges never hold NULL keys, so the batch key column must be not
+null.
+
+Before each range the number of queries running, as listed by sys.queue(),
+is checked and mroll pauses while it exceeds the throttle_queries option.
+"""
+import re
+import time
+from datetime import datetime
+from typing import Callable, Tuple
+from mroll.migration import Revision, RevisionTiming
+from mroll.exceptions import RevisionOperationError
+from mroll.databases.catalog import quote
+from mroll.databases.cost import TABLE_NAME, table_of, statement_body, current_schema
+from mroll.databases.online import (OnlineTable, DEFAULT_BATCH_ROWS, INTEGER_TYPES, execute, in_transaction,
+    range_condition, next_bound, batch_key_type)
+
+# seconds to wait before checking sys.queue() again
+DEFAULT_THROTTLE_PAUSE = 5.0
+
+_BACKFILL = re.compile(r'^\s*(?:update\s+|delete\s+from\s+)' + TABLE_NAME, re.I)
+# tokens that may hold a WHERE keyword not belonging to the statement itself
+_WHERE_TOKENS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|[()]|\bwhere\b", re.I | re.S)
+
+def progress_table(tbl_name: str) -> str:
+    """
+    Name of the table holding the last key done of unfinished backfills.
+    """
+    return '{}_progress'.format(tbl_name)
+
+def top_level_where(stmt: str) -> int:
+    """
+    Returns position of the WHERE keyword of a statement, skipping those in
+    sub queries, strings and comments, or -1.
+    """
+    depth = 0
+    for m in _WHERE_TOKENS.finditer(stmt):
+        tok = m.group()
+        if tok == '(':
+            depth += 1
+        elif tok == ')':
+            depth -= 1
+        elif depth == 0 and tok.lower() == 'where':
+            return m.start()
+    return -1
+
+def restrict(stmt: str, cond: str) -> str:
+    """
+    Adds cond to the WHERE clause of an UPDATE or DELETE statement.
+    """
+    stmt = stmt.strip()
+    if stmt.endswith(';'):
+        stmt = stmt[:-1].rstrip()
+    pos = top_level_where(stmt)
+    if pos < 0:
+        return '{} where {};'.format(stmt, cond)
+    # newline ends a trailing line comment of the original condition
+    return '{}where ({}) and ({}\n);'.format(stmt[:pos], cond, stmt[pos + len('where'):].strip())
+
+def running_queries(conn) -> int:
+    """
+    Number of queries running besides this one, None when sys.queue() can
+    not be read.
+    """
+    try:
+        count = execute(conn, "select count(*) from sys.queue() where status = 'running'").fetchone()[0]
+        return max(count - 1, 0)
+    except Exception:
+        return None
+    finally:
+        conn.rollback()
+
+def wait_while_busy(conn, max_running: int, pause: float) -> float:
+    """
+    Sleeps while more than max_running queries run. Returns seconds waited.
+    """
+    waited = 0.0
+    if not max_running:
+        return waited
+    while True:
+        running = running_queries(conn)
+        if running is None or running <= max_running:
+            return waited
+        time.sleep(pause)
+        waited += pause
+
+def create_progress_table(conn, tbl_name: str) -> None:
+    execute(conn, """create table if not exists sys."{}" (id string primary key, last_key string,
+        chunks int, updated_at timestamp)""".format(progress_table(tbl_name)))
+
+def get_progress(conn, rev: Revision, tbl_name: str) -> Tuple[str, int]:
+    """
+    Returns (last key done as sql literal, chunks done) of an interrupted
+    backfill, (None, 0) when it starts from scratch.
+    """
+    row = execute(conn, 'select last_key, chunks from sys."{}" where id = %s'.format(progress_table(tbl_name)),
+        (rev.id,)).fetchone()
+    return (row[0], row[1]) if row else (None, 0)
+
+def set_progress(conn, rev: Revision, tbl_name: str, last_key: str, chunks: int) -> None:
+    table = progress_table(tbl_name)
+    execute(conn, 'delete from sys."{}" where id = %s'.format(table), (rev.id,))
+    if last_key is not None:
+        execute(conn, 'insert into sys."{}" values (%s, %s, %s, %s)'.format(table),
+            (rev.id, last_key, chunks, datetime.now()))
+
+def backfill(conn, rev: Revision, tbl_name: str, finish: Callable, throttle: Tuple[int, float]=None,
+    on_chunk: Callable=None) -> RevisionTiming:
+    """
+    Applies a backfill revision. finish(timing) runs in the transaction of the
+    last range, e.g. to record the revision as applied. throttle is
+    (throttle_queries, throttle_pause), on_chunk(count) is called with the
+    number of ranges done. Returns timing with one duration per committed range.
+    """
+    directives = rev.directives
+    schema = current_schema(conn)
+    names = OnlineTable.from_directive(directives['backfill'], schema)
+    if not directives.get('batch_key'):
+        raise RevisionOperationError(rev, '', 'backfill needs a batch_key header')
+    key = quote(directives['batch_key'])
+    batch_rows = int(directives.get('batch_rows') or DEFAULT_BATCH_ROWS)
+    max_running, pause = throttle or (0, DEFAULT_THROTTLE_PAUSE)
+    stmts = []
+    for stmt in rev.iter_stmts(True):
+        body = statement_body(stmt)
+        m = _BACKFILL.match(body)
+        if m is None or table_of(m, schema) != (names.schema, names.table):
+            raise RevisionOperationError(rev, stmt, 'backfill revisions only update or delete from {}'.format(names.name))
+        stmts.append(body)
+
+    def prepare():
+        # a single range is not restricted, more would skip NULL keys
+        key_type = batch_key_type(conn, rev, names.schema, names.table, directives['batch_key'])
+        create_progress_table(conn, tbl_name)
+        return get_progress(conn, rev, tbl_name) + (key_type in INTEGER_TYPES,)
+
+    lower, chunks, integer = in_transaction(conn, prepare)
+    applied_at = datetime.now()
+    start = time.perf_counter()
+    durations = []
+    timing = None
+    while True:
+        wait_while_busy(conn, max_running, pause)
+        chunk_start = time.perf_counter()
+
+        def chunk(lower=lower):
+            nonlocal timing
+            upper = next_bound(conn, names.name, key, lower, batch_rows, integer)
+            cond = range_condition(key, lower, upper)
+            for stmt in stmts:
+                sql = restrict(stmt, cond) if cond else stmt
+                try:
+                    execute(conn, sql)
+                except Exception as e:
+                    raise RevisionOperationError(rev, sql, repr(e))
+            set_progress(conn, rev, tbl_name, upper, chunks + 1)
+            if upper is None:
+                timing = RevisionTiming(rev, applied_at, time.perf_counter() - start,
+                    durations + [time.perf_counter() - chunk_start])
+                finish(timing)
+            return upper
+
+        upper = in_transaction(conn, chunk)
+        durations.append(time.perf_counter() - chunk_start)
+        chunks += 1
+        if on_chunk is not None:
+            on_chunk(len(durations))
+        if upper is None:
+            return timing
+        lower = upper
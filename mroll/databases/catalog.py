@@ -0,0 +1,453 @@
+"""
+MonetDB catalog snapshot
+
+Reads user schemas, sequences, tables, keys, indexes, views, functions,
+triggers, comments and grants from the sys catalog, one bulk query per object
+kind, and renders DDL recreating them. The definition of a single table is
+read by read_table, tables of a catalog are rendered from the same per table
+definitions.
+"""
+from typing import Dict, List, Tuple
+
+CATALOG_QUERIES = dict(
+    schemas="""
+    select id, name from sys.schemas where not system order by id
+    """,
+    sequences="""
+    select s.id, sc.name, s.name, s."start", s.minvalue, s.maxvalue, s.increment, s.cycle
+    from sys.sequences s join sys.schemas sc on s.schema_id = sc.id order by s.id
+    """,
+    tables="""
+    select t.id, s.name, t.name, t.type, t.query
+    from sys._tables t join sys.schemas s on t.schema_id = s.id
+    where not t.system and t.type in (0, 1, 3, 4, 5, 6) order by t.id
+    """,
+    columns="""
+    select c.table_id, c.id, c.name, c.type, c.type_digits, c.type_scale, c."null", c."default"
+    from sys._columns c join sys._tables t on c.table_id = t.id
+    where not t.system order by c.table_id, c.number
+    """,
+    keys="""
+    select k.id, k.table_id, k.type, k.name, k.rkey, k.action
+    from sys.keys k join sys._tables t on k.table_id = t.id
+    where not t.system order by k.id
+    """,
+    indexes="""
+    select i.id, i.table_id, i.type, i.name
+    from sys.idxs i join sys._tables t on i.table_id = t.id
+    where not t.system and i.name not in (select name from sys.keys) order by i.id
+    """,
+    objects="""
+    select id, name from sys.objects order by id, nr
+    """,
+    functions="""
+    select f.id, s.name, f.name, f.type, f.func from sys.functions f join sys.schemas s on f.schema_id = s.id
+    where not f.system and f.language <> 0 order by f.id
+    """,
+    triggers="""
+    select tr.id, tr.statement from sys.triggers tr join sys._tables t on tr.table_id = t.id
+    where not t.system order by tr.id
+    """,
+    comments="""
+    select id, remark from sys.comments
+    """,
+    grants="""
+    select p.obj_id, a.name, p.privileges, p.grantable from sys.privileges p join sys.auths a on p.auth_id = a.id
+    where p.obj_id in (select id from sys._tables where not system)
+    or p.obj_id in (select c.id from sys._columns c join sys._tables t on c.table_id = t.id where not t.system)
+    or p.obj_id in (select id from sys.functions where not system) order by p.obj_id, a.name
+    """,
+)
+
+TABLE_QUERIES = dict(
+    columns="""
+    select c.id, c.name, c.type, c.type_digits, c.type_scale, c."null", c."default"
+    from sys._columns c where c.table_id = %(id)s order by c.number
+    """,
+    keys="""
+    select k.id, k.type, k.name, k.rkey, k.action from sys.keys k where k.table_id = %(id)s order by k.id
+    """,
+    references="""
+    select k.id, s.name, t.name from sys.keys k join sys._tables t on k.table_id = t.id
+    join sys.schemas s on t.schema_id = s.id
+    where k.id in (select rkey from sys.keys where table_id = %(id)s)
+    """,
+    indexes="""
+    select i.id, i.type, i.name from sys.idxs i
+    where i.table_id = %(id)s and i.name not in (select name from sys.keys where table_id = %(id)s) order by i.id
+    """,
+    objects="""
+    select o.id, o.name from sys.objects o
+    where o.id in (select id from sys.keys where table_id = %(id)s)
+    or o.id in (select rkey from sys.keys where table_id = %(id)s)
+    or o.id in (select id from sys.idxs where table_id = %(id)s) order by o.id, o.nr
+    """,
+    triggers="""
+    select name, statement from sys.triggers where table_id = %(id)s order by id
+    """,
+    comments="""
+    select id, remark from sys.comments
+    where id = %(id)s or id in (select id from sys._columns where table_id = %(id)s)
+    """,
+    grants="""
+    select a.name, p.privileges, p.grantable from sys.privileges p join sys.auths a on p.auth_id = a.id
+    where p.obj_id = %(id)s order by a.name
+    """,
+)
+# check constraints, sys.keys.check exists since MonetDB 11.45
+CHECKS_QUERY = """
+select id, "check" from sys.keys where table_id = %(id)s and type = 4
+"""
+CATALOG_CHECKS_QUERY = """
+select k.id, k."check" from sys.keys k join sys._tables t on k.table_id = t.id where not t.system and k.type = 4
+"""
+
+# sys.tables.type to create statement
+TABLE_KINDS = {0: 'table', 3: 'merge table', 4: 'remote table', 5: 'replica table', 6: 'unlogged table'}
+VIEW = 1
+# members and partitions of these are not read, see generate_ddl
+MERGE_TABLE, REPLICA_TABLE = 3, 5
+PRIMARY_KEY, UNIQUE_KEY, FOREIGN_KEY, UNIQUE_NULLS_KEY, CHECK_KEY = 0, 1, 2, 3, 4
+# sys.idxs.type to create statement, other types back keys and are not created explicitly
+INDEX_KINDS = {0: 'index', 4: 'ordered index', 5: 'imprints index'}
+# foreign key actions, sys.keys.action holds on_update << 8 | on_delete
+FK_ACTIONS = {0: 'no action', 1: 'cascade', 2: 'restrict', 3: 'set null', 4: 'set default'}
+FK_DEFAULT_ACTION = 2
+# sys.functions.type to drop statement
+FUNCTION_KINDS = {1: 'function', 2: 'procedure', 3: 'aggregate', 4: 'filter function', 5: 'function',
+    6: 'window', 7: 'loader'}
+# sys.privileges.privileges bits on tables
+PRIVILEGES = ((1, 'select'), (2, 'update'), (4, 'insert'), (8, 'delete'), (64, 'truncate'))
+
+def read_catalog(conn) -> Dict[str, List[Tuple]]:
+    """
+    Runs the catalog queries in one read transaction, returns rows per object kind.
+    """
+    res = {}
+    cur = conn.cursor()
+    try:
+        for kind, sql in CATALOG_QUERIES.items():
+            cur.execute(sql)
+            res[kind] = cur.fetchall()
+        res['checks'] = []
+        if has_checks(cur):
+            cur.execute(CATALOG_CHECKS_QUERY)
+            res['checks'] = cur.fetchall()
+    finally:
+        conn.rollback()
+    return res
+
+def has_checks(cur) -> bool:
+    """
+    Tells whether sys.keys has the check column of check constraints.
+    """
+    cur.execute("""select c.name from sys._columns c join sys._tables t on c.table_id = t.id
+        join sys.schemas s on t.schema_id = s.id where s.name = 'sys' and t.name = 'keys' and c.name = 'check'""")
+    return cur.fetchone() is not None
+
+def read_table(conn, schema: str, table: str) -> Dict[str, List[Tuple]]:
+    """
+    Reads the definition of one table in the current transaction, returns rows
+    per object kind as read_catalog does, None when there is no such table.
+    """
+    cur = conn.cursor()
+    cur.execute("""select t.id from sys._tables t join sys.schemas s on t.schema_id = s.id
+        where s.name = %(schema)s and t.name = %(table)s""", dict(schema=schema, table=table))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    params = dict(id=row[0])
+    res = dict(schema=[(schema, table)])
+    for kind, sql in TABLE_QUERIES.items():
+        cur.execute(sql, params)
+        res[kind] = cur.fetchall()
+    res['checks'] = []
+    if has_checks(cur):
+        cur.execute(CHECKS_QUERY, params)
+        res['checks'] = cur.fetchall()
+    return res
+
+def quote(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+def column_type(type_: str, digits: int, scale: int) -> str:
+    """
+    Renders column type from sys.columns type, type_digits and type_scale.
+    """
+    if type_ in ('decimal', 'numeric'):
+        return '{}({},{})'.format(type_, digits, scale)
+    if type_ in ('varchar', 'char', 'clob', 'blob') and digits:
+        return '{}({})'.format(type_, digits)
+    if type_ in ('time', 'timestamp', 'timetz', 'timestamptz'):
+        # fractional second precision is stored plus one
+        name = {'timetz': 'time', 'timestamptz': 'timestamp'}.get(type_, type_)
+        precision = '({})'.format(digits - 1) if digits and digits - 1 != (0 if name == 'time' else 6) else ''
+        zone = ' with time zone' if type_.endswith('tz') else ''
+        return '{}{}{}'.format(name, precision, zone)
+    if type_ == 'sec_interval':
+        return 'interval second'
+    if type_ == 'month_interval':
+        return 'interval month'
+    if type_ == 'day_interval':
+        return 'interval day'
+    return type_
+
+def column_definition(name: str, type_: str, digits: int, scale: int, nullable: bool, default: str) -> str:
+    col = '{} {}'.format(quote(name), column_type(type_, digits, scale))
+    if default is not None:
+        col += ' default {}'.format(default)
+    if not nullable:
+        col += ' not null'
+    return col
+
+def string_literal(value: str) -> str:
+    return "'{}'".format(value.replace("'", "''"))
+
+def create_table_sql(definition: Dict[str, List[Tuple]], name: str) -> List[str]:
+    """
+    Renders statements creating a table as read by read_table under the
+    qualified name, with column defaults, not null constraints, comments and
+    grants. Keys, indexes and triggers are named uniquely per schema, see
+    attach_sql.
+    """
+    sql = ['create table {} ({})'.format(name, ', '.join(column_definition(*row[1:])
+        for row in definition['columns']))]
+    return sql + comment_grant_sql(definition, name)
+
+def comment_grant_sql(definition: Dict[str, List[Tuple]], name: str, kind: str='table') -> List[str]:
+    """
+    Renders the comments and grants of a table as read by read_table for the
+    table, or view by kind, of qualified name.
+    """
+    columns = dict((row[0], row[1]) for row in definition['columns'])
+    sql = []
+    for id_, remark in definition['comments']:
+        if id_ in columns:
+            sql.append('comment on column {}.{} is {}'.format(name, quote(columns[id_]), string_literal(remark)))
+        else:
+            sql.append('comment on {} {} is {}'.format(kind, name, string_literal(remark)))
+    for grantee, privileges, grantable in definition['grants']:
+        granted = [priv for bit, priv in PRIVILEGES if privileges & bit]
+        if granted:
+            sql.append('grant {} on table {} to {}{}'.format(', '.join(granted), name, quote(grantee),
+                ' with grant option' if grantable else ''))
+    return sql
+
+def table_constraints(definition: Dict[str, List[Tuple]]) -> List[Tuple[str, str]]:
+    """
+    Returns (name, constraint) of the keys and check constraints of a table
+    as read by read_table.
+    """
+    objects = {}
+    for id_, column in definition['objects']:
+        objects.setdefault(id_, []).append(column)
+    references = dict((id_, '{}.{}'.format(quote(schema), quote(table)))
+        for id_, schema, table in definition['references'])
+    checks = dict(definition['checks'])
+
+    def column_list(id_):
+        return ', '.join(quote(c) for c in objects.get(id_, []))
+
+    res = []
+    for id_, type_, name, rkey, action in definition['keys']:
+        if type_ == PRIMARY_KEY:
+            res.append((name, 'primary key ({})'.format(column_list(id_))))
+        elif type_ == UNIQUE_KEY:
+            res.append((name, 'unique ({})'.format(column_list(id_))))
+        elif type_ == UNIQUE_NULLS_KEY:
+            res.append((name, 'unique nulls not distinct ({})'.format(column_list(id_))))
+        elif type_ == CHECK_KEY and id_ in checks:
+            res.append((name, 'check ({})'.format(checks[id_])))
+        elif type_ == FOREIGN_KEY and rkey in references:
+            constraint = 'foreign key ({}) references {} ({})'.format(column_list(id_), references[rkey],
+                column_list(rkey))
+            on_delete, on_update = action & 255, (action >> 8) & 255
+            if on_delete != FK_DEFAULT_ACTION:
+                constraint += ' on delete {}'.format(FK_ACTIONS.get(on_delete, 'restrict'))
+            if on_update != FK_DEFAULT_ACTION:
+                constraint += ' on update {}'.format(FK_ACTIONS.get(on_update, 'restrict'))
+            res.append((name, constraint))
+    return res
+
+def attach_sql(definition: Dict[str, List[Tuple]], name: str, exclude: Tuple[str]=()) -> List[str]:
+    """
+    Renders statements adding the keys, check constraints, indexes and
+    triggers of a table as read by read_table to the table of qualified name,
+    leaving out those named in exclude.
+    """
+    objects = {}
+    for id_, column in definition['objects']:
+        objects.setdefault(id_, []).append(column)
+    sql = []
+    for key, constraint in table_constraints(definition):
+        if key not in exclude:
+            sql.append('alter table {} add constraint {} {}'.format(name, quote(key), constraint))
+    for id_, type_, index in definition['indexes']:
+        if type_ in INDEX_KINDS and index not in exclude:
+            sql.append('create {} {} on {} ({})'.format(INDEX_KINDS[type_], quote(index), name,
+                ', '.join(quote(c) for c in objects.get(id_, []))))
+    for trigger, statement in definition['triggers']:
+        if trigger not in exclude:
+            sql.append(statement.strip().rstrip(';'))
+    return sql
+
+def detach_sql(definition: Dict[str, List[Tuple]], name: str, exclude: Tuple[str]=()) -> List[str]:
+    """
+    Renders statements dropping what attach_sql adds from the table of
+    qualified name, in reverse order, so their names can be used again.
+    """
+    schema = quote(definition['schema'][0][0])
+    sql = []
+    for trigger, _ in reversed(definition['triggers']):
+        if trigger not in exclude:
+            sql.append('drop trigger {}.{}'.format(schema, quote(trigger)))
+    for _, type_, index in reversed(definition['indexes']):
+        if type_ in INDEX_KINDS and index not in exclude:
+            sql.append('drop index {}.{}'.format(schema, quote(index)))
+    for key, _ in reversed(table_constraints(definition)):
+        if key not in exclude:
+            sql.append('alter table {} drop constraint {}'.format(name, quote(key)))
+    return sql
+
+def table_definitions(catalog: Dict[str, List[Tuple]], tables: Dict[int, Tuple]) -> Dict[int, Dict[str, List[Tuple]]]:
+    """
+    Splits a catalog as returned by read_catalog into definitions as read by
+    read_table of the tables given as {id: (schema, name, ...)}. Foreign keys
+    only reference tables among them.
+    """
+    definitions = {}
+    for id_, table in tables.items():
+        definitions[id_] = dict(schema=[table[:2]], columns=[], keys=[], references=[], indexes=[],
+            objects=[], triggers=[], comments=[], grants=[], checks=[])
+    owner = {}
+    for row in catalog['columns']:
+        if row[0] in definitions:
+            definitions[row[0]]['columns'].append(row[1:])
+            owner[row[1]] = row[0]
+    objects = {}
+    for id_, column in catalog['objects']:
+        objects.setdefault(id_, []).append(column)
+    key_tables = dict((row[0], row[1]) for row in catalog['keys'])
+    for id_, table_id, type_, name, rkey, action in catalog['keys']:
+        definition = definitions.get(table_id)
+        if definition is None:
+            continue
+        definition['keys'].append((id_, type_, name, rkey, action))
+        definition['objects'].extend((id_, column) for column in objects.get(id_, []))
+        if type_ == FOREIGN_KEY and key_tables.get(rkey) in definitions:
+            schema, table = definitions[key_tables[rkey]]['schema'][0]
+            definition['references'].append((rkey, schema, table))
+            definition['objects'].extend((rkey, column) for column in objects.get(rkey, []))
+    for id_, table_id, type_, name in catalog['indexes']:
+        if table_id in definitions:
+            definitions[table_id]['indexes'].append((id_, type_, name))
+            definitions[table_id]['objects'].extend((id_, column) for column in objects.get(id_, []))
+    for id_, remark in catalog['comments']:
+        table_id = id_ if id_ in definitions else owner.get(id_)
+        if table_id is not None:
+            definitions[table_id]['comments'].append((id_, remark))
+    for obj_id, grantee, privileges, grantable in catalog['grants']:
+        if obj_id in definitions:
+            definitions[obj_id]['grants'].append((grantee, privileges, grantable))
+    for id_, check in catalog['checks']:
+        if key_tables.get(id_) in definitions:
+            definitions[key_tables[id_]]['checks'].append((id_, check))
+    return definitions
+
+def generate_ddl(catalog: Dict[str, List[Tuple]], exclude: Tuple[Tuple[str, str]]=()) -> Tuple[str, str]:
+    """
+    Renders (upgrade_sql, downgrade_sql) recreating, respectively dropping, the
+    objects of a catalog as returned by read_catalog. Tables listed in exclude
+    as (schema, table) are left out, e.g. the mroll revisions table. Merge and
+    replica tables, comments on functions and grants on columns or functions
+    are not rendered, a catalog holding them is refused with ValueError.
+    """
+    tables = {}
+    for id_, schema, name, type_, query in catalog['tables']:
+        if (schema, name) not in exclude:
+            tables[id_] = (schema, name, type_, query)
+
+    def qualified(table_id):
+        schema, name = tables[table_id][:2]
+        return '{}.{}'.format(quote(schema), quote(name))
+
+    unsupported = ['merge or replica table {}'.format(qualified(id_))
+        for id_, table in tables.items() if table[2] in (MERGE_TABLE, REPLICA_TABLE)]
+    functions = dict((row[0], 'function {}.{}'.format(quote(row[1]), quote(row[2]))) for row in catalog['functions'])
+    unsupported += ['comment on {}'.format(functions[id_]) for id_, _ in catalog['comments'] if id_ in functions]
+    columns = dict((row[1], 'column {}.{}'.format(qualified(row[0]), quote(row[2])))
+        for row in catalog['columns'] if row[0] in tables)
+    unsupported += ['grant on {}'.format(functions.get(obj_id) or columns[obj_id])
+        for obj_id, _, _, _ in catalog['grants'] if obj_id in functions or obj_id in columns]
+    if unsupported:
+        raise ValueError("Error: can not snapshot {}".format(', '.join(unsupported)))
+    definitions = table_definitions(catalog, tables)
+    comments = dict(catalog['comments'])
+    objects = {}
+    for id_, column in catalog['objects']:
+        objects.setdefault(id_, []).append(column)
+
+    up = []
+    down = []
+    for id_, name in catalog['schemas']:
+        if name in ('sys', 'tmp', 'json', 'profiler', 'logging', 'information_schema'):
+            continue
+        up.append('create schema if not exists {};'.format(quote(name)))
+        if id_ in comments:
+            up.append('comment on schema {} is {};'.format(quote(name), string_literal(comments[id_])))
+        down.append('drop schema if exists {};'.format(quote(name)))
+    for id_, schema, name, start, minvalue, maxvalue, increment, cycle in catalog['sequences']:
+        seq = '{}.{}'.format(quote(schema), quote(name))
+        up.append('create sequence {} start with {} increment by {} minvalue {} maxvalue {}{};'.format(
+            seq, start, increment, minvalue, maxvalue, ' cycle' if cycle else ''))
+        if id_ in comments:
+            up.append('comment on sequence {} is {};'.format(seq, string_literal(comments[id_])))
+        down.append('drop sequence {};'.format(seq))
+    # views and functions in creation order, later ones may refer to earlier ones
+    deferred = []
+    foreign = []
+    for id_, (schema, name, type_, query) in tables.items():
+        definition = definitions[id_]
+        if type_ == VIEW:
+            sql = [query.strip().rstrip(';')] + comment_grant_sql(definition, qualified(id_), 'view')
+            deferred.append((id_, ';\n'.join(sql) + ';', 'drop view if exists {};'.format(qualified(id_))))
+            continue
+        defs = [column_definition(*column[1:]) for column in definition['columns']]
+        remote = " on '{}'".format(query.replace("'", "''")) if type_ == 4 and query else ''
+        up.append('create {} {} ({}){};'.format(TABLE_KINDS[type_], qualified(id_), ', '.join(defs), remote))
+        up.extend(sql + ';' for sql in comment_grant_sql(definition, qualified(id_)))
+        down.append('drop table if exists {} cascade;'.format(qualified(id_)))
+    for id_ in tables:
+        # referenced keys first
+        for key, constraint in table_constraints(definitions[id_]):
+            sql = 'alter table {} add constraint {} {};'.format(qualified(id_), quote(key), constraint)
+            if constraint.startswith('foreign key'):
+                foreign.append(sql)
+            else:
+                up.append(sql)
+    up.extend(foreign)
+    for id_, table_id, type_, name in catalog['indexes']:
+        if table_id in tables and type_ in INDEX_KINDS:
+            up.append('create {} {} on {} ({});'.format(INDEX_KINDS[type_], quote(name), qualified(table_id),
+                ', '.join(quote(column) for column in objects.get(id_, []))))
+            if id_ in comments:
+                up.append('comment on index {}.{} is {};'.format(quote(tables[table_id][0]), quote(name),
+                    string_literal(comments[id_])))
+    dropped = set()
+    for id_, schema, name, type_, func in catalog['functions']:
+        # overloads are dropped together
+        drop = None
+        if (schema, name) not in dropped:
+            dropped.add((schema, name))
+            drop = 'drop all {} {}.{} cascade;'.format(FUNCTION_KINDS.get(type_, 'function'), quote(schema), quote(name))
+        deferred.append((id_, func.strip().rstrip(';') + ';', drop))
+    deferred.sort(key=lambda item: item[0])
+    for _, sql, drop in deferred:
+        up.append(sql)
+        if drop:
+            down.append(drop)
+    for _, statement in catalog['triggers']:
+        up.append(statement.strip().rstrip(';') + ';')
+    # drop in reverse creation order, triggers go with their tables
+    down.reverse()
+    return '\n'.join(up), '\n'.join(down)
@@ -0,0 +1,101 @@
+"""
+Helpers shared by database engine contexts, working on any DB-API
+connection that provides execute(), commit() and rollback().
+"""
+import time
+from datetime import datetime
+from typing import Iterable, List
+from mroll.migration import Revision, RevisionTiming
+from mroll.exceptions import RevisionOperationError
+
+def execute_stmts(conn, rev: Revision, stmts: Iterable[str], batch_size: int=1, on_stmt=None) -> List[float]:
+    """
+    Executes revision statements, sending up to batch_size statements per request.
+    Statements not terminated by ';' are always sent on their own. Returns
+    wall-clock duration of every statement, a batch's duration is spread evenly
+    over its statements. on_stmt(count) is called with the number of statements done.
+    """
+    durations = []
+
+    def send(sql, count=1):
+        start = time.perf_counter()
+        try:
+            conn.execute(sql)
+        except Exception as e:
+            raise RevisionOperationError(rev, sql, repr(e))
+        durations.extend([(time.perf_counter() - start) / count] * count)
+        if on_stmt is not None:
+            on_stmt(len(durations))
+
+    if batch_size <= 1:
+        for stmt in stmts:
+            send(stmt)
+        return durations
+    batch = []
+    for stmt in stmts:
+        if not stmt.rstrip().endswith(';'):
+            if batch:
+                send('\n'.join(batch), len(batch))
+                batch = []
+            send(stmt)
+            continue
+        batch.append(stmt)
+        if len(batch) == batch_size:
+            send('\n'.join(batch), len(batch))
+            batch = []
+    if batch:
+        send('\n'.join(batch), len(batch))
+    return durations
+
+def execute_revision(conn, rev: Revision, stmts: Iterable[str], batch_size: int=1, progress=None) -> RevisionTiming:
+    """
+    Executes statements of a revision and returns its timings, reporting
+    to progress, a mroll.progress.Progress, when given.
+    """
+    applied_at = datetime.now()
+    start = time.perf_counter()
+    if progress is not None:
+        progress.start_revision(rev)
+    stmt_durations = execute_stmts(conn, rev, stmts, batch_size,
+        on_stmt=progress.statements_done if progress is not None else None)
+    timing = RevisionTiming(rev, applied_at, time.perf_counter() - start, stmt_durations)
+    if progress is not None:
+        progress.finish_revision(timing)
+    return timing
+
+def state_table(tbl_name: str) -> str:
+    """
+    Name of the single row state table kept next to a revisions table.
+    """
+    return '{}_state'.format(tbl_name)
+
+def head_candidate(revisions: List[Revision]) -> Revision:
+    """
+    Returns revision with the latest ts, the last one on ties.
+    """
+    def key(item):
+        i, rev = item
+        ts = rev.ts if isinstance(rev.ts, datetime) else datetime.fromisoformat(str(rev.ts))
+        return ts, i
+    return max(enumerate(revisions), key=key)[1]
+
+def run_in_transaction(conn, fn, batch_size: int=1) -> None:
+    """
+    Runs fn(batch_size) in one transaction. When batched execution fails the
+    transaction is rolled back and replayed one statement at a time, so that the
+    raised RevisionOperationError names the failing statement.
+    """
+    try:
+        fn(batch_size)
+        conn.commit()
+        return
+    except Exception:
+        conn.rollback()
+        if batch_size <= 1:
+            raise
+    try:
+        fn(1)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
@@ -0,0 +1,187 @@
+"""
+MonetDB cost estimation of pending revisions
+
+Statements are not executed. Queries and DML are run through EXPLAIN and the
+columns their MAL plan binds are weighed by table sizes from sys.storage. DDL
+can not be explained, its cost follows from the statement kind and the size of
+the table it rewrites. Costs are estimated numbers of column values touched.
+"""
+import re
+from typing import Dict, List, Tuple
+
+STORAGE_QUERY = """
+select "schema", "table", max("count") from sys.storage group by "schema", "table"
+"""
+
+# tables with at least this many rows get expensive operations flagged
+LARGE_TABLE_ROWS = 10000000
+
+TABLE_NAME = r'("(?:[^"]|"")+"|[\w$]+)(?:\s*\.\s*("(?:[^"]|"")+"|[\w$]+))?'
+_UPDATE = re.compile(r'^\s*update\s+' + TABLE_NAME, re.I)
+_DELETE = re.compile(r'^\s*delete\s+from\s+' + TABLE_NAME, re.I)
+_TRUNCATE = re.compile(r'^\s*truncate\s+(?:table\s+)?' + TABLE_NAME, re.I)
+_ALTER = re.compile(r'^\s*alter\s+table\s+(?:if\s+exists\s+)?' + TABLE_NAME, re.I)
+_INDEX = re.compile(r'^\s*create\s+(?:unique\s+|ordered\s+|imprints\s+)?index\s+\S+\s+on\s+' + TABLE_NAME, re.I)
+_WHERE = re.compile(r'\bwhere\b', re.I)
+_TYPE_CHANGE = re.compile(r'\balter\s+(?:column\s+)?\S+\s+(?:set\s+data\s+)?type\b', re.I)
+_ADD_COLUMN = re.compile(r'\badd\s+(?!constraint\b|primary\b|unique\b|foreign\b)', re.I)
+_ADD_KEY = re.compile(r'\badd\s+(?:constraint\s+\S+\s+)?(?:primary\s+key|unique|foreign\s+key)\b', re.I)
+_EXPLAINABLE = re.compile(r'^\s*(?:select|with|insert|update|delete|merge)\b', re.I)
+_LEADING_COMMENTS = re.compile(r'(?:\s*(?:--[^\n]*(?:\n|$)|/\*.*?\*/))*\s*', re.S)
+_BIND = re.compile(r'sql\.bind\([^,]+,\s*"([^"]*)"(?::str)?,\s*"([^"]*)"(?::str)?,\s*"([^"]*)"')
+
+class StatementCost:
+    __slots__ = ('stmt', 'cost', 'flags', 'explained')
+
+    def __init__(self, stmt, cost=None, flags=None, explained=False):
+        self.stmt = stmt
+        # None when the cost is unknown, e.g. the statement refers to objects created by earlier ones
+        self.cost = cost
+        self.flags = flags or []
+        self.explained = explained
+
+class RevisionCost:
+    __slots__ = ('revision', 'statements')
+
+    def __init__(self, revision, statements):
+        self.revision = revision
+        self.statements = statements
+
+    @property
+    def cost(self) -> int:
+        return sum(s.cost for s in self.statements if s.cost is not None)
+
+    @property
+    def unknown(self) -> int:
+        return sum(1 for s in self.statements if s.cost is None)
+
+    @property
+    def flags(self) -> List[str]:
+        return [flag for s in self.statements for flag in s.flags]
+
+def read_table_sizes(conn) -> Dict[Tuple[str, str], int]:
+    """
+    Returns row counts of all tables keyed by (schema, table).
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(STORAGE_QUERY)
+        return {(schema, table): count or 0 for schema, table, count in cur.fetchall()}
+    finally:
+        conn.rollback()
+
+def current_schema(conn) -> str:
+    cur = conn.cursor()
+    try:
+        cur.execute('select current_schema')
+        return cur.fetchone()[0]
+    finally:
+        conn.rollback()
+
+def explain(conn, stmt: str) -> List[str]:
+    """
+    Returns MAL plan lines of a statement without executing it, or None when
+    MonetDB can not explain it.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute('explain ' + stmt.strip().rstrip(';'))
+        return [row[0] for row in cur.fetchall()]
+    except Exception:
+        return None
+    finally:
+        conn.rollback()
+
+def unquote(name: str) -> str:
+    if name.startswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name.lower()
+
+def table_of(m, schema: str) -> Tuple[str, str]:
+    """
+    (schema, table) of a name matched by one of the statement patterns.
+    """
+    if m.group(2) is None:
+        return schema, unquote(m.group(1))
+    return unquote(m.group(1)), unquote(m.group(2))
+
+def statement_body(stmt: str) -> str:
+    """
+    Statement without the comments the splitter keeps in front of it.
+    """
+    return stmt[_LEADING_COMMENTS.match(stmt).end():]
+
+def bound_columns(mal: List[str]) -> set:
+    """
+    Returns (schema, table, column) of all columns a MAL plan binds.
+    """
+    res = set()
+    for line in mal:
+        for m in _BIND.finditer(line):
+            res.add(m.groups())
+    return res
+
+def estimate_statement(stmt: str, sizes: Dict[Tuple[str, str], int], mal: List[str]=None,
+    schema: str='sys', large_rows: int=LARGE_TABLE_ROWS) -> StatementCost:
+    """
+    Estimates cost of one statement from its MAL plan, when explained, or its
+    kind, and flags expensive operations on tables of at least large_rows rows.
+    """
+    res = StatementCost(stmt, explained=mal is not None)
+    stmt = statement_body(stmt)
+    if mal is not None:
+        res.cost = sum(sizes.get((s, t), 0) for s, t, _ in bound_columns(mal))
+    for pattern, what in ((_UPDATE, 'update'), (_DELETE, 'delete')):
+        m = pattern.match(stmt)
+        if m and not _WHERE.search(stmt):
+            table = table_of(m, schema)
+            rows = sizes.get(table, 0)
+            if rows >= large_rows:
+                res.flags.append('full table {} of {}.{} ({} rows)'.format(what, table[0], table[1], rows))
+    if mal is not None:
+        return res
+    m = _ALTER.match(stmt)
+    if m:
+        table = table_of(m, schema)
+        rows = sizes.get(table)
+        if rows is None:
+            # table created by an earlier statement of the working set
+            return res
+        res.cost = 0
+        for pattern, what in ((_TYPE_CHANGE, 'column type change'), (_ADD_KEY, 'key build'),
+                (_ADD_COLUMN, 'column added')):
+            if pattern.search(stmt):
+                res.cost = rows
+                if rows >= large_rows:
+                    res.flags.append('{} on {}.{} ({} rows)'.format(what, table[0], table[1], rows))
+                break
+        return res
+    m = _INDEX.match(stmt)
+    if m:
+        table = table_of(m, schema)
+        rows = sizes.get(table)
+        if rows is not None:
+            res.cost = rows
+            if rows >= large_rows:
+                res.flags.append('index build on {}.{} ({} rows)'.format(table[0], table[1], rows))
+        return res
+    m = _TRUNCATE.match(stmt)
+    if m or not _EXPLAINABLE.match(stmt):
+        # other DDL only touches the catalog
+        res.cost = 0
+    return res
+
+def estimate_revisions(conn, revisions, large_rows: int=LARGE_TABLE_ROWS) -> List[RevisionCost]:
+    """
+    Explains upgrade statements of revisions, in one pass over sys.storage.
+    """
+    sizes = read_table_sizes(conn)
+    schema = current_schema(conn)
+    res = []
+    for rev in revisions:
+        stmts = []
+        for stmt in rev.iter_stmts(True):
+            mal = explain(conn, stmt) if _EXPLAINABLE.match(statement_body(stmt)) else None
+            stmts.append(estimate_statement(stmt, sizes, mal, schema, large_rows))
+        res.append(RevisionCost(rev, stmts))
+    return res
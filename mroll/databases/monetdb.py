@@ -2,83 +2,157 @@
 MonetDB
 """
 import pymonetdb
+from pymonetdb.filetransfer import SafeDirectoryHandler
 import configparser
 import os, sys
-from typing import Tuple, List
-from mroll.migration import Revision, MigrationContext, MigrationCtxConfig
+from datetime import datetime
+from typing import Tuple, List, Iterator
+from mroll.migration import (Revision, RevisionTiming, MigrationContext, MigrationCtxConfig,
+    MigrationState, parse_commit_every, commit_units, CHUNKED_DIRECTIVES)
 from mroll.exceptions import RevisionOperationError
+from mroll.databases.common import (execute_revision, run_in_transaction,
+    state_table, head_candidate)
 
 class MonetMigrCtx(MigrationContext):
     """
-    Monetdb specific implementation of Migration Context
+    Monetdb specific implementation of Migration Context. Holds a single lazily
+    opened connection shared by all operations, use as a context manager or
+    call close() when done.
     """
     def __init__(self, config: MigrationCtxConfig):
         assert config.db_name
         assert config.username
         assert config.password
         assert config.tbl_name
-        assert config.hostname
-        assert config.port
+        if not getattr(config, 'unix_socket', None):
+            assert config.hostname
+            assert config.port
         self.config = config
+        self.batch_size = int(getattr(config, 'batch_size', None) or 1)
+        self.commit_every = parse_commit_every(getattr(config, 'commit_every', None))
+        # (max running queries, seconds to pause) of backfill revisions
+        self.throttle = (int(getattr(config, 'throttle_queries', None) or 0),
+            float(getattr(config, 'throttle_pause', None) or 5))
+        # timings of last add_revisions/remove_revisions call
+        self.last_timings = []
+        # mroll.progress.Progress reported to by add_revisions/remove_revisions
+        self.progress = None
+        # work dir fingerprint recorded in the state table by changes
+        self.fingerprint = None
+        # changes leave the state table alone, see rebuild_state
+        self.defer_state = False
+        self._conn = None
+        self._schema_checked = False
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = connect(self.config)
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            finally:
+                self._conn = None
+                self._schema_checked = False
+
+    def upgrade_revisions_tbl(self) -> List[str]:
+        """
+        Adds columns missing from revisions tables created by older mroll versions.
+        Returns names of added columns.
+        """
+        self._schema_checked = True
+        return upgrade_revisions_table(self.conn, tbl_name=self.config.tbl_name)
+
+    def _ensure_schema(self):
+        if not self._schema_checked:
+            self.upgrade_revisions_tbl()
 
     def create_revisions_tbl(self) -> None:
-        config = self.config
-        return create_revisions_table(
-            config.db_name,
-            tbl_name=config.tbl_name,
-            hostname=config.hostname,
-            port=config.port,
-            username=config.username,
-            password=config.password)
+        return create_revisions_table(self.conn, tbl_name=self.config.tbl_name)
 
     @property
     def head(self) -> Revision:
-        config = self.config
-        head = get_head(
-            config.db_name,
-            tbl_name=config.tbl_name,
-            hostname=config.hostname,
-            port=config.port,
-            username=config.username,
-            password=config.password)
-        if head is not None:
-            id_, description, ts = head
-            return Revision(id_, description, ts)
-        return head
+        return self.state.head
+
+    @property
+    def state(self) -> MigrationState:
+        row = get_state(self.conn, tbl_name=self.config.tbl_name)
+        if row is None:
+            # reads leave a history table of an older mroll version alone
+            raise RuntimeError("Error: revisions table sys.{} is missing or outdated, run mroll init".format(
+                self.config.tbl_name))
+        id_, description, ts, applied_count, fingerprint, updated_at = row
+        head = Revision(id_, description, ts) if id_ is not None else None
+        return MigrationState(head, applied_count, fingerprint, updated_at)
 
     @property
     def revisions(self) -> List[Revision]:
-        config = self.config
-        revisions = get_revisions(
-            config.db_name,
-            tbl_name=config.tbl_name,
-            hostname=config.hostname,
-            port=config.port,
-            username=config.username,
-            password=config.password)
+        revisions = get_revisions(self.conn, tbl_name=self.config.tbl_name)
         return [Revision(id_, description, ts) for id_, description, ts in revisions]
 
-    def add_revisions(self, revisions: List[Revision]) -> None:
-        config = self.config
-        return add_revisions(
-            revisions,
-            config.db_name,
-            tbl_name=config.tbl_name,
-            hostname=config.hostname,
-            port=config.port,
-            username=config.username,
-            password=config.password)
-
-    def remove_revisions(self, revisions: List[Revision]) -> None:
-        config = self.config
-        return remove_revisions(
-            revisions,
-            config.db_name,
-            tbl_name=config.tbl_name,
-            hostname=config.hostname,
-            port=config.port,
-            username=config.username,
-            password=config.password)
+    def applied_ids(self) -> Iterator[str]:
+        return get_applied_ids(self.conn, tbl_name=self.config.tbl_name)
+
+    @property
+    def timings(self) -> dict:
+        return {id_: (applied_at, duration, stmt_count)
+            for id_, applied_at, duration, stmt_count in get_timings(self.conn, tbl_name=self.config.tbl_name)}
+
+    def timing_estimates(self, revision_ids: List[str]) -> Tuple[dict, float]:
+        return get_timing_estimates(self.conn, revision_ids, tbl_name=self.config.tbl_name)
+
+    def checksums(self) -> Iterator[Tuple[str, str]]:
+        return get_checksums(self.conn, tbl_name=self.config.tbl_name)
+
+    def record_checksums(self, checksums: dict) -> None:
+        self._ensure_schema()
+        return set_checksums(self.conn, checksums, tbl_name=self.config.tbl_name)
+
+    def history(self, since=None, limit: int=None, last: int=None) -> Iterator[Tuple]:
+        return get_history(self.conn, tbl_name=self.config.tbl_name, since=since, limit=limit, last=last)
+
+    def add_revisions(self, revisions: List[Revision], batch_size: int=None, commit_every: int=None) -> None:
+        batch_size = batch_size or self.batch_size
+        commit_every = commit_every or self.commit_every
+        self._ensure_schema()
+        self.last_timings = []
+        return add_revisions(self.conn, revisions, tbl_name=self.config.tbl_name,
+            batch_size=batch_size, commit_every=commit_every, timings=self.last_timings,
+            fingerprint=self.fingerprint, throttle=self.throttle, progress=self.progress,
+            update_state=not self.defer_state)
+
+    def remove_revisions(self, revisions: List[Revision], batch_size: int=None, commit_every: int=None) -> None:
+        batch_size = batch_size or self.batch_size
+        commit_every = commit_every or self.commit_every
+        self._ensure_schema()
+        self.last_timings = []
+        return remove_revisions(self.conn, revisions, tbl_name=self.config.tbl_name,
+            batch_size=batch_size, commit_every=commit_every, timings=self.last_timings,
+            fingerprint=self.fingerprint, throttle=self.throttle, progress=self.progress,
+            update_state=not self.defer_state)
+
+    def rebuild_state(self) -> None:
+        self._ensure_schema()
+        return rebuild_state(self.conn, tbl_name=self.config.tbl_name, fingerprint=self.fingerprint)
+
+    def replace_revisions(self, revision_ids: List[str], baseline: Revision) -> None:
+        self._ensure_schema()
+        return replace_revision_records(self.conn, revision_ids, baseline, tbl_name=self.config.tbl_name,
+            fingerprint=self.fingerprint)
+
+    def snapshot_schema(self) -> Tuple[str, str]:
+        from mroll.databases.catalog import read_catalog, generate_ddl
+        from mroll.databases.backfill import progress_table
+        tbl_name = self.config.tbl_name
+        return generate_ddl(read_catalog(self.conn), exclude=(('sys', tbl_name), ('sys', state_table(tbl_name)),
+            ('sys', progress_table(tbl_name))))
+
+    def estimate_costs(self, revisions: List[Revision], large_rows: int=None) -> list:
+        from mroll.databases.cost import estimate_revisions, LARGE_TABLE_ROWS
+        return estimate_revisions(self.conn, revisions, large_rows or LARGE_TABLE_ROWS)
 
     def __repr__(self):
         return "<MonetMigrCtx head={} revisions={}>".format(self.head, self.revisions)
@@ -86,100 +160,473 @@ class MonetMigrCtx(MigrationContext):
 
 REVISION_RECORD = Tuple[str, str, str]
 
-def get_head(
-    db_name, tbl_name:str='mroll_revisions',
-    hostname:str='127.0.0.1', port:int=50000,
-    username:str='monetbd', password:str='monetdb') -> REVISION_RECORD:
+def connect(config: MigrationCtxConfig):
+    """
+    Opens connection described by config, over a unix domain socket when
+    config.unix_socket is set.
+    """
+    unix_socket = getattr(config, 'unix_socket', None)
+    if unix_socket:
+        conn = pymonetdb.connect(config.db_name, unix_socket=unix_socket,
+            username=config.username, password=config.password)
+    else:
+        conn = pymonetdb.connect(config.db_name, hostname=config.hostname, port=int(config.port),
+            username=config.username, password=config.password)
+    path = data_dir(config)
+    if path is not None:
+        # revisions load data files with COPY INTO ... ON CLIENT, streamed by pymonetdb
+        conn.set_uploader(SafeDirectoryHandler(path))
+    return conn
+
+def data_dir(config: MigrationCtxConfig) -> str:
+    """
+    Directory files of COPY INTO ... FROM '<file>' ON CLIENT statements are
+    read from, relative to the work directory. The versions directory unless
+    data_dir is set in mroll.ini. Files outside it are refused.
+    """
+    path = getattr(config, 'data_dir', None) or 'versions'
+    work_dir = getattr(config, 'work_dir', None)
+    if work_dir is None:
+        return path if os.path.isabs(path) else None
+    return os.path.join(work_dir, path)
+
+def get_head(conn, tbl_name:str='mroll_revisions') -> REVISION_RECORD:
     """
-    Returns last revision
+    Returns last revision from the revisions table, on equal ts the last applied
+    one. Scans the history, the state table holds the head for everyday use.
     """
-    conn = pymonetdb.connect(db_name, hostname=hostname, port=port, username=username, password=password)
-    sql = """select id, description, ts from sys."{}" as r where r.ts=(select max(ts) from sys."{}")""".format(tbl_name, tbl_name)
+    sql = """select id, description, ts from sys."{}" order by ts desc, applied_at desc limit 1""".format(tbl_name)
     curr = conn.cursor()
     curr.execute(sql)
-    rev = curr.fetchone()
-    conn.close() 
-    return rev
+    return curr.fetchone()
+
+# single row of the state table
+STATE_COLUMNS = (('head_id', 'string'), ('head_description', 'string'), ('head_ts', 'timestamp'),
+    ('applied_count', 'int'), ('fingerprint', 'string'), ('updated_at', 'timestamp'))
+
+def get_state(conn, tbl_name:str='mroll_revisions') -> Tuple:
+    """
+    Returns (head_id, head_description, head_ts, applied_count, fingerprint,
+    updated_at) or None when there is no state table.
+    """
+    sql = 'select {} from sys."{}"'.format(', '.join(name for name, _ in STATE_COLUMNS), state_table(tbl_name))
+    cur = conn.cursor()
+    try:
+        cur.execute(sql)
+        return cur.fetchone()
+    except pymonetdb.Error:
+        return None
+    finally:
+        # end read transaction so later reads see fresh data
+        conn.rollback()
 
-def create_revisions_table(
-    db_name, tbl_name:str='mroll_revisions', 
-    hostname:str='127.0.0.1', port:int=50000, 
-    username:str='monetbd', password:str='monetdb') -> None:
+def create_state_table(conn, tbl_name:str='mroll_revisions') -> None:
     """
-    Creates revisons table with columns (id string, description string, ts timestamp)
+    Creates the state table with its single row, filled from the revisions
+    table. Runs in the caller's transaction.
     """
-    conn = pymonetdb.connect(db_name, hostname=hostname, port=port, username=username, password=password)
+    state = state_table(tbl_name)
+    columns = ', '.join('{} {}'.format(name, type_) for name, type_ in STATE_COLUMNS)
+    conn.execute("""create table sys."{}" ({})""".format(state, columns))
+    cur = conn.cursor()
+    cur.execute('select count(*) from sys."{}"'.format(tbl_name))
+    count, = cur.fetchone()
+    id_, description, ts = get_head(conn, tbl_name) or (None, None, None)
+    cur.execute("""insert into sys."{}" values (%s, %s, %s, %s, null, %s)""".format(state),
+        (id_, description, ts, count, datetime.now()))
+
+def advance_state(conn, head: Revision, count: int, tbl_name:str='mroll_revisions', fingerprint:str=None) -> None:
+    """
+    Updates state after count revisions were added, head becomes the new head
+    unless the current one is more recent.
+    """
+    newer = "head_ts is null or head_ts <= cast(%s as timestamp)"
+    sql = """update sys."{}" set
+        head_id = case when {newer} then %s else head_id end,
+        head_description = case when {newer} then %s else head_description end,
+        head_ts = case when {newer} then cast(%s as timestamp) else head_ts end,
+        applied_count = applied_count + %s,
+        fingerprint = coalesce(%s, fingerprint),
+        updated_at = %s""".format(state_table(tbl_name), newer=newer)
+    ts = str(head.ts)
+    params = (ts, head.id, ts, head.description, ts, ts, count, fingerprint, datetime.now())
+    try:
+        conn.cursor().execute(sql, params)
+    except Exception as e:
+        raise RevisionOperationError(head, sql, repr(e))
+
+def refresh_state(conn, revision: Revision, count: int, tbl_name:str='mroll_revisions', fingerprint:str=None) -> None:
+    """
+    Updates state after records were removed, looking up the new head.
+    revision is only used for error reporting.
+    """
+    sql = """update sys."{}" set head_id=%s, head_description=%s, head_ts=%s,
+        applied_count = applied_count + %s, fingerprint = coalesce(%s, fingerprint), updated_at=%s""".format(
+        state_table(tbl_name))
+    try:
+        id_, description, ts = get_head(conn, tbl_name) or (None, None, None)
+        conn.cursor().execute(sql, (id_, description, ts, count, fingerprint, datetime.now()))
+    except Exception as e:
+        raise RevisionOperationError(revision, sql, repr(e))
+
+def rebuild_state(conn, tbl_name:str='mroll_revisions', fingerprint:str=None) -> None:
+    """
+    Recomputes head and applied count from the revisions table, after changes
+    made with the state table left alone. Concurrent transactions all updating
+    its single row would fail with write-write conflicts.
+    """
+    def run(batch_size):
+        cur = conn.cursor()
+        cur.execute('select count(*) from sys."{}"'.format(tbl_name))
+        count, = cur.fetchone()
+        id_, description, ts = get_head(conn, tbl_name) or (None, None, None)
+        cur.execute("""update sys."{}" set head_id=%s, head_description=%s, head_ts=%s, applied_count=%s,
+            fingerprint = coalesce(%s, fingerprint), updated_at=%s""".format(state_table(tbl_name)),
+            (id_, description, ts, count, fingerprint, datetime.now()))
+
+    run_in_transaction(conn, run)
+
+# columns added after (id, description, ts), with their types
+TIMING_COLUMNS = (('applied_at', 'timestamp'), ('duration', 'double'), ('stmt_count', 'int'))
+# columns added after the first release, upgrade_revisions_table adds them to older tables
+ADDED_COLUMNS = TIMING_COLUMNS + (('checksum', 'string'),)
+
+def create_revisions_table(conn, tbl_name:str='mroll_revisions') -> None:
+    """
+    Creates revisons table with columns (id string, description string, ts timestamp,
+    applied_at timestamp, duration double, stmt_count int, checksum string)
+    """
+    columns = ''.join(', {} {}'.format(name, type_) for name, type_ in ADDED_COLUMNS)
     sql = """
-    create table sys."{}"(id string, description string, ts timestamp);
+    create table sys."{}"(id string, description string, ts timestamp{});
     alter table sys."{}" add constraint mroll_rev_pk primary key (id);
-    """.format(tbl_name, tbl_name)
+    """.format(tbl_name, columns, tbl_name)
     try:
         conn.execute(sql)
+        create_state_table(conn, tbl_name)
         conn.commit()
     except Exception as e:
         conn.rollback()
-        raise(e)    
+        raise(e)
+
+def upgrade_revisions_table(conn, tbl_name:str='mroll_revisions') -> List[str]:
+    """
+    Adds columns and state table missing from a revisions table created by an
+    older mroll version. Returns names of added columns.
+    """
+    sql = """
+    select c.name from sys.columns c, sys.tables t, sys.schemas s
+    where c.table_id=t.id and t.schema_id=s.id and s.name='sys' and t.name=%s
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(sql, (tbl_name,))
+        existing = set(name for name, in cur.fetchall())
     finally:
-        conn.close()
+        conn.rollback()
+    if not existing:
+        # no revisions table, nothing to upgrade
+        return []
+    cur.execute("""select count(*) from sys.tables t, sys.schemas s
+        where t.schema_id=s.id and s.name='sys' and t.name=%s""", (state_table(tbl_name),))
+    has_state, = cur.fetchone()
+    added = []
+    try:
+        for name, type_ in ADDED_COLUMNS:
+            if name not in existing:
+                conn.execute("""alter table sys."{}" add column {} {}""".format(tbl_name, name, type_))
+                added.append(name)
+        if not has_state:
+            create_state_table(conn, tbl_name)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise(e)
+    return added
 
-def get_revisions(
-    db_name, tbl_name:str='mroll_revisions',
-    hostname:str='127.0.0.1', port:int=50000, 
-    username:str='monetbd', password:str='monetdb') -> List[REVISION_RECORD]:
+def get_revisions(conn, tbl_name:str='mroll_revisions') -> List[REVISION_RECORD]:
     """
     Returns all applied revisions.
     """
-    conn = pymonetdb.connect(db_name, hostname=hostname, port=port, username=username, password=password)
     sql = """select id, description, ts from sys."{}" order by ts""".format(tbl_name)
     cur = conn.cursor()
-    cur.execute(sql)
-    res = cur.fetchall()
-    conn.close()
-    return res
-        
+    try:
+        cur.execute(sql)
+        return cur.fetchall()
+    finally:
+        conn.rollback()
 
-def add_revisions(revisions: List[Revision], 
-    db_name, tbl_name:str='mroll_revisions', 
-    hostname:str='127.0.0.1', port:int=50000,
-    username:str='monetbd', password:str='monetdb') -> None:
+# rows fetched per round trip when streaming ids
+FETCH_SIZE = 10000
+
+def get_applied_ids(conn, tbl_name:str='mroll_revisions') -> Iterator[str]:
     """
-    Executes upgrade_sql and adds new revision records.
+    Streams ids of all applied revisions, FETCH_SIZE rows per round trip.
     """
-    conn = pymonetdb.connect(db_name, hostname=hostname, port=port, username=username, password=password)
+    sql = 'select id from sys."{}"'.format(tbl_name)
     cur = conn.cursor()
-    sql = """
-    insert into sys."{}" values (%s, %s, %s)
-    """.format(tbl_name)
+    cur.arraysize = FETCH_SIZE
+    if hasattr(cur, 'replysize'):
+        # newer pymonetdb sizes server replies separately from fetchmany
+        cur.replysize = FETCH_SIZE
+    try:
+        cur.execute(sql)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            for id_, in rows:
+                yield id_
+    finally:
+        conn.rollback()
+
+def get_checksums(conn, tbl_name:str='mroll_revisions') -> Iterator[Tuple[str, str]]:
+    """
+    Streams (id, checksum) of all applied revisions, FETCH_SIZE rows per round trip.
+    """
+    sql = 'select id, checksum from sys."{}"'.format(tbl_name)
+    cur = conn.cursor()
+    cur.arraysize = FETCH_SIZE
+    if hasattr(cur, 'replysize'):
+        cur.replysize = FETCH_SIZE
+    try:
+        cur.execute(sql)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.rollback()
+
+def set_checksums(conn, checksums: dict, tbl_name:str='mroll_revisions') -> None:
+    """
+    Fills in checksums, keyed by revision id, of records without one in one transaction.
+    """
+    sql = 'update sys."{}" set checksum = %s where id = %s and checksum is null'.format(tbl_name)
     try:
-        for rev in revisions:
-            for stmt in rev.upgrade_stmts:
-                conn.execute(stmt)
-            cur.execute(sql, (rev.id, rev.description, rev.ts))
+        conn.cursor().executemany(sql, [(checksum, id_) for id_, checksum in checksums.items()])
         conn.commit()
-    except Exception as e:
+    except Exception:
         conn.rollback()
-        raise RevisionOperationError(rev, stmt, repr(e))
+        raise
+
+def get_timings(conn, tbl_name:str='mroll_revisions') -> List[Tuple]:
+    """
+    Returns (id, applied_at, duration, stmt_count) of all applied revisions.
+    """
+    sql = """select id, applied_at, duration, stmt_count from sys."{}" order by ts""".format(tbl_name)
+    cur = conn.cursor()
+    try:
+        cur.execute(sql)
+        return cur.fetchall()
     finally:
-        conn.close()
+        conn.rollback()
 
-def remove_revisions(revisions: List[Revision],
-    db_name, tbl_name:str='mroll_revisions', 
-    hostname:str='127.0.0.1', port:int=50000,
-    username:str='monetbd', password:str='monetdb') -> None:
+def get_timing_estimates(conn, revision_ids: List[str], tbl_name:str='mroll_revisions') -> Tuple[dict, float]:
     """
-    Removes list of revisions in one transaction.
+    Returns (recorded duration by id, of revision_ids, seconds per statement
+    of all applied revisions, None when unknown), aggregated in the query.
     """
-    conn = pymonetdb.connect(db_name, hostname=hostname, port=port, username=username, password=password)
     cur = conn.cursor()
-    sql = """delete from sys."{}" where id=%s""".format(tbl_name)
     try:
-        for rev in revisions:
-            for stmt in rev.downgrade_stmts:
-                conn.execute(stmt)
-            cur.execute(sql, (rev.id,))
-        conn.commit()
-    except Exception as e:
+        cur.execute("""select sum(duration), sum(stmt_count) from sys."{}"
+            where duration is not null and stmt_count > 0""".format(tbl_name))
+        total_duration, total_stmts = cur.fetchone()
+        durations = {}
+        for i in range(0, len(revision_ids), BOOKKEEPING_CHUNK):
+            chunk = revision_ids[i:i + BOOKKEEPING_CHUNK]
+            cur.execute('select id, duration from sys."{}" where duration is not null and id in ({})'.format(
+                tbl_name, ', '.join(['%s'] * len(chunk))), chunk)
+            durations.update(cur.fetchall())
+        return durations, (total_duration / total_stmts if total_stmts else None)
+    finally:
         conn.rollback()
-        raise RevisionOperationError(rev, stmt, repr(e))
+
+def get_history(conn, tbl_name:str='mroll_revisions', since=None, limit:int=None, last:int=None) -> Iterator[Tuple]:
+    """
+    Streams (id, description, ts, applied_at, duration, stmt_count) of applied
+    revisions in (ts, id) order, FETCH_SIZE rows per round trip. Filters run in the
+    query: since an applied revision id or datetime, limit first rows, last last rows.
+    """
+    where = ''
+    params = []
+    cur = conn.cursor()
+    cur.arraysize = FETCH_SIZE
+    if hasattr(cur, 'replysize'):
+        cur.replysize = FETCH_SIZE
+    try:
+        if isinstance(since, datetime):
+            where = 'where applied_at >= cast(%s as timestamp)'
+            params.append(since.isoformat())
+        elif since is not None:
+            cur.execute('select ts from sys."{}" where id = %s'.format(tbl_name), (since,))
+            row = cur.fetchone()
+            if row is None:
+                raise ValueError("Error: no applied revision with id {}".format(since))
+            # revisions sharing its ts are ordered by id
+            where = 'where ts > cast(%s as timestamp) or (ts = cast(%s as timestamp) and id > %s)'
+            params.extend((str(row[0]), str(row[0]), since))
+        sql = 'select id, description, ts, applied_at, duration, stmt_count from sys."{}" {}'.format(tbl_name, where)
+        if last is not None:
+            # newest rows first, handed out oldest first
+            cur.execute(sql + ' order by ts desc, id desc limit {}'.format(int(last)), params or None)
+            rows = cur.fetchall()
+            rows.reverse()
+            yield from rows
+            return
+        if limit is not None:
+            sql += ' order by ts, id limit {}'.format(int(limit))
+        else:
+            sql += ' order by ts, id'
+        cur.execute(sql, params or None)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            yield from rows
     finally:
-        conn.close()
+        conn.rollback()
+
+# max number of rows written per bookkeeping statement
+BOOKKEEPING_CHUNK = 1000
+
+def insert_revision_records(conn, timings: List[RevisionTiming], tbl_name:str='mroll_revisions') -> None:
+    """
+    Records revisions as applied, together with their timings, using multi-row inserts.
+    """
+    cur = conn.cursor()
+    for i in range(0, len(timings), BOOKKEEPING_CHUNK):
+        chunk = timings[i:i + BOOKKEEPING_CHUNK]
+        sql = """insert into sys."{}" (id, description, ts, applied_at, duration, stmt_count, checksum)
+            values {}""".format(tbl_name, ', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(chunk)))
+        params = []
+        for t in chunk:
+            rev = t.revision
+            params.extend((rev.id, rev.description, rev.ts, t.applied_at, t.duration, t.stmt_count, rev.checksum))
+        try:
+            cur.execute(sql, params)
+        except Exception as e:
+            raise RevisionOperationError(chunk[0].revision, sql, repr(e))
+
+def delete_revision_records(conn, revisions: List[Revision], tbl_name:str='mroll_revisions') -> None:
+    """
+    Removes revision records with a single delete per chunk of ids.
+    """
+    cur = conn.cursor()
+    for i in range(0, len(revisions), BOOKKEEPING_CHUNK):
+        chunk = revisions[i:i + BOOKKEEPING_CHUNK]
+        sql = """delete from sys."{}" where id in ({})""".format(tbl_name, ', '.join(['%s'] * len(chunk)))
+        try:
+            cur.execute(sql, [rev.id for rev in chunk])
+        except Exception as e:
+            raise RevisionOperationError(chunk[0], sql, repr(e))
+
+def replace_revision_records(conn, revision_ids: List[str], baseline: Revision, tbl_name:str='mroll_revisions',
+    fingerprint:str=None) -> None:
+    """
+    Swaps records of squashed revisions for the record of their baseline in one transaction.
+    """
+    def run(batch_size):
+        delete_revision_records(conn, [Revision(id_, None, None) for id_ in revision_ids], tbl_name)
+        insert_revision_records(conn, [RevisionTiming(baseline, datetime.now())], tbl_name)
+        refresh_state(conn, baseline, 1 - len(revision_ids), tbl_name, fingerprint)
+
+    run_in_transaction(conn, run)
+
+def add_revisions(conn, revisions: List[Revision], tbl_name:str='mroll_revisions',
+    batch_size:int=1, commit_every:int=None, timings:list=None, fingerprint:str=None,
+    throttle:Tuple[int, float]=None, progress=None, update_state:bool=True) -> None:
+    """
+    Executes upgrade_sql and adds new revision records. By default in one
+    transaction, with commit_every set each commit_every revisions are
+    committed together with their records and state, so a rerun resumes after
+    the last commit. Timings of committed revisions are appended to timings.
+    Without update_state the state table is left to rebuild_state.
+    """
+    for unit in commit_units(revisions, commit_every):
+        if unit[0].chunked:
+            timing = apply_chunked(conn, unit[0], True, tbl_name, fingerprint, throttle, progress, update_state)
+            if timings is not None:
+                timings.append(timing)
+            continue
+        unit_timings = []
+
+        def run(batch_size, unit=unit):
+            unit_timings.clear()
+            for rev in unit:
+                unit_timings.append(execute_revision(conn, rev, rev.iter_stmts(True), batch_size, progress))
+            insert_revision_records(conn, unit_timings, tbl_name)
+            if update_state:
+                advance_state(conn, head_candidate(unit), len(unit), tbl_name, fingerprint)
+
+        run_in_transaction(conn, run, batch_size)
+        if timings is not None:
+            timings.extend(unit_timings)
+
+def remove_revisions(conn, revisions: List[Revision], tbl_name:str='mroll_revisions',
+    batch_size:int=1, commit_every:int=None, timings:list=None, fingerprint:str=None,
+    throttle:Tuple[int, float]=None, progress=None, update_state:bool=True) -> None:
+    """
+    Removes list of revisions, in one transaction unless commit_every is set.
+    Timings of committed revisions are appended to timings.
+    """
+    for unit in commit_units(revisions, commit_every):
+        if unit[0].chunked and 'online_alter' in unit[0].directives and not unit[0].has_sql(upgrade=False):
+            timing = apply_chunked(conn, unit[0], False, tbl_name, fingerprint, progress=progress,
+                update_state=update_state)
+            if timings is not None:
+                timings.append(timing)
+            continue
+        unit_timings = []
+
+        def run(batch_size, unit=unit):
+            unit_timings.clear()
+            for rev in unit:
+                unit_timings.append(execute_revision(conn, rev, rev.iter_stmts(False), batch_size, progress))
+            delete_revision_records(conn, unit, tbl_name)
+            if update_state:
+                refresh_state(conn, unit[-1], -len(unit), tbl_name, fingerprint)
+
+        run_in_transaction(conn, run, batch_size)
+        if timings is not None:
+            timings.extend(unit_timings)
+
+def apply_chunked(conn, rev: Revision, upgrade: bool, tbl_name:str='mroll_revisions',
+    fingerprint:str=None, throttle:Tuple[int, float]=None, progress=None, update_state:bool=True) -> RevisionTiming:
+    """
+    Applies, or rolls back, a revision committing in chunks, see
+    mroll.databases.online and mroll.databases.backfill. The revision record
+    and state change in the final transaction.
+    """
+    from mroll.databases import online, backfill
+
+    def applied(timing):
+        insert_revision_records(conn, [timing], tbl_name)
+        if update_state:
+            advance_state(conn, rev, 1, tbl_name, fingerprint)
+
+    def removed(timing):
+        delete_revision_records(conn, [rev], tbl_name)
+        if update_state:
+            refresh_state(conn, rev, -1, tbl_name, fingerprint)
+
+    if len([d for d in CHUNKED_DIRECTIVES if d in rev.directives]) > 1:
+        raise RevisionOperationError(rev, '', 'only one of {} headers allowed'.format(', '.join(CHUNKED_DIRECTIVES)))
+    on_chunk = progress.statements_done if progress is not None else None
+    if progress is not None:
+        progress.start_revision(rev)
+    try:
+        if upgrade and 'backfill' in rev.directives:
+            timing = backfill.backfill(conn, rev, tbl_name, applied, throttle, on_chunk)
+        elif upgrade:
+            timing = online.online_alter(conn, rev, applied, on_chunk)
+        else:
+            timing = online.online_revert(conn, rev, removed, on_chunk)
+    except RevisionOperationError:
+        raise
+    except Exception as e:
+        raise RevisionOperationError(rev, '', repr(e))
+    if progress is not None:
+        progress.finish_revision(timing)
+    return timing
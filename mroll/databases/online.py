@@ -0,0 +1,390 @@
+"""
+Online schema changes of large MonetDB tables
+
+A revision with an `-- online_alter=<table>` header holds only ALTER TABLE
+statements on that table. Instead of altering the table in place, inside one
+long transaction, the change is applied to an empty shadow table which is then
+filled in key ranges of `-- batch_rows=` rows over `-- batch_key=`, each range
+committed on its own. Triggers log keys of rows changed meanwhile, the logged
+rows are copied again until little is left, or for at most CATCH_UP_ROUNDS
+rounds, and the final transaction copies the rest and swaps the table names.
+Ranges never hold NULL keys, so the batch key column must be not null.
+
+The shadow table is created from the catalog definition of the table, with
+column defaults, not null constraints, comments and grants. Keys, check
+constraints, indexes and triggers are named uniquely per schema, they move
+from the previous table to the new one in the final transaction.
+
+The previous table is kept, emptied, as <table>_mroll_old. Without downgrade
+sql, rollback copies the rows back into it the same way.
+"""
+import re
+import time
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Callable, List, Tuple
+from mroll.migration import Revision, RevisionTiming
+from mroll.exceptions import RevisionOperationError
+from mroll.databases.catalog import (quote, column_type, read_table, create_table_sql, attach_sql,
+    detach_sql)
+from mroll.databases.cost import TABLE_NAME, table_of, statement_body, current_schema
+
+SHADOW_SUFFIX = '_mroll_new'
+OLD_SUFFIX = '_mroll_old'
+LOG_SUFFIX = '_mroll_log'
+DEFAULT_BATCH_ROWS = 100000
+# attempts of a chunk aborted by concurrency conflicts with other writers
+CONFLICT_RETRIES = 5
+# catch-up rounds before the final transaction copies what is left, however much
+CATCH_UP_ROUNDS = 10
+# batch keys of these types are seeked by value, see next_bound
+INTEGER_TYPES = ('tinyint', 'smallint', 'int', 'bigint', 'hugeint', 'oid')
+
+_ALTER_TABLE = re.compile(r'^\s*alter\s+table\s+(?:if\s+exists\s+)?' + TABLE_NAME, re.I)
+_TABLE = re.compile(r'^\s*' + TABLE_NAME + r'\s*$')
+_ADD_CONSTRAINT = re.compile(r'\badd\s+constraint\s+(?:"((?:[^"]|"")+)"|(\w+))', re.I)
+
+def literal(value) -> str:
+    """
+    Renders a key value fetched from the database as sql literal.
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float, Decimal)):
+        return str(value)
+    if isinstance(value, datetime):
+        return "timestamp '{}'".format(value.isoformat(sep=' '))
+    if isinstance(value, date):
+        return "date '{}'".format(value.isoformat())
+    return "'{}'".format(str(value).replace("'", "''"))
+
+def range_condition(key: str, lower: str=None, upper: str=None) -> str:
+    """
+    Condition selecting keys in (lower, upper], given as sql literals, open
+    ended when None.
+    """
+    conds = []
+    if lower is not None:
+        conds.append('{} > {}'.format(key, lower))
+    if upper is not None:
+        conds.append('{} <= {}'.format(key, upper))
+    return ' and '.join(conds)
+
+def range_where(key: str, lower: str=None, upper: str=None) -> str:
+    cond = range_condition(key, lower, upper)
+    return ' where ' + cond if cond else ''
+
+def next_bound(conn, table: str, key: str, lower: str, batch_rows: int, integer: bool=False) -> str:
+    """
+    Returns, as sql literal, the upper key of the range of at most batch_rows
+    rows past lower, None when the rest fits. Integer keys seek the first key
+    past lower and step batch_rows values from it, other keys take the
+    batch_rows smallest keys past lower.
+    """
+    where = range_where(key, lower)
+    if integer:
+        first, last = execute(conn, 'select min({key}), max({key}) from {table}{where}'.format(
+            key=key, table=table, where=where)).fetchone()
+        if first is None or last - first < batch_rows:
+            return None
+        return literal(first + batch_rows - 1)
+    sql = 'select count(*), max(k) from (select {key} as k from {table}{where} order by {key} limit {n}) as s'.format(
+        key=key, table=table, where=where, n=batch_rows)
+    count, upper = execute(conn, sql).fetchone()
+    return literal(upper) if count == batch_rows else None
+
+def execute(conn, sql: str, params=None):
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    return cur
+
+def in_transaction(conn, fn: Callable):
+    """
+    Runs fn() in a transaction of its own and commits, retrying when it
+    conflicts with concurrent writers.
+    """
+    for attempt in range(CONFLICT_RETRIES):
+        try:
+            res = fn()
+            conn.commit()
+            return res
+        except Exception as e:
+            conn.rollback()
+            if 'conflict' not in str(e).lower() or attempt == CONFLICT_RETRIES - 1:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+
+class OnlineTable:
+    """
+    Names of a table and of the helper objects of its online change.
+    """
+    def __init__(self, schema: str, table: str):
+        self.schema = schema
+        self.table = table
+        self.name = self.qualified(table)
+        self.shadow = self.qualified(table + SHADOW_SUFFIX)
+        self.old = self.qualified(table + OLD_SUFFIX)
+        self.log = self.qualified(table + LOG_SUFFIX)
+        # created in the schema of their table, unqualified
+        self.triggers = [table + '_mroll_' + op for op in ('ins', 'upd', 'del')]
+
+    def qualified(self, name: str) -> str:
+        return '{}.{}'.format(quote(self.schema), quote(name))
+
+    @classmethod
+    def from_directive(cls, value: str, schema: str) -> 'OnlineTable':
+        m = _TABLE.match(value)
+        if m is None:
+            raise ValueError("Error: invalid table name {}".format(value))
+        return cls(*table_of(m, schema))
+
+def table_columns(conn, schema: str, table: str) -> List[Tuple[str, str]]:
+    """
+    Returns (name, sql type) of the columns of a table, in order.
+    """
+    sql = """select c.name, c.type, c.type_digits, c.type_scale from sys.columns c
+        join sys.tables t on c.table_id = t.id join sys.schemas s on t.schema_id = s.id
+        where s.name = %s and t.name = %s order by c.number"""
+    rows = execute(conn, sql, (schema, table)).fetchall()
+    return [(name, column_type(type_, digits, scale)) for name, type_, digits, scale in rows]
+
+def batch_key_type(conn, rev: Revision, schema: str, table: str, key_name: str) -> str:
+    """
+    Returns the sql type of the batch key column of a table. Key ranges never
+    select NULL keys, so the column must be not null.
+    """
+    sql = """select c.type, c.type_digits, c.type_scale, c."null" from sys.columns c
+        join sys.tables t on c.table_id = t.id join sys.schemas s on t.schema_id = s.id
+        where s.name = %s and t.name = %s and c.name = %s"""
+    row = execute(conn, sql, (schema, table, key_name)).fetchone()
+    name = '{}.{}'.format(quote(schema), quote(table))
+    if row is None:
+        raise RevisionOperationError(rev, '', 'no column {} in {}'.format(key_name, name))
+    type_, digits, scale, nullable = row
+    if nullable:
+        raise RevisionOperationError(rev, '', 'batch_key {} of {} must be not null'.format(key_name, name))
+    return column_type(type_, digits, scale)
+
+def referencing_keys(conn, schema: str, table: str) -> List[str]:
+    """
+    Returns names of foreign keys referencing a table, they would keep
+    pointing at the table renamed away.
+    """
+    sql = """select fk.name from sys.keys fk join sys.keys pk on fk.rkey = pk.id
+        join sys.tables t on pk.table_id = t.id join sys.schemas s on t.schema_id = s.id
+        where s.name = %s and t.name = %s"""
+    return [row[0] for row in execute(conn, sql, (schema, table)).fetchall()]
+
+def drop_helpers(conn, names: OnlineTable) -> None:
+    """
+    Drops change log and triggers, e.g. left behind by an interrupted run.
+    """
+    for trigger in names.triggers:
+        execute(conn, 'drop trigger if exists {}'.format(names.qualified(trigger)))
+    execute(conn, 'drop table if exists {}'.format(names.log))
+
+def create_change_log(conn, names: OnlineTable, source: str, key: str, key_type: str) -> None:
+    """
+    Logs keys of rows of source changed from now on.
+    """
+    execute(conn, 'create table {} (seq serial, k {})'.format(names.log, key_type))
+    ins, upd, del_ = (quote(trigger) for trigger in names.triggers)
+    execute(conn, """create trigger {} after insert on {} referencing new row as n for each row
+        insert into {} (k) values (n.{})""".format(ins, source, names.log, key))
+    execute(conn, """create trigger {} after update on {} referencing old row as o new row as n for each row
+        begin atomic insert into {log} (k) values (o.{key}); insert into {log} (k) values (n.{key}); end""".format(
+        upd, source, log=names.log, key=key))
+    execute(conn, """create trigger {} after delete on {} referencing old row as o for each row
+        insert into {} (k) values (o.{})""".format(del_, source, names.log, key))
+
+def copy_chunks(conn, source: str, target: str, key: str, columns: str, batch_rows: int,
+    on_chunk: Callable=None, integer: bool=False) -> List[float]:
+    """
+    Copies rows from source to target in ranges of batch_rows keys, one
+    transaction per range. Returns the duration of every chunk, on_chunk(count)
+    is called with the number of chunks done. integer tells next_bound the key
+    is of an integer type.
+    """
+    durations = []
+    lower = None
+    while True:
+        start = time.perf_counter()
+
+        def chunk(lower=lower):
+            upper = next_bound(conn, source, key, lower, batch_rows, integer)
+            execute(conn, 'insert into {dst} ({cols}) select {cols} from {src}{where}'.format(
+                dst=target, cols=columns, src=source, where=range_where(key, lower, upper)))
+            return upper
+
+        upper = in_transaction(conn, chunk)
+        durations.append(time.perf_counter() - start)
+        if on_chunk is not None:
+            on_chunk(len(durations))
+        if upper is None:
+            return durations
+        lower = upper
+
+def catch_up(conn, names: OnlineTable, source: str, target: str, key: str, columns: str) -> int:
+    """
+    Copies rows logged as changed again, deleting those gone from source.
+    Runs in the current transaction, returns number of processed log rows.
+    """
+    max_seq, count = execute(conn, 'select max(seq), count(*) from {}'.format(names.log)).fetchone()
+    if not count:
+        return 0
+    logged = 'select k from {} where seq <= {}'.format(names.log, max_seq)
+    execute(conn, 'delete from {} where {} in ({})'.format(target, key, logged))
+    execute(conn, 'insert into {dst} ({cols}) select {cols} from {src} where {key} in ({logged})'.format(
+        dst=target, cols=columns, src=source, key=key, logged=logged))
+    execute(conn, 'delete from {} where seq <= {}'.format(names.log, max_seq))
+    return count
+
+def online_copy(conn, rev: Revision, names: OnlineTable, source_table: str, target_table: str, key: str,
+    batch_rows: int, swap: Callable, finish: Callable, on_chunk: Callable=None) -> RevisionTiming:
+    """
+    Copies source_table into the empty target_table online, columns they
+    share only, then calls swap() and finish() in the final transaction.
+    Change log and triggers on the source must exist. Returns timing with one
+    duration per committed chunk.
+    """
+    applied_at = datetime.now()
+    start = time.perf_counter()
+    source = names.qualified(source_table)
+    target = names.qualified(target_table)
+    source_columns = dict((quote(name), type_) for name, type_ in table_columns(conn, names.schema, source_table))
+    columns = ', '.join(quote(name) for name, _ in table_columns(conn, names.schema, target_table)
+        if quote(name) in source_columns)
+    conn.rollback()
+    durations = copy_chunks(conn, source, target, key, columns, batch_rows, on_chunk,
+        source_columns.get(key) in INTEGER_TYPES)
+    for _ in range(CATCH_UP_ROUNDS):
+        # copy changes logged meanwhile until few are left for the final transaction
+        chunk_start = time.perf_counter()
+        count = in_transaction(conn, lambda: catch_up(conn, names, source, target, key, columns))
+        durations.append(time.perf_counter() - chunk_start)
+        if count <= batch_rows:
+            break
+    timing = None
+
+    def final():
+        nonlocal timing
+        catch_up(conn, names, source, target, key, columns)
+        drop_helpers(conn, names)
+        swap()
+        timing = RevisionTiming(rev, applied_at, time.perf_counter() - start, durations)
+        finish(timing)
+
+    in_transaction(conn, final)
+    return timing
+
+def online_alter(conn, rev: Revision, finish: Callable, on_chunk: Callable=None) -> RevisionTiming:
+    """
+    Applies an online_alter revision. finish(timing) runs in the final
+    transaction, e.g. to record the revision as applied.
+    """
+    directives = rev.directives
+    schema = current_schema(conn)
+    names = OnlineTable.from_directive(directives['online_alter'], schema)
+    if not directives.get('batch_key'):
+        raise RevisionOperationError(rev, '', 'online_alter needs a batch_key header')
+    key = quote(directives['batch_key'])
+    batch_rows = int(directives.get('batch_rows') or DEFAULT_BATCH_ROWS)
+    stmts = []
+    for stmt in rev.iter_stmts(True):
+        body = statement_body(stmt)
+        m = _ALTER_TABLE.match(body)
+        if m is None or table_of(m, schema) != (names.schema, names.table):
+            raise RevisionOperationError(rev, stmt, 'online_alter revisions only alter table {}'.format(names.name))
+        stmts.append(body[:m.start(1)] + names.shadow + body[m.end():])
+    definition = None
+
+    def prepare():
+        fks = referencing_keys(conn, names.schema, names.table)
+        if fks:
+            raise RevisionOperationError(rev, '', 'table {} is referenced by foreign key(s) {}'.format(
+                names.name, ', '.join(fks)))
+        key_type = batch_key_type(conn, rev, names.schema, names.table, directives['batch_key'])
+        drop_helpers(conn, names)
+        nonlocal definition
+        definition = read_table(conn, names.schema, names.table)
+        execute(conn, 'drop table if exists {}'.format(names.shadow))
+        for sql in create_table_sql(definition, names.shadow):
+            execute(conn, sql)
+        for stmt in stmts:
+            try:
+                execute(conn, stmt)
+            except Exception as e:
+                raise RevisionOperationError(rev, stmt, repr(e))
+        create_change_log(conn, names, names.name, key, key_type)
+
+    in_transaction(conn, prepare)
+
+    def swap():
+        # keys, indexes and triggers move over under their own names
+        for sql in detach_sql(definition, names.name):
+            execute(conn, sql)
+        execute(conn, 'drop table if exists {}'.format(names.old))
+        execute(conn, 'alter table {} rename to {}'.format(names.name, quote(names.table + OLD_SUFFIX)))
+        execute(conn, 'alter table {} rename to {}'.format(names.shadow, quote(names.table)))
+        for sql in attach_sql(definition, names.name):
+            try:
+                execute(conn, sql)
+            except Exception as e:
+                raise RevisionOperationError(rev, sql, repr(e))
+        # only its shape is kept, for rollback
+        execute(conn, 'truncate table {}'.format(names.old))
+
+    return online_copy(conn, rev, names, names.table, names.table + SHADOW_SUFFIX, key, batch_rows, swap, finish, on_chunk)
+
+def revision_constraints(rev: Revision, names: OnlineTable, definition) -> set:
+    """
+    Returns names of the keys of the table definition an online_alter revision
+    added, unnamed ones are named after the shadow table they were added to.
+    """
+    added = set()
+    for stmt in rev.iter_stmts(True):
+        for quoted, plain in _ADD_CONSTRAINT.findall(statement_body(stmt)):
+            added.add(quoted.replace('""', '"') if quoted else plain.lower())
+    for _, _, name, _, _ in definition['keys']:
+        if name.startswith(names.table + SHADOW_SUFFIX):
+            added.add(name)
+    return added
+
+def online_revert(conn, rev: Revision, finish: Callable, on_chunk: Callable=None) -> RevisionTiming:
+    """
+    Rolls back an online_alter revision without downgrade sql, copying the
+    rows back into the table kept as <table>_mroll_old.
+    """
+    directives = rev.directives
+    names = OnlineTable.from_directive(directives['online_alter'], current_schema(conn))
+    key = quote(directives['batch_key'])
+    batch_rows = int(directives.get('batch_rows') or DEFAULT_BATCH_ROWS)
+    definition = added = None
+
+    def prepare():
+        if not table_columns(conn, names.schema, names.table + OLD_SUFFIX):
+            raise RevisionOperationError(rev, '', 'no table {} to roll back to'.format(names.old))
+        key_type = batch_key_type(conn, rev, names.schema, names.table, directives['batch_key'])
+        drop_helpers(conn, names)
+        nonlocal definition, added
+        definition = read_table(conn, names.schema, names.table)
+        added = revision_constraints(rev, names, definition)
+        execute(conn, 'delete from {}'.format(names.old))
+        create_change_log(conn, names, names.name, key, key_type)
+
+    in_transaction(conn, prepare)
+
+    def swap():
+        # constraints the revision added go with the altered table
+        for sql in detach_sql(definition, names.name, added):
+            execute(conn, sql)
+        execute(conn, 'alter table {} rename to {}'.format(names.name, quote(names.table + SHADOW_SUFFIX)))
+        execute(conn, 'alter table {} rename to {}'.format(names.old, quote(names.table)))
+        for sql in attach_sql(definition, names.name, added):
+            try:
+                execute(conn, sql)
+            except Exception as e:
+                raise RevisionOperationError(rev, sql, repr(e))
+        execute(conn, 'drop table {}'.format(names.shadow))
+
+    return online_copy(conn, rev, names, names.table, names.table + OLD_SUFFIX, key, batch_rows, swap, finish, on_chunk)
@@ -0,0 +1,427 @@
+"""
+SQLite
+"""
+import os
+import sqlite3
+from datetime import datetime
+from typing import Tuple, List, Iterator
+from mroll.migration import (Revision, RevisionTiming, MigrationContext, MigrationCtxConfig,
+    MigrationState, parse_commit_every, commit_units)
+from mroll.exceptions import RevisionOperationError
+from mroll.databases.common import execute_revision, run_in_transaction, state_table, head_candidate
+
+class SqliteMigrCtx(MigrationContext):
+    """
+    In-process implementation of Migration Context, keeping revision history in
+    an sqlite database file or in memory. Needs no database server, meant for
+    planning, dry runs, benchmarks and tests.
+
+    Configured in mroll.ini with
+        [mroll]
+        backend = sqlite
+        [sqlite]
+        sqlite_db = <path relative to work dir, or :memory:, default history.sqlite>
+        sqlite_execute = <true to run revision sql against sqlite_db, false to only record history>
+    """
+    def __init__(self, config: MigrationCtxConfig):
+        assert config.tbl_name
+        self.config = config
+        self.path = resolve_db_path(config)
+        self.execute = str(getattr(config, 'sqlite_execute', 'false')).lower() in ('1', 'true', 'yes', 'on')
+        self.commit_every = parse_commit_every(getattr(config, 'commit_every', None))
+        self.last_timings = []
+        self.fingerprint = None
+        # changes leave the state table alone, see rebuild_state
+        self.defer_state = False
+        self.progress = None
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            # autocommit mode, transactions are started explicitly. The
+            # context may be handed between threads, though never shared.
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            finally:
+                self._conn = None
+
+    def create_revisions_tbl(self) -> None:
+        return create_revisions_table(self.conn, tbl_name=self.config.tbl_name)
+
+    def upgrade_revisions_tbl(self) -> List[str]:
+        # created with all columns from the start, only the state table may be missing
+        upgrade_revisions_table(self.conn, tbl_name=self.config.tbl_name)
+        return []
+
+    @property
+    def head(self) -> Revision:
+        return self.state.head
+
+    @property
+    def state(self) -> MigrationState:
+        row = get_state(self.conn, tbl_name=self.config.tbl_name)
+        if row is None:
+            # reads leave a history table of an older mroll version alone
+            raise RuntimeError("Error: revisions table {} in {} is missing or outdated, run mroll init".format(
+                self.config.tbl_name, self.path))
+        id_, description, ts, applied_count, fingerprint, updated_at = row
+        head = Revision(id_, description, ts) if id_ is not None else None
+        return MigrationState(head, applied_count, fingerprint, updated_at)
+
+    @property
+    def revisions(self) -> List[Revision]:
+        revisions = get_revisions(self.conn, tbl_name=self.config.tbl_name)
+        return [Revision(id_, description, ts) for id_, description, ts in revisions]
+
+    def applied_ids(self) -> Iterator[str]:
+        return get_applied_ids(self.conn, tbl_name=self.config.tbl_name)
+
+    @property
+    def timings(self) -> dict:
+        return {id_: (applied_at, duration, stmt_count)
+            for id_, applied_at, duration, stmt_count in get_timings(self.conn, tbl_name=self.config.tbl_name)}
+
+    def timing_estimates(self, revision_ids: List[str]) -> Tuple[dict, float]:
+        return get_timing_estimates(self.conn, revision_ids, tbl_name=self.config.tbl_name)
+
+    def checksums(self) -> Iterator[Tuple[str, str]]:
+        return get_checksums(self.conn, tbl_name=self.config.tbl_name)
+
+    def record_checksums(self, checksums: dict) -> None:
+        self.upgrade_revisions_tbl()
+        return set_checksums(self.conn, checksums, tbl_name=self.config.tbl_name)
+
+    def history(self, since=None, limit: int=None, last: int=None) -> Iterator[Tuple]:
+        return get_history(self.conn, tbl_name=self.config.tbl_name, since=since, limit=limit, last=last)
+
+    def add_revisions(self, revisions: List[Revision], batch_size: int=None, commit_every: int=None) -> None:
+        # sqlite runs one statement per call, batch_size does not apply
+        self.last_timings = []
+        return add_revisions(self.conn, revisions, tbl_name=self.config.tbl_name,
+            commit_every=commit_every or self.commit_every, execute=self.execute, timings=self.last_timings,
+            fingerprint=self.fingerprint, progress=self.progress, update_state=not self.defer_state)
+
+    def remove_revisions(self, revisions: List[Revision], batch_size: int=None, commit_every: int=None) -> None:
+        self.last_timings = []
+        return remove_revisions(self.conn, revisions, tbl_name=self.config.tbl_name,
+            commit_every=commit_every or self.commit_every, execute=self.execute, timings=self.last_timings,
+            fingerprint=self.fingerprint, progress=self.progress, update_state=not self.defer_state)
+
+    def rebuild_state(self) -> None:
+        return rebuild_state(self.conn, tbl_name=self.config.tbl_name, fingerprint=self.fingerprint)
+
+    def replace_revisions(self, revision_ids: List[str], baseline: Revision) -> None:
+        return replace_revision_records(self.conn, revision_ids, baseline, tbl_name=self.config.tbl_name,
+            fingerprint=self.fingerprint)
+
+    def snapshot_schema(self) -> Tuple[str, str]:
+        return snapshot_schema(self.conn, tbl_name=self.config.tbl_name)
+
+    def estimate_costs(self, revisions: List[Revision], large_rows: int=None) -> list:
+        raise ValueError("Error: cost estimation needs MonetDB")
+
+    def __repr__(self):
+        return "<SqliteMigrCtx path={} head={}>".format(self.path, self.head)
+
+
+REVISION_RECORD = Tuple[str, str, str]
+# sqlite_db when not configured, in the work directory
+DEFAULT_DB = 'history.sqlite'
+
+def resolve_db_path(config: MigrationCtxConfig) -> str:
+    """
+    Returns sqlite database path, relative paths are taken relative to the work directory.
+    """
+    path = getattr(config, 'sqlite_db', None) or DEFAULT_DB
+    work_dir = getattr(config, 'work_dir', None)
+    if path != ':memory:' and not os.path.isabs(path) and work_dir:
+        path = os.path.join(work_dir, path)
+    return path
+
+def normalize_ts(ts) -> str:
+    """
+    Stores timestamps as iso strings, so that they sort chronologically.
+    """
+    if isinstance(ts, datetime):
+        return ts.isoformat()
+    return datetime.fromisoformat(str(ts)).isoformat()
+
+def create_revisions_table(conn, tbl_name:str='mroll_revisions') -> None:
+    """
+    Creates revisions table with the same columns as the MonetDB one.
+    """
+    conn.execute('begin immediate')
+    conn.execute("""create table "{}" (id text primary key, description text, ts text,
+        applied_at text, duration real, stmt_count integer, checksum text)""".format(tbl_name))
+    create_state_table(conn, tbl_name)
+    conn.execute('commit')
+
+def upgrade_revisions_table(conn, tbl_name:str='mroll_revisions') -> None:
+    """
+    Adds state table and checksum column to revisions tables created before they existed.
+    """
+    sql = "select name from sqlite_master where type='table' and name in (?, ?)"
+    names = set(name for name, in conn.execute(sql, (tbl_name, state_table(tbl_name))))
+    if tbl_name not in names:
+        return
+    columns = set(row[1] for row in conn.execute('pragma table_info("{}")'.format(tbl_name)))
+    if state_table(tbl_name) not in names or 'checksum' not in columns:
+        conn.execute('begin immediate')
+        if state_table(tbl_name) not in names:
+            create_state_table(conn, tbl_name)
+        if 'checksum' not in columns:
+            conn.execute('alter table "{}" add column checksum text'.format(tbl_name))
+        conn.execute('commit')
+
+def get_head(conn, tbl_name:str='mroll_revisions') -> REVISION_RECORD:
+    """
+    Returns last revision from the revisions table, on equal ts the last applied one.
+    """
+    sql = """select id, description, ts from "{}" order by ts desc, applied_at desc limit 1""".format(tbl_name)
+    return conn.execute(sql).fetchone()
+
+def get_state(conn, tbl_name:str='mroll_revisions') -> Tuple:
+    """
+    Returns (head_id, head_description, head_ts, applied_count, fingerprint,
+    updated_at) or None when there is no state table.
+    """
+    sql = 'select head_id, head_description, head_ts, applied_count, fingerprint, updated_at from "{}"'.format(
+        state_table(tbl_name))
+    try:
+        return conn.execute(sql).fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+def create_state_table(conn, tbl_name:str='mroll_revisions') -> None:
+    """
+    Creates the state table with its single row, filled from the revisions table.
+    """
+    state = state_table(tbl_name)
+    conn.execute("""create table "{}" (head_id text, head_description text, head_ts text,
+        applied_count integer, fingerprint text, updated_at text)""".format(state))
+    count, = conn.execute('select count(*) from "{}"'.format(tbl_name)).fetchone()
+    id_, description, ts = get_head(conn, tbl_name) or (None, None, None)
+    conn.execute('insert into "{}" values (?, ?, ?, ?, null, ?)'.format(state),
+        (id_, description, ts, count, datetime.now().isoformat()))
+
+def advance_state(conn, head: Revision, count: int, tbl_name:str='mroll_revisions', fingerprint:str=None) -> None:
+    """
+    Updates state after count revisions were added, head becomes the new head
+    unless the current one is more recent.
+    """
+    sql = """update "{}" set
+        head_id = case when head_ts is null or head_ts <= :ts then :id else head_id end,
+        head_description = case when head_ts is null or head_ts <= :ts then :description else head_description end,
+        head_ts = case when head_ts is null or head_ts <= :ts then :ts else head_ts end,
+        applied_count = applied_count + :count,
+        fingerprint = coalesce(:fingerprint, fingerprint),
+        updated_at = :now""".format(state_table(tbl_name))
+    conn.execute(sql, dict(ts=normalize_ts(head.ts), id=head.id, description=head.description, count=count,
+        fingerprint=fingerprint, now=datetime.now().isoformat()))
+
+def refresh_state(conn, count: int, tbl_name:str='mroll_revisions', fingerprint:str=None) -> None:
+    """
+    Updates state after records were removed, looking up the new head.
+    """
+    id_, description, ts = get_head(conn, tbl_name) or (None, None, None)
+    sql = """update "{}" set head_id=?, head_description=?, head_ts=?, applied_count = applied_count + ?,
+        fingerprint = coalesce(?, fingerprint), updated_at=?""".format(state_table(tbl_name))
+    conn.execute(sql, (id_, description, ts, count, fingerprint, datetime.now().isoformat()))
+
+def rebuild_state(conn, tbl_name:str='mroll_revisions', fingerprint:str=None) -> None:
+    """
+    Recomputes head and applied count from the revisions table, after changes
+    made with the state table left alone.
+    """
+    def run(batch_size):
+        conn.execute('begin immediate')
+        count, = conn.execute('select count(*) from "{}"'.format(tbl_name)).fetchone()
+        id_, description, ts = get_head(conn, tbl_name) or (None, None, None)
+        sql = """update "{}" set head_id=?, head_description=?, head_ts=?, applied_count=?,
+            fingerprint = coalesce(?, fingerprint), updated_at=?""".format(state_table(tbl_name))
+        conn.execute(sql, (id_, description, ts, count, fingerprint, datetime.now().isoformat()))
+
+    run_in_transaction(conn, run)
+
+def get_revisions(conn, tbl_name:str='mroll_revisions') -> List[REVISION_RECORD]:
+    """
+    Returns all applied revisions.
+    """
+    sql = """select id, description, ts from "{}" order by ts""".format(tbl_name)
+    return conn.execute(sql).fetchall()
+
+def get_applied_ids(conn, tbl_name:str='mroll_revisions') -> Iterator[str]:
+    """
+    Streams ids of all applied revisions.
+    """
+    for id_, in conn.execute('select id from "{}"'.format(tbl_name)):
+        yield id_
+
+def get_checksums(conn, tbl_name:str='mroll_revisions') -> Iterator[Tuple[str, str]]:
+    """
+    Streams (id, checksum) of all applied revisions.
+    """
+    yield from conn.execute('select id, checksum from "{}"'.format(tbl_name))
+
+def set_checksums(conn, checksums: dict, tbl_name:str='mroll_revisions') -> None:
+    """
+    Fills in checksums, keyed by revision id, of records without one in one transaction.
+    """
+    conn.execute('begin immediate')
+    try:
+        conn.executemany('update "{}" set checksum = ? where id = ? and checksum is null'.format(tbl_name),
+            [(checksum, id_) for id_, checksum in checksums.items()])
+        conn.execute('commit')
+    except sqlite3.Error:
+        conn.execute('rollback')
+        raise
+
+def get_timings(conn, tbl_name:str='mroll_revisions') -> List[Tuple]:
+    """
+    Returns (id, applied_at, duration, stmt_count) of all applied revisions.
+    """
+    sql = """select id, applied_at, duration, stmt_count from "{}" order by ts""".format(tbl_name)
+    return conn.execute(sql).fetchall()
+
+# max number of ids per query, sqlite allows 999 parameters
+ID_CHUNK = 500
+
+def get_timing_estimates(conn, revision_ids: List[str], tbl_name:str='mroll_revisions') -> Tuple[dict, float]:
+    """
+    Returns (recorded duration by id, of revision_ids, seconds per statement
+    of all applied revisions, None when unknown), aggregated in the query.
+    """
+    total_duration, total_stmts = conn.execute("""select sum(duration), sum(stmt_count) from "{}"
+        where duration is not null and stmt_count > 0""".format(tbl_name)).fetchone()
+    durations = {}
+    for i in range(0, len(revision_ids), ID_CHUNK):
+        chunk = revision_ids[i:i + ID_CHUNK]
+        durations.update(conn.execute('select id, duration from "{}" where duration is not null and id in ({})'.format(
+            tbl_name, ', '.join(['?'] * len(chunk))), chunk))
+    return durations, (total_duration / total_stmts if total_stmts else None)
+
+def get_history(conn, tbl_name:str='mroll_revisions', since=None, limit:int=None, last:int=None) -> Iterator[Tuple]:
+    """
+    Streams (id, description, ts, applied_at, duration, stmt_count) of applied
+    revisions in (ts, id) order. Filters run in the query: since an applied revision
+    id or datetime, limit first rows, last last rows.
+    """
+    where = ''
+    params = []
+    if isinstance(since, datetime):
+        where = 'where applied_at >= ?'
+        params.append(since.isoformat())
+    elif since is not None:
+        row = conn.execute('select ts from "{}" where id = ?'.format(tbl_name), (since,)).fetchone()
+        if row is None:
+            raise ValueError("Error: no applied revision with id {}".format(since))
+        # revisions sharing its ts are ordered by id
+        where = 'where ts > ? or (ts = ? and id > ?)'
+        params.extend((row[0], row[0], since))
+    sql = 'select id, description, ts, applied_at, duration, stmt_count from "{}" {}'.format(tbl_name, where)
+    if last is not None:
+        rows = conn.execute(sql + ' order by ts desc, id desc limit ?', params + [last]).fetchall()
+        rows.reverse()
+        yield from rows
+        return
+    if limit is not None:
+        yield from conn.execute(sql + ' order by ts, id limit ?', params + [limit])
+    else:
+        yield from conn.execute(sql + ' order by ts, id', params)
+
+# sqlite_master object types dropped explicitly, triggers go with their tables
+DROP_KINDS = ('table', 'view', 'index')
+
+def snapshot_schema(conn, tbl_name:str='mroll_revisions') -> Tuple[str, str]:
+    """
+    Returns (upgrade_sql, downgrade_sql) recreating, respectively dropping, all
+    objects in sqlite_master but mroll's own tables, in creation order.
+    """
+    sql = """select type, name, sql from sqlite_master
+        where sql is not null and name not like 'sqlite_%' and tbl_name not in (?, ?) order by rowid"""
+    rows = conn.execute(sql, (tbl_name, state_table(tbl_name))).fetchall()
+    up = [sql.rstrip(';') + ';' for _, _, sql in rows]
+    down = ['drop {} if exists "{}";'.format(type_, name.replace('"', '""'))
+        for type_, name, _ in reversed(rows) if type_ in DROP_KINDS]
+    return '\n'.join(up), '\n'.join(down)
+
+def insert_revision_records(conn, timings: List[RevisionTiming], tbl_name:str='mroll_revisions') -> None:
+    sql = """insert into "{}" (id, description, ts, applied_at, duration, stmt_count, checksum)
+        values (?, ?, ?, ?, ?, ?, ?)""".format(tbl_name)
+    try:
+        conn.executemany(sql, [(t.revision.id, t.revision.description, normalize_ts(t.revision.ts),
+            t.applied_at.isoformat(), t.duration, t.stmt_count, t.revision.checksum) for t in timings])
+    except sqlite3.Error as e:
+        raise RevisionOperationError(timings[0].revision, sql, repr(e))
+
+def delete_revision_records(conn, revisions: List[Revision], tbl_name:str='mroll_revisions') -> None:
+    sql = """delete from "{}" where id=?""".format(tbl_name)
+    try:
+        conn.executemany(sql, [(rev.id,) for rev in revisions])
+    except sqlite3.Error as e:
+        raise RevisionOperationError(revisions[0], sql, repr(e))
+
+def replace_revision_records(conn, revision_ids: List[str], baseline: Revision, tbl_name:str='mroll_revisions',
+    fingerprint:str=None) -> None:
+    """
+    Swaps records of squashed revisions for the record of their baseline in one transaction.
+    """
+    def run(batch_size):
+        conn.execute('begin immediate')
+        delete_revision_records(conn, [Revision(id_, None, None) for id_ in revision_ids], tbl_name)
+        insert_revision_records(conn, [RevisionTiming(baseline, datetime.now())], tbl_name)
+        refresh_state(conn, 1 - len(revision_ids), tbl_name, fingerprint)
+
+    run_in_transaction(conn, run)
+
+def _apply(conn, revisions, upgrade, tbl_name, commit_every, execute, timings, fingerprint=None, progress=None,
+    update_state=True):
+    for unit in commit_units(revisions, commit_every):
+        unit_timings = []
+
+        def run(batch_size, unit=unit):
+            # take the write lock up front, concurrent writers wait for it
+            conn.execute('begin immediate')
+            unit_timings.clear()
+            for rev in unit:
+                stmts = []
+                if execute and rev.chunked and (upgrade or ('online_alter' in rev.directives and not rev.has_sql(upgrade=False))):
+                    raise RevisionOperationError(rev, '', 'chunked revisions need MonetDB')
+                if execute:
+                    stmts = rev.iter_stmts(upgrade)
+                # only recording history takes no time worth reporting
+                unit_timings.append(execute_revision(conn, rev, stmts, progress=progress if execute else None))
+            if upgrade:
+                insert_revision_records(conn, unit_timings, tbl_name)
+                if update_state:
+                    advance_state(conn, head_candidate(unit), len(unit), tbl_name, fingerprint)
+            else:
+                delete_revision_records(conn, unit, tbl_name)
+                if update_state:
+                    refresh_state(conn, -len(unit), tbl_name, fingerprint)
+
+        run_in_transaction(conn, run)
+        if timings is not None:
+            timings.extend(unit_timings)
+
+def add_revisions(conn, revisions: List[Revision], tbl_name:str='mroll_revisions',
+    commit_every:int=None, execute:bool=False, timings:list=None, fingerprint:str=None, progress=None,
+    update_state:bool=True) -> None:
+    """
+    Records revisions as applied, running their upgrade sql when execute is set.
+    """
+    _apply(conn, revisions, True, tbl_name, commit_every, execute, timings, fingerprint, progress, update_state)
+
+def remove_revisions(conn, revisions: List[Revision], tbl_name:str='mroll_revisions',
+    commit_every:int=None, execute:bool=False, timings:list=None, fingerprint:str=None, progress=None,
+    update_state:bool=True) -> None:
+    """
+    Removes revision records, running their downgrade sql when execute is set.
+    """
+    _apply(conn, revisions, False, tbl_name, commit_every, execute, timings, fingerprint, progress, update_state)
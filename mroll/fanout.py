@@ -0,0 +1,54 @@
+"""
+Runs an operation against several target databases concurrently.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class TargetResult:
+    __slots__ = ('name', 'ok', 'message', 'duration')
+
+    def __init__(self, name, ok, message, duration):
+        self.name = name
+        self.ok = ok
+        self.message = message
+        self.duration = duration
+
+    def __repr__(self):
+        return "<TargetResult name={} ok={}>".format(self.name, self.ok)
+
+def _run_one(fn, name, config):
+    start = time.perf_counter()
+    try:
+        message = fn(name, config)
+        return TargetResult(name, True, message, time.perf_counter() - start)
+    except SystemExit as e:
+        return TargetResult(name, False, str(e.code).strip(), time.perf_counter() - start)
+    except Exception as e:
+        return TargetResult(name, False, repr(e), time.perf_counter() - start)
+
+def run_targets(targets, fn, jobs=4, on_result=None):
+    """
+    Calls fn(name, ctx_config) for every (name, ctx_config) in targets using a pool
+    of at most jobs threads. fn returns a status message or raises on failure.
+    on_result(result) is called as targets complete. Returns results in target order.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(targets)))) as pool:
+        futures = [pool.submit(_run_one, fn, name, config) for name, config in targets]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result.name] = result
+            if on_result is not None:
+                on_result(result)
+    return [results[name] for name, _ in targets]
+
+def exit_code(results):
+    """
+    0 when all targets succeeded, 1 when all failed, 2 on partial failure.
+    """
+    failed = len([r for r in results if not r.ok])
+    if failed == 0:
+        return 0
+    if failed == len(results):
+        return 1
+    return 2
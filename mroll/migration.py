@@ -1,28 +1,200 @@
 import os
+import re
+import sys
+import hashlib
+import time
 from configparser import ConfigParser
 from datetime import datetime
 from mroll.exceptions import InvalidWorkDirError
-import sqlparse
+from mroll.cache import RevisionCache, CacheEntry, CACHE_ERRORS, file_digest
+from mroll.splitter import split, split_stream, iter_section
 from  abc  import  ABCMeta,  abstractmethod
-from typing import Tuple, List
+from typing import Tuple, List, Iterable, Iterator, Optional
 
 def gen_rev_id():
     import uuid
     return uuid.uuid4().hex[-12:]
 
+# marks revision sql not yet read from file
+_UNLOADED = object()
+# mroll.ini sections describing extra target databases, e.g. [db:replica1]
+TARGET_SECTION_PREFIX = 'db:'
+# directory under versions holding revision files replaced by a baseline
+SQUASHED_DIR = 'squashed'
+# revision files written but not loaded yet, see WorkDirectory.publish_revision
+PENDING_SUFFIX = '.pending'
+# revision files larger than this are split while executing instead of held in memory
+STREAM_THRESHOLD = 16 * 2**20
+# number of revision files to parse from which parsing runs in a process pool
+PARALLEL_PARSE_THRESHOLD = 1000
+# optional headers changing how a revision is applied, see mroll.databases.online
+# and mroll.databases.backfill
+DIRECTIVES = ('online_alter', 'backfill', 'batch_key', 'batch_rows')
+# directives making a revision run in chunks, each committed on its own
+CHUNKED_DIRECTIVES = ('online_alter', 'backfill')
+_DIRECTIVE_LINE = re.compile(r'^\s*--\s*(\w+)=(.*)$')
+
 class Revision:
-    def __init__(self, id_, description, ts, upgrade_sql=None, downgrade_sql=None):
-        self.id = id_
-        self.description = description
-        self.ts = ts
-        self.upgrade_sql = upgrade_sql
-        self.downgrade_sql = downgrade_sql
-        self.upgrade_stmts = sqlparse.split(upgrade_sql) if upgrade_sql else []
-        self.downgrade_stmts = sqlparse.split(downgrade_sql) if downgrade_sql else []
+    """
+    Revision with lazily loaded sql. Header fields are read eagerly, upgrade
+    and downgrade sql are read from file and split into statements on first access.
+    """
+    __slots__ = ('id', 'description', 'ts', 'depends_on', 'squashes', 'directives', 'path',
+        '_upgrade_sql', '_downgrade_sql', '_upgrade_stmts', '_downgrade_stmts', '_stmts_store', '_checksum')
+
+    def __init__(self, id_, description, ts, upgrade_sql=None, downgrade_sql=None, depends_on=None, squashes=None,
+        directives=None):
+        self._set_header(id_, description, ts, depends_on, squashes, directives)
+        self.path = None
+        self._upgrade_sql = upgrade_sql
+        self._downgrade_sql = downgrade_sql
+        self._upgrade_stmts = None
+        self._downgrade_stmts = None
+        self._stmts_store = None
+        self._checksum = None
+
+    def _set_header(self, id_, description, ts, depends_on=None, squashes=None, directives=None):
+        self.id = sys.intern(id_) if isinstance(id_, str) else id_
+        self.description = sys.intern(description) if isinstance(description, str) else description
+        self.ts = sys.intern(ts) if isinstance(ts, str) else ts
+        # None when the revision has no depends_on header, it then depends on all earlier revisions
+        self.depends_on = tuple(sys.intern(d) for d in depends_on) if depends_on is not None else None
+        # ids of revisions a baseline revision replaces, see mroll squash
+        self.squashes = tuple(sys.intern(d) for d in squashes) if squashes else None
+        # DIRECTIVES headers by name, e.g. {'online_alter': 'sales', 'batch_key': 'id'}
+        self.directives = dict(directives) if directives else None
+
+    @property
+    def chunked(self) -> bool:
+        """
+        True for revisions applied in chunks committed one by one, outside the
+        transaction of other revisions.
+        """
+        return self.directives is not None and any(d in self.directives for d in CHUNKED_DIRECTIVES)
 
     def __repr__(self):
         return "<Revision id={} description={}>".format(self.id, self.description)
 
+    @property
+    def upgrade_sql(self):
+        if self._upgrade_sql is _UNLOADED:
+            self._load_sql()
+        return self._upgrade_sql
+
+    @property
+    def downgrade_sql(self):
+        if self._downgrade_sql is _UNLOADED:
+            self._load_sql()
+        return self._downgrade_sql
+
+    @property
+    def upgrade_stmts(self):
+        if self._upgrade_stmts is None:
+            self._split()
+        return self._upgrade_stmts
+
+    @property
+    def downgrade_stmts(self):
+        if self._downgrade_stmts is None:
+            self._split()
+        return self._downgrade_stmts
+
+    def _load_sql(self):
+        """
+        Reads upgrade and downgrade sql, skipping the header.
+        """
+        upgrade_sql = []
+        downgrade_sql = []
+        with open(self.path, 'rt') as file_:
+            for l in file_:
+                if 'migration:upgrade' in l:
+                    break
+            for l in file_:
+                if 'migration:downgrade' in l:
+                    break
+                upgrade_sql.append(l)
+            for l in file_:
+                downgrade_sql.append(l)
+        self._upgrade_sql = ''.join(upgrade_sql).strip() or None
+        self._downgrade_sql = ''.join(downgrade_sql).strip() or None
+
+    def _split(self):
+        if self._stmts_store is not None:
+            stmts = self._stmts_store.get_statements(self)
+            if stmts is not None:
+                self._upgrade_stmts, self._downgrade_stmts = stmts
+                return
+        upgrade_sql = self.upgrade_sql
+        downgrade_sql = self.downgrade_sql
+        self._upgrade_stmts = split(upgrade_sql) if upgrade_sql else []
+        self._downgrade_stmts = split(downgrade_sql) if downgrade_sql else []
+        if self._stmts_store is not None:
+            self._stmts_store.put_statements(self, self._upgrade_stmts, self._downgrade_stmts)
+
+    @property
+    def is_large(self) -> bool:
+        """
+        True for a revision file above STREAM_THRESHOLD whose sql is not loaded.
+        """
+        return (self.path is not None and self._upgrade_stmts is None and self._upgrade_sql is _UNLOADED
+            and os.path.getsize(self.path) > STREAM_THRESHOLD)
+
+    def iter_stmts(self, upgrade=True) -> Iterator[str]:
+        """
+        Iterates upgrade or downgrade statements. Large revision files are read
+        and split while the statements are consumed, in constant memory.
+        """
+        if self.is_large:
+            return split_stream(iter_section(self.path, upgrade))
+        return iter(self.upgrade_stmts if upgrade else self.downgrade_stmts)
+
+    @property
+    def checksum(self) -> str:
+        """
+        Digest of upgrade and downgrade sql, see sql_checksum. Large files are
+        hashed while read, digests of files are kept in the revision cache.
+        """
+        if self._checksum is None and self._stmts_store is not None:
+            self._checksum = self._stmts_store.get_checksum(self)
+            if self._checksum is not None:
+                return self._checksum
+        if self._checksum is None:
+            if self.is_large:
+                self._checksum = sql_checksum(iter_section(self.path, True), iter_section(self.path, False))
+            else:
+                self._checksum = sql_checksum((self.upgrade_sql or '').splitlines(),
+                    (self.downgrade_sql or '').splitlines())
+            if self._stmts_store is not None:
+                self._stmts_store.put_checksum(self, self._checksum)
+        return self._checksum
+
+    def stmt_count(self, upgrade=True) -> Optional[int]:
+        """
+        Number of upgrade or downgrade statements, None for large revision
+        files which are only split while executing.
+        """
+        if self.is_large:
+            return None
+        return len(self.upgrade_stmts if upgrade else self.downgrade_stmts)
+
+    def has_sql(self, upgrade=True) -> bool:
+        """
+        Whether the upgrade or downgrade section holds any sql.
+        """
+        if self.is_large:
+            return any(l.strip() for l in iter_section(self.path, upgrade))
+        return (self.upgrade_sql if upgrade else self.downgrade_sql) is not None
+
+    def prefetch(self):
+        """
+        Splits statements and computes the checksum ahead of use from other
+        threads, the statements cache is bound to the thread that opened it.
+        Statements of large files are left alone.
+        """
+        if self._upgrade_stmts is None and not self.is_large:
+            self._split()
+        self.checksum
+
     def serialize(self):
         from io import StringIO
         res=''
@@ -32,6 +204,13 @@ class Revision:
             buf.write('-- description={}\n'.format(self.description))
             ts = self.ts.isoformat() if type(self.ts) == datetime else self.ts
             buf.write('-- ts={}\n'.format(ts))
+            if self.depends_on is not None:
+                buf.write('-- depends_on={}\n'.format(','.join(self.depends_on)))
+            if self.squashes:
+                buf.write('-- squashes={}\n'.format(','.join(self.squashes)))
+            for name in DIRECTIVES:
+                if self.directives and name in self.directives:
+                    buf.write('-- {}={}\n'.format(name, self.directives[name]))
             buf.write('-- migration:upgrade\n')
             buf.write('{}\n'.format(self.upgrade_sql or ''))
             buf.write('-- migration:downgrade\n')
@@ -40,21 +219,38 @@ class Revision:
         return res
 
     @classmethod
-    def from_file(cls, rev_file):
+    def from_file(cls, rev_file, stmts_store=None):
         """
         Parse revision file with following format:
         -- identifiers used by mroll
         -- id=<revision_id>
         -- description=<revision description>
         -- ts=<time stamp>
+        -- depends_on=<comma separated revision ids, optional>
+        -- squashes=<comma separated revision ids, baseline revisions only>
+        -- <directive>=<value, optional, see DIRECTIVES>
         -- migration:upgrade
             <sql text>
 
         -- migration:downgrade
             <sql text>
+
+        Only the header is read, sql is loaded on first access.
         """
+        id_ = description = ts = depends_on = squashes = None
+        directives = {}
         with open(rev_file, 'rt') as file_:
             for l in file_:
+                m = _DIRECTIVE_LINE.match(l)
+                if m and m.group(1) in DIRECTIVES:
+                    directives[m.group(1)] = m.group(2).strip()
+                    continue
+                if 'squashes=' in l:
+                    squashes = parse_depends_on(l.split('squashes=').pop())
+                    continue
+                if 'depends_on=' in l:
+                    depends_on = parse_depends_on(l.split('depends_on=').pop())
+                    continue
                 if 'id=' in l:
                     id_ = l.split('id=').pop().strip()
                     continue
@@ -66,30 +262,246 @@ class Revision:
                     continue
                 if 'migration:upgrade' in l:
                     break
-            upgrade_sql = ''
-            for l in file_:
-                if 'migration:downgrade' in l:
-                    break
-                upgrade_sql+=l
-            downgrade_sql = ''
-            for l in file_:
-                downgrade_sql+=l
-            assert id_
-            assert description
-            assert ts
-            rev = cls.__new__(cls)
-            setattr(rev, 'id', id_)
-            setattr(rev, 'description', description)
-            setattr(rev, 'ts', ts)
-            upgrade_sql = upgrade_sql.strip() or None
-            upgrade_stmts = sqlparse.split(upgrade_sql) if upgrade_sql else []
-            setattr(rev, 'upgrade_sql', upgrade_sql)
-            setattr(rev, 'upgrade_stmts', upgrade_stmts)
-            downgrade_sql = downgrade_sql.strip() or None
-            downgrade_stmts = sqlparse.split(downgrade_sql) if downgrade_sql else []
-            setattr(rev, 'downgrade_sql', downgrade_sql)
-            setattr(rev, 'downgrade_stmts', downgrade_stmts)
-            return rev
+        assert id_
+        assert description
+        assert ts
+        return cls._from_header(id_, description, ts, rev_file, stmts_store, depends_on, squashes, directives)
+
+    @classmethod
+    def _from_header(cls, id_, description, ts, path, stmts_store=None, depends_on=None, squashes=None,
+        directives=None):
+        """
+        Builds revision backed by file at path from already parsed header.
+        """
+        rev = cls.__new__(cls)
+        rev._set_header(id_, description, ts, depends_on, squashes, directives)
+        rev.path = path
+        rev._upgrade_sql = _UNLOADED
+        rev._downgrade_sql = _UNLOADED
+        rev._upgrade_stmts = None
+        rev._downgrade_stmts = None
+        rev._stmts_store = stmts_store
+        rev._checksum = None
+        return rev
+
+def sql_checksum(upgrade_lines: Iterable[str], downgrade_lines: Iterable[str]) -> str:
+    """
+    sha1 hex digest of upgrade and downgrade sql lines with runs of whitespace
+    collapsed and blank lines skipped, so reindenting or changed line endings
+    do not count as a change.
+    """
+    h = hashlib.sha1()
+    for lines in (upgrade_lines, downgrade_lines):
+        for l in lines:
+            words = l.split()
+            if words:
+                h.update(' '.join(words).encode())
+                h.update(b'\n')
+        h.update(b'\0')
+    return h.hexdigest()
+
+def parse_revision_file(path):
+    """
+    Parses header and statements of a revision file, run in pool workers.
+    Returns plain values, revisions do not pickle with their lazily loaded sql.
+    """
+    rev = Revision.from_file(path)
+    stmts = None if rev.is_large else (rev.upgrade_stmts, rev.downgrade_stmts)
+    return rev.id, rev.description, rev.ts, rev.depends_on, rev.squashes, rev.directives, stmts
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def prefetch_revisions(revisions: List[Revision]) -> None:
+    """
+    Prefetches revisions, see Revision.prefetch, storing what was computed in
+    their revision cache in one transaction.
+    """
+    stores = []
+    for rev in revisions:
+        rev.prefetch()
+        if rev._stmts_store is not None and rev._stmts_store not in stores:
+            stores.append(rev._stmts_store)
+    for store in stores:
+        store.flush()
+
+def parse_revision_files(paths: List[str], threshold: int=PARALLEL_PARSE_THRESHOLD, stmts_store=None) -> List[Revision]:
+    """
+    Parses revision files, returns revisions in the order of paths. From
+    threshold files on, when more than one core is available, files are parsed
+    and split into statements by a process pool. Errors are raised as when
+    parsing serially, for the first failing file in order. A threshold of 0
+    disables the pool.
+    """
+    workers = available_cpus()
+    if threshold <= 0 or len(paths) < threshold or workers < 2:
+        return [Revision.from_file(path, stmts_store=stmts_store) for path in paths]
+    from concurrent.futures import ProcessPoolExecutor
+    res = []
+    chunksize = max(1, len(paths) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parsed = pool.map(parse_revision_file, paths, chunksize=chunksize)
+        for path, (id_, description, ts, depends_on, squashes, directives, stmts) in zip(paths, parsed):
+            rev = Revision._from_header(id_, description, ts, path, stmts_store, depends_on, squashes, directives)
+            if stmts is not None:
+                rev._upgrade_stmts, rev._downgrade_stmts = stmts
+            res.append(rev)
+    return res
+
+def parse_depends_on(value):
+    """
+    Parses comma separated revision ids, returns tuple of ids.
+    """
+    return tuple(id_.strip() for id_ in value.split(',') if id_.strip())
+
+def parse_commit_every(value):
+    """
+    Parses commit mode: 'all' (or empty) commits all revisions in one transaction,
+    'revision' commits after every revision and a number n after every n revisions.
+    Returns number of revisions per transaction or None for all.
+    """
+    if value is None or isinstance(value, int):
+        return value or None
+    value = value.strip().lower()
+    if value in ('', 'all'):
+        return None
+    if value == 'revision':
+        return 1
+    try:
+        n = int(value)
+    except ValueError:
+        raise ValueError("invalid commit mode '{}', expected all, revision or a number".format(value))
+    if n < 1:
+        raise ValueError("invalid commit mode '{}', expected a positive number".format(value))
+    return n
+
+def commit_units(revisions: List[Revision], commit_every=None):
+    """
+    Splits revisions in groups applied in one transaction each. Chunked
+    revisions commit on their own and always form a group by themselves.
+    """
+    res = []
+    unit = []
+    for rev in revisions:
+        if rev.chunked:
+            if unit:
+                res.append(unit)
+            res.append([rev])
+            unit = []
+            continue
+        unit.append(rev)
+        if commit_every and len(unit) == commit_every:
+            res.append(unit)
+            unit = []
+    if unit:
+        res.append(unit)
+    return res
+
+def squash(revisions: List[Revision], rev_id, description=None) -> Tuple[Revision, List[Revision]]:
+    """
+    Collapses revisions up to rev_id inclusive into one baseline revision.
+    Upgrade sql is concatenated in order, downgrade sql in reverse order.
+    Returns (baseline, squashed revisions).
+    """
+    ids = [rev.id for rev in revisions]
+    if rev_id not in ids:
+        raise ValueError("Error: no revision with id {}".format(rev_id))
+    squashed = revisions[:ids.index(rev_id) + 1]
+    if len(squashed) < 2:
+        raise ValueError("Error: nothing to squash up to {}".format(rev_id))
+    chunked = [rev.id for rev in squashed if rev.chunked]
+    if chunked:
+        raise ValueError("Error: can not squash chunked revision(s) {}".format(', '.join(chunked)))
+    squashes = squashed_ids(squashed)
+    upgrade_sql = '\n'.join(rev.upgrade_sql for rev in squashed if rev.upgrade_sql)
+    downgrade_sql = '\n'.join(rev.downgrade_sql for rev in reversed(squashed) if rev.downgrade_sql)
+    last = squashed[-1]
+    ts = last.ts.isoformat() if isinstance(last.ts, datetime) else last.ts
+    baseline = Revision(gen_rev_id(), description or 'baseline up to {}'.format(rev_id), ts,
+        upgrade_sql=upgrade_sql or None, downgrade_sql=downgrade_sql or None, squashes=squashes)
+    return baseline, squashed
+
+def squashed_ids(revisions: List[Revision]) -> List[str]:
+    """
+    Returns ids replaced by a baseline of revisions, including the ids earlier
+    baselines among them replaced.
+    """
+    res = []
+    for rev in revisions:
+        res.extend(rev.squashes or ())
+        res.append(rev.id)
+    return res
+
+def resolve_squashed(revisions: List[Revision], recorded_ids) -> List[Tuple[Revision, List[str]]]:
+    """
+    Finds baseline revisions not recorded as applied whose squashed revisions
+    are, i.e. on databases migrated before the squash. Revisions are applied in
+    order, so the range counts as applied when its last revision is recorded.
+    Returns [(baseline, recorded squashed ids)]. Raises ValueError when only
+    part of a squashed range is recorded.
+    """
+    res = []
+    for rev in revisions:
+        if not rev.squashes or rev.id in recorded_ids:
+            continue
+        recorded = [id_ for id_ in rev.squashes if id_ in recorded_ids]
+        if not recorded:
+            continue
+        if rev.squashes[-1] not in recorded_ids:
+            raise ValueError("Error: revisions squashed into {} are only partially applied, "
+                "last applied is {}".format(rev.id, recorded[-1]))
+        res.append((rev, recorded))
+    return res
+
+class RevisionTiming:
+    """
+    Wall-clock timings of applying or removing a revision, durations in seconds.
+    """
+    __slots__ = ('revision', 'applied_at', 'duration', 'stmt_durations')
+
+    def __init__(self, revision, applied_at=None, duration=None, stmt_durations=None):
+        self.revision = revision
+        self.applied_at = applied_at
+        self.duration = duration
+        self.stmt_durations = stmt_durations or []
+
+    @property
+    def stmt_count(self):
+        return len(self.stmt_durations)
+
+    def __repr__(self):
+        return "<RevisionTiming id={} duration={:.3f}s statements={}>".format(
+            self.revision.id, self.duration or 0, self.stmt_count)
+
+class MigrationState:
+    """
+    Summary of a database's revision history kept in a single row: head
+    revision, number of applied revisions and fingerprint of the work directory
+    at the last change.
+    """
+    __slots__ = ('head', 'applied_count', 'fingerprint', 'updated_at')
+
+    def __init__(self, head=None, applied_count=0, fingerprint=None, updated_at=None):
+        self.head = head
+        self.applied_count = applied_count
+        self.fingerprint = fingerprint
+        self.updated_at = updated_at
+
+    def __repr__(self):
+        return "<MigrationState head={} applied_count={}>".format(self.head, self.applied_count)
+
+def revisions_fingerprint(revisions: List[Revision]) -> str:
+    """
+    Digest of the revision ids of a work directory, in order.
+    """
+    h = hashlib.sha1()
+    for rev in revisions:
+        h.update(rev.id.encode())
+        h.update(b'\n')
+    return h.hexdigest()
 
 class MigrationCtxConfig:
     db_name = None
@@ -122,13 +534,122 @@ class MigrationContext(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def add_revisions(self, revisions: List[Revision]):
+    def add_revisions(self, revisions: List[Revision], batch_size: int=None, commit_every: int=None):
         pass
 
     @abstractmethod
-    def remove_revisions(self, revisions: List[Revision]):
+    def remove_revisions(self, revisions: List[Revision], batch_size: int=None, commit_every: int=None):
         pass
 
+    @property
+    @abstractmethod
+    def timings(self) -> dict:
+        """
+        Returns recorded (applied_at, duration, stmt_count) of applied revisions keyed by id.
+        """
+        pass
+
+    def applied_ids(self) -> Iterator[str]:
+        """
+        Iterates over ids of applied revisions, in no particular order.
+        """
+        return (rev.id for rev in self.revisions)
+
+    def timing_estimates(self, revision_ids: List[str]) -> Tuple[dict, Optional[float]]:
+        """
+        Returns (recorded duration by id, of revision_ids, seconds per
+        statement of all applied revisions, None when unknown).
+        """
+        from mroll.progress import history_estimates
+        durations, stmt_rate = history_estimates(self.timings)
+        ids = set(revision_ids)
+        return {id_: d for id_, d in durations.items() if id_ in ids}, stmt_rate
+
+    @property
+    def state(self) -> MigrationState:
+        """
+        Returns head, applied count and fingerprint recorded by the last change.
+        """
+        return MigrationState(self.head, len(self.revisions))
+
+    @abstractmethod
+    def history(self, since=None, limit: int=None, last: int=None) -> Iterator[Tuple]:
+        """
+        Iterates (id, description, ts, applied_at, duration, stmt_count) of
+        applied revisions in ts order. since is an applied revision id, rows
+        after it, or a datetime, rows applied at or after it. limit keeps the
+        first rows, last the last ones. Raises ValueError on unknown ids.
+        """
+        pass
+
+    @abstractmethod
+    def checksums(self) -> Iterator[Tuple[str, str]]:
+        """
+        Iterates (id, checksum) of applied revisions, checksum None for
+        revisions applied before checksums were recorded.
+        """
+        pass
+
+    @abstractmethod
+    def record_checksums(self, checksums: dict) -> None:
+        """
+        Records checksums, keyed by revision id, of applied revisions without one.
+        """
+        pass
+
+    @abstractmethod
+    def estimate_costs(self, revisions: List[Revision], large_rows: int=None) -> list:
+        """
+        Estimates cost of the upgrade statements of revisions without running
+        them, see mroll.databases.cost. Returns a RevisionCost per revision.
+        Raises ValueError when the backend cannot estimate.
+        """
+        pass
+
+    @abstractmethod
+    def rebuild_state(self) -> None:
+        """
+        Recomputes head and applied count from the revision records, after
+        changes made with defer_state set.
+        """
+        pass
+
+    @abstractmethod
+    def replace_revisions(self, revision_ids: List[str], baseline: Revision) -> None:
+        """
+        Replaces records of squashed revisions by one record of their baseline
+        revision, without running any revision sql.
+        """
+        pass
+
+    @abstractmethod
+    def snapshot_schema(self) -> Tuple[str, str]:
+        """
+        Reads the database catalog, returns (upgrade_sql, downgrade_sql)
+        recreating, respectively dropping, the current schema without the
+        revisions table.
+        """
+        pass
+
+    def upgrade_revisions_tbl(self) -> List[str]:
+        """
+        Brings revisions table created by an older mroll version up to date.
+        Returns names of added columns.
+        """
+        return []
+
+    def close(self):
+        """
+        Releases resources, e.g. database connection, held by the context.
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 # class MigrationContext:
 #     def __init__(self, head=None, revisions=[]):
 #         self.head = head
@@ -150,12 +671,26 @@ class MigrationContext(metaclass=ABCMeta):
 #         return mc
 
 class WorkDirectory:
-    def __init__(self, path):
+    def __init__(self, path, use_cache=True, parse_threshold=None):
         if not os.path.exists(path):
             raise RuntimeError("""Error: work directory doesn't exist. Run setup command first.""")
         if not os.listdir(path):
             raise RuntimeError("""Error: invalid work directory. Run setup command.""")
         self.path = path
+        self.use_cache = use_cache
+        self._cache = None
+        self._parse_threshold = parse_threshold
+
+    @property
+    def parse_threshold(self) -> int:
+        """
+        Files to parse from which a process pool is used, parse_threshold in
+        the [mroll] section of mroll.ini or PARALLEL_PARSE_THRESHOLD.
+        """
+        if self._parse_threshold is None:
+            value = self.config.get('mroll', 'parse_threshold', fallback=None)
+            self._parse_threshold = int(value) if value else PARALLEL_PARSE_THRESHOLD
+        return self._parse_threshold
 
     @property
     def config(self) -> MigrationCtxConfig:
@@ -169,17 +704,79 @@ class WorkDirectory:
         ctx_config = MigrationCtxConfig()
         sections = config.sections()
         for sec in sections:
+            if sec.startswith(TARGET_SECTION_PREFIX):
+                continue
             options = config.options(sec)
             for opt in options:
                 setattr(ctx_config, opt, config.get(sec, opt))
         ctx_config.tbl_name = ctx_config.rev_history_tbl_name
+        ctx_config.work_dir = self.path
         return ctx_config
 
-    def add_revision(self, rev: Revision):
+    def get_target_configs(self, targets=(), targets_file=None):
+        """
+        Returns [(name, MigrationCtxConfig)] for the [db:<name>] target sections
+        of mroll.ini, or of targets_file when given. Options of a target section
+        override those of the work dir config. Target 'all', or no targets with a
+        targets_file, selects every target section.
+        """
+        if targets_file:
+            config = ConfigParser()
+            if not config.read(targets_file):
+                raise ValueError("Error: can not read targets file {}".format(targets_file))
+        else:
+            config = self.config
+        available = [sec[len(TARGET_SECTION_PREFIX):] for sec in config.sections()
+            if sec.startswith(TARGET_SECTION_PREFIX)]
+        names = list(dict.fromkeys(targets))
+        if 'all' in names or (not names and targets_file):
+            names = available
+        missing = [name for name in names if name not in available]
+        if missing:
+            raise ValueError("Error: no [{}<target>] section for target(s) {}".format(
+                TARGET_SECTION_PREFIX, ', '.join(missing)))
+        if not names:
+            raise ValueError("Error: no targets found")
+        res = []
+        for name in names:
+            ctx_config = self.get_migration_ctx_config()
+            sec = TARGET_SECTION_PREFIX + name
+            for opt in config.options(sec):
+                setattr(ctx_config, opt, config.get(sec, opt))
+            res.append((name, ctx_config))
+        return res
+
+    def add_revision(self, rev: Revision, pending: bool=False) -> str:
+        """
+        Writes revision file, returns its path. A pending file is not loaded
+        until publish_revision renames it.
+        """
         kebab = rev.description.strip().replace(' ', '_')
         fn = os.path.join(self.path, 'versions', '{}_{}.sql'.format(rev.id, kebab))
+        if pending:
+            fn += PENDING_SUFFIX
         with open(fn, 'w+') as fw:
             fw.write(rev.serialize())
+        return fn
+
+    def publish_revision(self, path: str) -> str:
+        """
+        Renames a pending revision file written by add_revision, so it is loaded.
+        """
+        fn = path[:-len(PENDING_SUFFIX)]
+        os.replace(path, fn)
+        return fn
+
+    def archive_revisions(self, revisions: List[Revision]) -> str:
+        """
+        Moves revision files out of the way into versions/squashed, where they
+        are no longer loaded. Returns archive directory.
+        """
+        archive = os.path.join(self.path, 'versions', SQUASHED_DIR)
+        os.makedirs(archive, exist_ok=True)
+        for rev in revisions:
+            os.replace(rev.path, os.path.join(archive, os.path.basename(rev.path)))
+        return archive
 
     def _set_config(self, section, key, value):
         """
@@ -188,6 +785,8 @@ class WorkDirectory:
         """
         configfile = os.path.join(self.path, 'mroll.ini')
         config = self.config
+        if not config.has_section(section):
+            config.add_section(section)
         config[section][key] = value
         with open(configfile, 'w') as f:
             config.write(f)
@@ -196,22 +795,120 @@ class WorkDirectory:
     def revisions(self):
         return self.load_revisions(self.path)
 
-    def load_revisions(self, path):
-        vers_dir = os.path.join(path or self.path, 'versions')
-        res = []
-        for f in os.listdir(vers_dir):
-            if f.endswith('.sql'):
-                rev_file = os.path.join(vers_dir, f)
-                res.append(Revision.from_file(rev_file))
+    def checksums(self, revisions: List[Revision]) -> dict:
+        """
+        Returns checksums of revisions keyed by id. Checksums computed, not
+        found in the revision cache, are stored in it in one commit.
+        """
+        res = {rev.id: rev.checksum for rev in revisions}
+        self.save_cache()
+        return res
+
+    def save_cache(self) -> None:
+        """
+        Stores statements split and checksums computed since the revisions
+        were loaded in the revision cache, in one transaction.
+        """
+        if self._cache is not None:
+            self._cache.flush()
+
+    def durations(self, upgrade=True) -> dict:
+        """
+        Returns durations in seconds of revisions applied, or rolled back, from
+        this work dir before, keyed by revision id.
+        """
+        cache = self._open_cache(self.path)
+        return cache.get_durations(upgrade) if cache is not None else {}
+
+    def record_durations(self, timings: List[RevisionTiming], upgrade=True) -> None:
+        cache = self._open_cache(self.path)
+        if cache is not None:
+            cache.put_durations(timings, upgrade)
+
+    def _open_cache(self, path):
+        if not self.use_cache:
+            return None
+        if self._cache is None or os.path.dirname(self._cache.path) != path:
+            if self._cache is not None:
+                self._cache.close()
+            self._cache = RevisionCache.open(path)
+        return self._cache
+
+    def load_revisions(self, path=None):
+        path = path or self.path
+        cache = self._open_cache(path)
+        if cache is not None:
+            try:
+                return self._load_cached_revisions(path, cache)
+            except CACHE_ERRORS:
+                # e.g. read-only work directory, parse everything instead
+                cache.close()
+                self._cache = None
+        vers_dir = os.path.join(path, 'versions')
+        files = [os.path.join(vers_dir, f) for f in os.listdir(vers_dir) if f.endswith('.sql')]
+        res = parse_revision_files(files, self.parse_threshold)
         res.sort(key=lambda rev: datetime.fromisoformat(rev.ts))
         return res
+
+    def _load_cached_revisions(self, path, cache):
+        """
+        Loads revisions through the revision cache, parsing only new or changed files.
+        """
+        scan_ns = time.time_ns()
+        vers_dir = os.path.join(path, 'versions')
+        entries = cache.entries()
+        res = []
+        # new or changed files, parsed together below
+        to_parse = []
+        changed = False
+        for f in os.scandir(vers_dir):
+            if not f.name.endswith('.sql'):
+                continue
+            stat = f.stat()
+            entry = entries.pop(f.name, None)
+            digest = None
+            if entry is not None and not cache.is_fresh(entry, stat):
+                digest = file_digest(f.path)
+                if digest == entry.digest:
+                    cache.touch(entry, stat)
+                else:
+                    entry = None
+            if entry is None:
+                to_parse.append((f, stat, digest))
+                continue
+            rev = Revision._from_header(entry.id, entry.description, entry.ts, f.path, stmts_store=cache,
+                depends_on=entry.depends_on, squashes=entry.squashes, directives=entry.directives)
+            res.append((entry, rev))
+        parsed = parse_revision_files([f.path for f, _, _ in to_parse], self.parse_threshold, stmts_store=cache)
+        for (f, stat, digest), rev in zip(to_parse, parsed):
+            digest = digest or file_digest(f.path)
+            entry = CacheEntry(f.name, stat.st_mtime_ns, stat.st_size, digest, rev.id, rev.description, rev.ts,
+                rev.depends_on, rev.squashes, directives=rev.directives)
+            # statements are known when split by a pool worker
+            cache.put(entry, rev._upgrade_stmts, rev._downgrade_stmts)
+            res.append((entry, rev))
+            changed = True
+        if entries:
+            # files no longer in versions directory
+            cache.remove(entries.keys())
+            changed = True
+        if not changed and None not in (entry.pos for entry, _ in res):
+            res.sort(key=lambda pair: pair[0].pos)
+        else:
+            res.sort(key=lambda pair: datetime.fromisoformat(pair[1].ts))
+            cache.set_order([entry.fname for entry, _ in res])
+        cache.save(scan_ns)
+        return [rev for _, rev in res]
     
     def config_validate(self):
         """
-        Performs validation checks, e.g. mroll.ini is set and ready.
+        Performs validation checks, e.g. mroll.ini is set and ready. The
+        [db] and [host] sections are not used by the sqlite backend.
         """
         config = self.config
         sections = config.sections()
+        if config.get('mroll', 'backend', fallback='monetdb').strip().lower() == 'sqlite':
+            sections = [sec for sec in sections if sec not in ('db', 'host')]
         for sec in sections:
             options = config.options(sec)
             for opt in options:
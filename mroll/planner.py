@@ -0,0 +1,69 @@
+"""
+Computes which revisions of a work directory are applied and which are
+pending, from the ids recorded in the revisions table.
+"""
+from typing import Iterable, List
+from mroll.migration import Revision, resolve_squashed
+
+class Plan:
+    """
+    Revisions split in applied and pending, both in work directory order, plus
+    anomalies: recorded ids with no revision file (missing) and pending
+    revisions older than the newest applied one (out_of_order).
+    """
+    __slots__ = ('applied', 'pending', 'missing', 'out_of_order')
+
+    def __init__(self, applied, pending, missing, out_of_order):
+        self.applied = applied
+        self.pending = pending
+        self.missing = missing
+        self.out_of_order = out_of_order
+
+    @property
+    def head(self) -> Revision:
+        return self.applied[-1] if self.applied else None
+
+    def warnings(self) -> List[str]:
+        res = []
+        if self.missing:
+            res.append('Warning: applied revisions missing in work dir: {}'.format(', '.join(self.missing)))
+        for rev in self.out_of_order:
+            res.append('Warning: pending {} is older than applied head {}'.format(rev, self.head))
+        return res
+
+    def __repr__(self):
+        return "<Plan applied={} pending={} missing={} out_of_order={}>".format(
+            len(self.applied), len(self.pending), len(self.missing), len(self.out_of_order))
+
+def make_plan(revisions: List[Revision], applied_ids: Iterable[str]) -> Plan:
+    """
+    Splits revisions, in work directory order, using the recorded applied ids.
+    A baseline counts as applied when the revisions it squashed are recorded.
+    Raises ValueError when only part of a squashed range is recorded.
+    """
+    recorded = applied_ids if isinstance(applied_ids, (set, frozenset)) else set(applied_ids)
+    covered = set()
+    for baseline, _ in resolve_squashed(revisions, recorded):
+        covered.add(baseline.id)
+    applied = []
+    pending = []
+    last_applied = -1
+    for i, rev in enumerate(revisions):
+        if rev.id in recorded or rev.id in covered:
+            applied.append(rev)
+            last_applied = i
+        else:
+            pending.append((i, rev))
+    out_of_order = [rev for i, rev in pending if i < last_applied]
+    known = set()
+    for rev in revisions:
+        known.add(rev.id)
+        known.update(rev.squashes or ())
+    missing = sorted(id_ for id_ in recorded if id_ not in known)
+    return Plan(applied, [rev for _, rev in pending], missing, out_of_order)
+
+def plan_for(revisions: List[Revision], migr_ctx) -> Plan:
+    """
+    Plan against the revisions table of a migration context, fetching only ids.
+    """
+    return make_plan(revisions, migr_ctx.applied_ids())
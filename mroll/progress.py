@@ -0,0 +1,256 @@
+"""
+Progress display of upgrade and rollback
+
+On a terminal a single status line is redrawn, otherwise a log line is printed
+when a revision starts and every LOG_INTERVAL seconds while it runs, also
+while a single long statement runs. The ETA is derived from durations of
+earlier runs of the same revisions, recorded in the work dir cache or in the
+history table, and from seconds per statement for revisions never run before.
+"""
+import sys
+import time
+import shutil
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# seconds between log lines when not writing to a terminal
+LOG_INTERVAL = 10.0
+# seconds between redraws of the terminal status line
+TTY_INTERVAL = 0.2
+BAR_WIDTH = 20
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def history_estimates(timings: dict) -> Tuple[Dict[str, float], Optional[float]]:
+    """
+    Returns (duration by revision id, seconds per statement) from the
+    (applied_at, duration, stmt_count) timings of a history table.
+    """
+    durations = {}
+    total_duration = 0.0
+    total_stmts = 0
+    for id_, (_, duration, stmt_count) in timings.items():
+        if duration is None:
+            continue
+        durations[id_] = duration
+        if stmt_count:
+            total_duration += duration
+            total_stmts += stmt_count
+    return durations, (total_duration / total_stmts if total_stmts else None)
+
+class Progress:
+    """
+    Tracks revisions applied, or rolled back, by one add_revisions or
+    remove_revisions call. Engines call start_revision(), statements_done()
+    and finish_revision() while executing, a background thread redraws the
+    status in between until close() is called.
+    """
+    def __init__(self, revisions: List, upgrade: bool=True, expected: Dict[str, float]=None,
+        stmt_rate: float=None, out=None):
+        self.revisions = revisions
+        self.upgrade = upgrade
+        # expected duration by revision id
+        self.expected = expected or {}
+        # seconds per statement of earlier runs
+        self.stmt_rate = stmt_rate
+        self.out = out or sys.stderr
+        self.tty = hasattr(self.out, 'isatty') and self.out.isatty()
+        self.started = time.perf_counter()
+        self.finished = {}
+        self.finished_total = 0.0
+        self.stmt_counts = {}
+        self.stmts_done = 0
+        self.stmts_time = 0.0
+        self.current = None
+        self.current_started = None
+        self.current_done = 0
+        self.last_output = None
+        self.line_width = 0
+        # unfinished revisions, kept up to date as revisions finish so that
+        # the ETA does not walk all revisions: expected seconds of those with
+        # a recorded duration, number and statements of those with a statement
+        # count and number of those with neither
+        self.remaining_known = 0.0
+        self.remaining_counted = 0
+        self.remaining_stmts = 0
+        self.remaining_uncounted = 0
+        self.ids = set()
+        for rev in revisions:
+            self.ids.add(rev.id)
+            self.account(rev, 1)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.refresher = None
+
+    def stmt_count(self, rev) -> Optional[int]:
+        if rev.id not in self.stmt_counts:
+            self.stmt_counts[rev.id] = None if rev.chunked else rev.stmt_count(self.upgrade)
+        return self.stmt_counts[rev.id]
+
+    def account(self, rev, sign: int) -> None:
+        """
+        Adds (sign 1) or removes (sign -1) rev to the remaining revisions.
+        """
+        if rev.id in self.expected:
+            self.remaining_known += sign * self.expected[rev.id]
+            return
+        count = self.stmt_count(rev)
+        if count is None:
+            self.remaining_uncounted += sign
+        else:
+            self.remaining_counted += sign
+            self.remaining_stmts += sign * count
+
+    def start_revision(self, rev) -> None:
+        with self.lock:
+            # a replayed transaction starts its revisions again
+            duration = self.finished.pop(rev.id, None)
+            if duration is not None:
+                self.finished_total -= duration
+                self.account(rev, 1)
+            self.current = rev
+            self.current_started = time.perf_counter()
+            self.current_done = 0
+            self.output(force=True)
+        if self.refresher is None:
+            self.refresher = threading.Thread(target=self.refresh, name='mroll-progress', daemon=True)
+            self.refresher.start()
+
+    def statements_done(self, count: int) -> None:
+        """
+        count statements, or chunks, of the current revision are done.
+        """
+        with self.lock:
+            self.current_done = count
+            self.output()
+
+    def finish_revision(self, timing) -> None:
+        rev = timing.revision
+        with self.lock:
+            if rev.id in self.ids and rev.id not in self.finished:
+                self.account(rev, -1)
+            self.finished_total += (timing.duration or 0.0) - self.finished.get(rev.id, 0.0)
+            self.finished[rev.id] = timing.duration or 0.0
+            if not rev.chunked:
+                self.stmts_done += timing.stmt_count
+                self.stmts_time += timing.duration or 0.0
+            self.current = None
+
+    def refresh(self) -> None:
+        """
+        Redraws the status while a revision runs, e.g. one long statement.
+        """
+        interval = TTY_INTERVAL if self.tty else LOG_INTERVAL
+        while not self.stopped.wait(interval):
+            with self.lock:
+                if self.current is not None:
+                    self.output()
+
+    def rate(self) -> Optional[float]:
+        """
+        Seconds per statement, of this run once it has done some.
+        """
+        if self.stmts_done:
+            return self.stmts_time / self.stmts_done
+        return self.stmt_rate
+
+    def expected_duration(self, rev) -> Optional[float]:
+        if rev.id in self.expected:
+            return self.expected[rev.id]
+        rate = self.rate()
+        count = self.stmt_count(rev)
+        if rate is not None and count is not None:
+            return rate * count
+        return self.average()
+
+    def average(self) -> Optional[float]:
+        """
+        Mean duration of finished revisions.
+        """
+        if self.finished:
+            return self.finished_total / len(self.finished)
+        return None
+
+    def eta(self) -> Optional[float]:
+        """
+        Estimated seconds left, None when nothing is known to estimate from.
+        """
+        res = self.remaining_known
+        rate = self.rate()
+        average = self.average()
+        if self.remaining_counted:
+            if rate is not None:
+                res += rate * self.remaining_stmts
+            elif average is not None:
+                res += average * self.remaining_counted
+            else:
+                return None
+        if self.remaining_uncounted:
+            if average is None:
+                return None
+            res += average * self.remaining_uncounted
+        if self.current is not None and self.current.id not in self.finished:
+            expected = self.expected_duration(self.current)
+            res -= min(time.perf_counter() - self.current_started, expected or 0.0)
+        return max(res, 0.0)
+
+    def status(self) -> str:
+        return self.format_status(self.eta())
+
+    def bar(self) -> str:
+        return self.format_bar(self.eta())
+
+    def format_status(self, eta: Optional[float]) -> str:
+        now = time.perf_counter()
+        elapsed = now - self.started
+        position = min(len(self.finished) + 1, len(self.revisions))
+        head = '[{}/{}]'.format(position, len(self.revisions))
+        if self.current is not None:
+            total = self.stmt_count(self.current)
+            unit = 'chunk' if self.current.chunked else 'statement'
+            head += ' {} {} {}{}'.format(self.current, unit, self.current_done,
+                '/{}'.format(total) if total is not None else '')
+        parts = [head]
+        parts.append('elapsed {}'.format(format_duration(elapsed)))
+        stmts = self.stmts_done + (0 if self.current is None or self.current.chunked else self.current_done)
+        if stmts and elapsed > 0:
+            parts.append('{:.1f} stmt/s'.format(stmts / elapsed))
+        parts.append('ETA {}'.format(format_duration(eta) if eta is not None else '?'))
+        return ', '.join(parts)
+
+    def format_bar(self, eta: Optional[float]) -> str:
+        elapsed = time.perf_counter() - self.started
+        if eta is not None and elapsed + eta > 0:
+            fraction = elapsed / (elapsed + eta)
+        else:
+            fraction = len(self.finished) / max(len(self.revisions), 1)
+        filled = int(round(fraction * BAR_WIDTH))
+        return '[{}{}] '.format('#' * filled, '-' * (BAR_WIDTH - filled))
+
+    def output(self, force: bool=False) -> None:
+        now = time.perf_counter()
+        interval = TTY_INTERVAL if self.tty else LOG_INTERVAL
+        if not force and self.last_output is not None and now - self.last_output < interval:
+            return
+        self.last_output = now
+        eta = self.eta()
+        if self.tty:
+            line = (self.format_bar(eta) + self.format_status(eta))[:shutil.get_terminal_size().columns - 1]
+            self.out.write('\r' + line.ljust(self.line_width))
+            self.line_width = len(line)
+        else:
+            self.out.write(self.format_status(eta) + '\n')
+        self.out.flush()
+
+    def close(self) -> None:
+        """
+        Stops redrawing and ends the terminal status line.
+        """
+        self.stopped.set()
+        if self.refresher is not None:
+            self.refresher.join()
+        if self.tty and self.line_width:
+            self.out.write('\n')
+            self.out.flush()
@@ -0,0 +1,211 @@
+"""
+Streaming SQL splitter aware of MonetDB syntax
+
+Splits lines of sql into statements, yielding each statement as soon as its
+terminating ';' is read, so revision files of any size are split in constant
+memory. Besides quoted strings, identifiers and comments it keeps together
+
+- bodies of create function/procedure/trigger statements, BEGIN ... END blocks
+  including nested CASE ... END and embedded language { ... } code,
+- COPY ... FROM STDIN statements and their inline data. With `COPY n RECORDS`
+  exactly n data lines follow, otherwise data runs up to an empty line.
+
+Comments are kept with the statement that follows them, comment only text is
+dropped.
+"""
+import re
+from typing import Iterable, Iterator, List
+
+NORMAL, QUOTE, DQUOTE, COMMENT, BRACES, DATA = range(6)
+
+_NORMAL_TOKENS = re.compile(r"--|/\*|[;'\"{]")
+_QUOTE_END = re.compile(r"\\.|'", re.S)
+_RAW_QUOTE_END = re.compile(r"'")
+_DQUOTE_END = re.compile(r'"')
+_COMMENT_END = re.compile(r"\*/")
+_BRACES = re.compile(r"[{}]")
+_WORDS = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_COPY_RECORDS = re.compile(r"\bcopy\s+(\d+)\s+(?:offset\s+\d+\s+)?records\b", re.I)
+_FROM_STDIN = re.compile(r"\bfrom\s+stdin\b", re.I)
+
+# create statements whose body may hold ';'
+ROUTINE_KINDS = frozenset(('FUNCTION', 'PROCEDURE', 'TRIGGER', 'AGGREGATE', 'FILTER', 'LOADER', 'WINDOW'))
+_CREATE_MODIFIERS = frozenset(('OR', 'REPLACE', 'TEMP', 'TEMPORARY'))
+# END of these blocks is followed by the block keyword, they are not counted
+_UNCOUNTED_BLOCKS = frozenset(('IF', 'WHILE', 'LOOP', 'REPEAT', 'FOR'))
+
+def _routine_kind(head):
+    """
+    Tells from the leading words of a statement whether it creates a routine.
+    Returns None when more words are needed.
+    """
+    if head[0] != 'CREATE':
+        return False
+    for word in head[1:]:
+        if word not in _CREATE_MODIFIERS:
+            return word in ROUTINE_KINDS
+    return None
+
+def split_stream(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Yields stripped statements, including their terminating ';', from an
+    iterable of lines such as an open file.
+    """
+    buf = []
+    state = NORMAL
+    raw = False
+    has_code = False
+    head = []
+    routine = None
+    depth = 0
+    pending_end = False
+    braces = 0
+    data_left = None
+    copy_stmt = None
+
+    def copy_records(stmt):
+        m = _COPY_RECORDS.search(stmt)
+        return int(m.group(1)) if m else None
+
+    for line in lines:
+        if state == DATA:
+            if data_left is None and not line.strip():
+                yield (copy_stmt + '\n' + ''.join(buf)).rstrip('\n')
+                buf = []
+                state = NORMAL
+                continue
+            buf.append(line)
+            if data_left is not None:
+                data_left -= 1
+                if data_left == 0:
+                    yield (copy_stmt + '\n' + ''.join(buf)).rstrip('\n')
+                    buf = []
+                    state = NORMAL
+            continue
+        pos = 0
+        n = len(line)
+        while pos < n:
+            if state == NORMAL:
+                m = _NORMAL_TOKENS.search(line, pos)
+                end = m.start() if m else n
+                if end > pos:
+                    code = line[pos:end]
+                    if not has_code and not code.isspace():
+                        has_code = True
+                    if routine is not False:
+                        words = [w.upper() for w in _WORDS.findall(code)]
+                        if routine is None and words:
+                            head.extend(words)
+                            routine = _routine_kind(head)
+                        if routine:
+                            for w in words:
+                                if pending_end:
+                                    pending_end = False
+                                    if w in _UNCOUNTED_BLOCKS:
+                                        continue
+                                    depth -= 1
+                                    if w == 'CASE':
+                                        continue
+                                if w == 'BEGIN' or w == 'CASE':
+                                    depth += 1
+                                elif w == 'END':
+                                    pending_end = True
+                if m is None:
+                    buf.append(line[pos:])
+                    break
+                tok = m.group()
+                if tok == ';':
+                    if pending_end:
+                        pending_end = False
+                        depth -= 1
+                    buf.append(line[pos:end + 1])
+                    pos = end + 1
+                    if depth > 0:
+                        continue
+                    stmt = ''.join(buf).strip()
+                    buf = []
+                    is_copy = head[:1] == ['COPY'] and _FROM_STDIN.search(stmt) is not None
+                    if has_code and is_copy:
+                        copy_stmt = stmt
+                        data_left = copy_records(stmt)
+                        if data_left == 0:
+                            yield stmt
+                        else:
+                            state = DATA
+                    elif has_code:
+                        yield stmt
+                    has_code = False
+                    head = []
+                    routine = None
+                    depth = 0
+                    if state == DATA:
+                        # inline data starts on the next line
+                        break
+                    continue
+                if tok == "'":
+                    raw = end > 0 and line[end - 1] in 'rR' and (end < 2 or not (line[end - 2].isalnum() or line[end - 2] == '_'))
+                    state = QUOTE
+                    has_code = True
+                elif tok == '"':
+                    state = DQUOTE
+                    has_code = True
+                elif tok == '--':
+                    buf.append(line[pos:])
+                    break
+                elif tok == '/*':
+                    state = COMMENT
+                elif tok == '{' and routine:
+                    state = BRACES
+                    braces = 1
+                buf.append(line[pos:m.end()])
+                pos = m.end()
+            elif state == BRACES:
+                for m in _BRACES.finditer(line, pos):
+                    braces += 1 if m.group() == '{' else -1
+                    if braces == 0:
+                        buf.append(line[pos:m.end()])
+                        pos = m.end()
+                        state = NORMAL
+                        break
+                else:
+                    buf.append(line[pos:])
+                    break
+            else:
+                if state == QUOTE:
+                    pattern = _RAW_QUOTE_END if raw else _QUOTE_END
+                else:
+                    pattern = _DQUOTE_END if state == DQUOTE else _COMMENT_END
+                m = pattern.search(line, pos)
+                while m is not None and m.group()[0] == '\\':
+                    m = pattern.search(line, m.end())
+                if m is None:
+                    buf.append(line[pos:])
+                    break
+                buf.append(line[pos:m.end()])
+                pos = m.end()
+                state = NORMAL
+    if state == DATA:
+        yield (copy_stmt + '\n' + ''.join(buf)).rstrip('\n')
+    elif has_code:
+        yield ''.join(buf).strip()
+
+def split(sql: str) -> List[str]:
+    """
+    Splits sql text into a list of statements.
+    """
+    return list(split_stream(sql.splitlines(True)))
+
+def iter_section(path: str, upgrade: bool=True) -> Iterator[str]:
+    """
+    Yields lines of the upgrade or downgrade section of a revision file
+    without reading the whole file.
+    """
+    marker = 'migration:upgrade' if upgrade else 'migration:downgrade'
+    with open(path, 'rt') as file_:
+        for l in file_:
+            if marker in l:
+                break
+        for l in file_:
+            if upgrade and 'migration:downgrade' in l:
+                break
+            yield l
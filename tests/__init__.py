@@ -1,4 +1,14 @@
 from .test_commands import *
 from .test_work_dir import *
+from .test_cache import *
+from .test_splitter import *
+from .test_planner import *
+from .test_dag import *
+from .test_revision import *
+from .test_bench import *
 from .test_migration_context import *
 from .test_ad_hoc import *
+from .test_sqlite_context import *
+from .test_baseline import *
+from .test_cost import *
+from .test_chunked import *
@@ -0,0 +1,155 @@
+import shutil
+from unittest import TestCase
+from click.testing import CliRunner
+from mroll.migration import WorkDirectory, Revision
+from mroll.commands import upgrade, baseline
+from mroll.databases import create_migration_ctx
+from mroll.databases.catalog import generate_ddl, column_type, create_table_sql, attach_sql, detach_sql
+from .test_sqlite_context import make_sqlite_work_dir
+
+class TestBaseline(TestCase):
+    def test_generate_ddl(self):
+        catalog = dict(
+            schemas=[(2000, 'sys'), (7000, 'sales')],
+            sequences=[(7001, 'sales', 'seq_1', 1, 1, 9223372036854775807, 1, False)],
+            tables=[
+                (7002, 'sales', 'orders', 0, None),
+                (7003, 'sales', 'lines', 0, None),
+                (7004, 'sales', 'big_orders', 1, 'create view sales.big_orders as select * from sales.orders;'),
+                (7005, 'sys', 'mroll_revisions', 0, None)],
+            columns=[
+                (7002, 7040, 'id', 'int', 32, 0, False, 'next value for "sales"."seq_1"'),
+                (7002, 7041, 'total', 'decimal', 18, 3, True, None),
+                (7003, 7042, 'order_id', 'int', 32, 0, True, None),
+                (7003, 7043, 'at', 'timestamptz', 7, 0, True, None),
+                (7005, 7044, 'id', 'clob', 0, 0, True, None)],
+            keys=[(7010, 7002, 0, 'orders_pk', -1, -1), (7011, 7003, 2, 'lines_fk', 7010, (1 << 8) | 1),
+                (7012, 7002, 4, 'orders_total', -1, -1), (7013, 7003, 3, 'lines_at_key', -1, -1)],
+            indexes=[(7020, 7003, 0, 'lines_at')],
+            objects=[(7010, 'id'), (7011, 'order_id'), (7013, 'at'), (7020, 'at')],
+            functions=[(7030, 'sales', 'total', 1, 'create function sales.total() returns int begin return 1; end')],
+            triggers=[],
+            comments=[(7000, 'shop'), (7002, 'orders'), (7041, 'in cents'), (7020, 'by time')],
+            grants=[(7004, 'clerk', 1, 0)],
+            checks=[(7012, 'total >= 0')])
+        up, down = generate_ddl(catalog, exclude=(('sys', 'mroll_revisions'),))
+        self.assertEqual(up.splitlines()[:3], [
+            'create schema if not exists "sales";',
+            'comment on schema "sales" is \'shop\';',
+            'create sequence "sales"."seq_1" start with 1 increment by 1 minvalue 1 maxvalue 9223372036854775807;'])
+        self.assertIn('create table "sales"."orders" ("id" int default next value for "sales"."seq_1" not null, '
+            '"total" decimal(18,3));\ncomment on table "sales"."orders" is \'orders\';\n'
+            'comment on column "sales"."orders"."total" is \'in cents\';', up)
+        self.assertIn('alter table "sales"."orders" add constraint "orders_total" check (total >= 0);', up)
+        self.assertIn('alter table "sales"."lines" add constraint "lines_at_key" unique nulls not distinct ("at");', up)
+        self.assertIn('alter table "sales"."lines" add constraint "lines_fk" foreign key ("order_id") '
+            'references "sales"."orders" ("id") on delete cascade on update cascade;', up)
+        self.assertIn('create index "lines_at" on "sales"."lines" ("at");\n'
+            'comment on index "sales"."lines_at" is \'by time\';', up)
+        self.assertIn('create view sales.big_orders as select * from sales.orders;\n'
+            'grant select on table "sales"."big_orders" to "clerk";', up)
+        # foreign keys after the keys they reference
+        self.assertLess(up.index('"orders_pk"'), up.index('"lines_fk"'))
+        self.assertNotIn('mroll_revisions', up + down)
+        self.assertTrue(up.endswith('begin return 1; end;'))
+        self.assertEqual(down.splitlines()[0], 'drop all function "sales"."total" cascade;')
+        self.assertEqual(down.splitlines()[-1], 'drop schema if exists "sales";')
+        # members of merge tables are not read, grants on functions are not rendered
+        catalog['tables'].append((7006, 'sales', 'all_orders', 3, None))
+        catalog['grants'].append((7030, 'clerk', 16, 0))
+        with self.assertRaises(ValueError) as cm:
+            generate_ddl(catalog)
+        self.assertIn('merge or replica table "sales"."all_orders"', str(cm.exception))
+        self.assertIn('grant on function "sales"."total"', str(cm.exception))
+        self.assertEqual(column_type('timestamp', 4, 0), 'timestamp(3)')
+        self.assertEqual(column_type('varchar', 20, 0), 'varchar(20)')
+
+    def test_table_ddl(self):
+        definition = dict(
+            schema=[('sales', 'orders')],
+            columns=[
+                (7101, 'id', 'int', 32, 0, False, 'next value for "sales"."seq_1"'),
+                (7102, 'total', 'int', 32, 0, True, '0')],
+            keys=[(7110, 0, 'orders_pk', -1, -1), (7111, 4, 'orders_total', -1, -1),
+                (7112, 2, 'orders_fk', 7210, 2 << 8 | 2)],
+            references=[(7210, 'sales', 'customers')],
+            indexes=[(7120, 5, 'orders_total_imprints')],
+            objects=[(7110, 'id'), (7112, 'id'), (7120, 'total'), (7210, 'cid')],
+            triggers=[('orders_audit', 'create trigger orders_audit after delete on orders delete from audit;')],
+            comments=[(7100, "it's orders"), (7102, 'in cents')],
+            grants=[('clerk', 1 | 4, 0), ('boss', 1 | 2 | 8, 1)],
+            checks=[(7111, 'total >= 0')])
+        self.assertEqual(create_table_sql(definition, '"sales"."orders_new"'), [
+            'create table "sales"."orders_new" ("id" int default next value for "sales"."seq_1" not null, '
+            '"total" int default 0)',
+            'comment on table "sales"."orders_new" is \'it\'\'s orders\'',
+            'comment on column "sales"."orders_new"."total" is \'in cents\'',
+            'grant select, insert on table "sales"."orders_new" to "clerk"',
+            'grant select, update, delete on table "sales"."orders_new" to "boss" with grant option'])
+        # keys keep their names, no suffix
+        self.assertEqual(attach_sql(definition, '"sales"."orders"'), [
+            'alter table "sales"."orders" add constraint "orders_pk" primary key ("id")',
+            'alter table "sales"."orders" add constraint "orders_total" check (total >= 0)',
+            'alter table "sales"."orders" add constraint "orders_fk" foreign key ("id") '
+            'references "sales"."customers" ("cid")',
+            'create imprints index "orders_total_imprints" on "sales"."orders" ("total")',
+            'create trigger orders_audit after delete on orders delete from audit'])
+        self.assertEqual(detach_sql(definition, '"sales"."orders"', exclude={'orders_fk'}), [
+            'drop trigger "sales"."orders_audit"',
+            'drop index "sales"."orders_total_imprints"',
+            'alter table "sales"."orders" drop constraint "orders_total"',
+            'alter table "sales"."orders" drop constraint "orders_pk"'])
+
+    def test_baseline_cmd(self):
+        work_dir = make_sqlite_work_dir()
+        self.addCleanup(shutil.rmtree, work_dir)
+        wd = WorkDirectory(work_dir)
+        wd.add_revision(Revision('a', 'table a', '2020-05-04T23:14:31',
+            upgrade_sql="create table a (i int primary key);", downgrade_sql="drop table a;"))
+        with create_migration_ctx(wd.get_migration_ctx_config()) as ctx:
+            ctx.create_revisions_tbl()
+            # objects created outside of mroll
+            ctx.conn.execute("create table b (i int)")
+            ctx.conn.execute("create index b_i on b (i)")
+        runner = CliRunner()
+        res = runner.invoke(upgrade, ['-d', work_dir])
+        self.assertEqual(res.exit_code, 0, res.output)
+        res = runner.invoke(baseline, ['-d', work_dir, '-m', 'adopt'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        revisions = WorkDirectory(work_dir).revisions
+        self.assertEqual(len(revisions), 1)
+        rev = revisions[0]
+        self.assertEqual(rev.squashes, ('a',))
+        self.assertEqual(len(rev.upgrade_stmts), 3)
+        self.assertNotIn('mroll_revisions', rev.upgrade_sql)
+        with create_migration_ctx(wd.get_migration_ctx_config()) as ctx:
+            self.assertEqual([r.id for r in ctx.revisions], [rev.id])
+
+    def test_baseline_partial_target(self):
+        work_dir = make_sqlite_work_dir()
+        self.addCleanup(shutil.rmtree, work_dir)
+        wd = WorkDirectory(work_dir)
+        for id_, ts in (('a', '2020-05-04T23:14:31'), ('b', '2020-05-04T23:14:32')):
+            wd.add_revision(Revision(id_, 'table ' + id_, ts,
+                upgrade_sql="create table {} (i int);".format(id_), downgrade_sql="drop table {};".format(id_)))
+        wd._set_config('db:part', 'sqlite_db', 'part.sqlite')
+        for config in (wd.get_migration_ctx_config(), wd.get_target_configs(['part'])[0][1]):
+            with create_migration_ctx(config) as ctx:
+                ctx.create_revisions_tbl()
+        runner = CliRunner()
+        res = runner.invoke(upgrade, ['-d', work_dir])
+        self.assertEqual(res.exit_code, 0, res.output)
+        res = runner.invoke(upgrade, ['-d', work_dir, '-t', 'part', '-n', '1'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        # the target could not upgrade past the archived revision 'a'
+        res = runner.invoke(baseline, ['-d', work_dir])
+        self.assertEqual(res.exit_code, 1)
+        self.assertIn('target part holds only part', res.output)
+        self.assertEqual([r.id for r in WorkDirectory(work_dir).revisions], ['a', 'b'])
+        with create_migration_ctx(wd.get_migration_ctx_config()) as ctx:
+            self.assertEqual(sorted(r.id for r in ctx.revisions), ['a', 'b'])
+        res = runner.invoke(upgrade, ['-d', work_dir, '-t', 'part'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        res = runner.invoke(baseline, ['-d', work_dir])
+        self.assertEqual(res.exit_code, 0, res.output)
+        self.assertEqual([r.squashes for r in WorkDirectory(work_dir).revisions], [('a', 'b')])
@@ -0,0 +1,45 @@
+import os
+import sys
+import shutil
+import subprocess
+from tempfile import mkdtemp
+from unittest import TestCase
+from mroll.migration import WorkDirectory
+from mroll.planner import make_plan
+from mroll.bench import generate_work_dir, BODY_SIZES
+
+# modules only commands working on revisions or databases should load
+HEAVY_MODULES = ('pymonetdb', 'mroll.databases', 'mroll.migration', 'mroll.cache', 'sqlite3')
+
+def loaded_heavy_modules(code='import mroll.commands'):
+    """
+    Returns HEAVY_MODULES loaded by running code in a fresh interpreter.
+    """
+    check = '{}\nimport sys\nprint(" ".join(m for m in {!r} if m in sys.modules))'.format(code, HEAVY_MODULES)
+    out = subprocess.run([sys.executable, '-c', check], check=True, stdout=subprocess.PIPE,
+        universal_newlines=True).stdout
+    # last line, code may print too
+    return out.splitlines()[-1].split() if out.strip() else []
+
+class TestBench(TestCase):
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'versions'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_bench_generate_work_dir(self):
+        path = os.path.join(self.work_dir, 'bench')
+        generate_work_dir(path, 5, 'small')
+        revisions = WorkDirectory(path).revisions
+        self.assertEqual(len(revisions), 5)
+        self.assertEqual(len(revisions[0].upgrade_stmts), BODY_SIZES['small'])
+        self.assertEqual(len(make_plan(revisions, [r.id for r in revisions[:2]]).pending), 3)
+
+    def test_cli_startup_imports(self):
+        # trivial commands must not pay for the database drivers
+        self.assertEqual(loaded_heavy_modules(), [])
+        self.assertEqual(loaded_heavy_modules('from mroll.commands import cli\n'
+            'cli(["version"], standalone_mode=False)'), [])
+        self.assertIn('mroll.migration', loaded_heavy_modules('from mroll.bench import generate_work_dir'))
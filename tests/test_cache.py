@@ -0,0 +1,100 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+from mroll.migration import Revision, WorkDirectory, gen_rev_id, prefetch_revisions
+from mroll.cache import CACHE_FILE, RevisionCache
+
+class TestRevisionCache(TestCase):
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'versions'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_revision_cache(self):
+        content="""
+        -- identifiers used by mroll
+        -- id={}
+        -- description=add column {}
+        -- ts=2020-05-04T23:14:3{}.498799
+        -- migration:upgrade
+            alter table foo add column {} string;
+
+        -- migration:downgrade
+            alter table foo drop column {};
+        """
+        ids = [gen_rev_id() for i in range(3)]
+        for i, id_ in enumerate(ids):
+            fn = os.path.join(self.work_dir, 'versions', "{}.sql".format(id_))
+            with open(fn, 'w') as f:
+                f.write(content.format(id_, i, i, i, i))
+        wd = WorkDirectory(self.work_dir)
+        first = wd.revisions
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, CACHE_FILE)))
+        second = wd.revisions
+        self.assertEqual([r.id for r in first], ids)
+        self.assertEqual([r.id for r in second], ids)
+        self.assertEqual([r.upgrade_stmts for r in first], [r.upgrade_stmts for r in second])
+        # changed file is parsed again
+        fn = os.path.join(self.work_dir, 'versions', "{}.sql".format(ids[0]))
+        with open(fn, 'w') as f:
+            f.write(content.format(ids[0], 'x', 5, 'x', 'x'))
+        third = wd.revisions
+        self.assertEqual([r.id for r in third], ids[1:] + ids[:1])
+        self.assertEqual(third[-1].description, 'add column x')
+        # removed file drops out
+        os.remove(fn)
+        self.assertEqual([r.id for r in wd.revisions], ids[1:])
+        uncached = WorkDirectory(self.work_dir, use_cache=False).revisions
+        self.assertEqual([r.id for r in uncached], ids[1:])
+
+    def test_rev_lazy_statements(self):
+        id_ = gen_rev_id()
+        content="""
+        -- identifiers used by mroll
+        -- id={}
+        -- description=add column
+        -- ts=2020-05-04T23:14:37.498799
+        -- migration:upgrade
+            alter table foo add column b string;
+            alter table foo add column c string;
+
+        -- migration:downgrade
+            alter table foo drop column c;
+            alter table foo drop column b;
+        """.format(id_)
+        fn = os.path.join(self.work_dir, 'versions', "{}.sql".format(id_))
+        with open(fn, 'w') as f:
+            f.write(content)
+        wd = WorkDirectory(self.work_dir)
+        rev = wd.revisions[0]
+        self.assertEqual(rev.id, id_)
+        self.assertIsNone(RevisionCache.open(self.work_dir).get_statements(rev))
+        self.assertEqual(len(rev.upgrade_stmts), 2)
+        # kept until stored together with those of other revisions
+        self.assertIsNone(RevisionCache.open(self.work_dir).get_statements(rev))
+        wd.save_cache()
+        # split statements end up in the cache
+        rev = WorkDirectory(self.work_dir).revisions[0]
+        stmts = RevisionCache.open(self.work_dir).get_statements(rev)
+        self.assertEqual(stmts, (rev.upgrade_stmts, rev.downgrade_stmts))
+        self.assertEqual(len(stmts[1]), 2)
+
+    def test_prefetch_revisions(self):
+        wd = WorkDirectory(self.work_dir)
+        for i in range(3):
+            wd.add_revision(Revision(gen_rev_id(), 'rev {}'.format(i), '2020-05-04T23:14:3{}'.format(i),
+                upgrade_sql='create table t{} (i int);'.format(i), downgrade_sql='drop table t{};'.format(i)))
+        revisions = WorkDirectory(self.work_dir).revisions
+        commits = []
+        cache = revisions[0]._stmts_store
+        cache.conn.set_trace_callback(lambda sql: commits.append(sql) if sql.upper() == 'COMMIT' else None)
+        prefetch_revisions(revisions)
+        # statements and checksums of all revisions in one transaction
+        self.assertEqual(len(commits), 1)
+        cache = RevisionCache.open(self.work_dir)
+        for rev in revisions:
+            self.assertEqual(cache.get_statements(rev), (rev.upgrade_stmts, rev.downgrade_stmts))
+            self.assertEqual(cache.get_checksum(rev), rev.checksum)
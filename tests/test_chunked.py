@@ -0,0 +1,65 @@
+import sqlite3
+from unittest import TestCase
+from datetime import date
+from mroll.databases.online import literal, range_condition, next_bound, OnlineTable
+from mroll.databases.backfill import restrict, top_level_where
+
+class SqliteConn:
+    """
+    sqlite connection taking None for no parameters, as DB-API drivers do.
+    """
+    def __init__(self):
+        self.conn = sqlite3.connect(':memory:')
+
+    def cursor(self):
+        conn = self.conn
+
+        class Cursor:
+            def execute(self, sql, params=None):
+                self.cur = conn.execute(sql, params or ())
+
+            def fetchone(self):
+                return self.cur.fetchone()
+        return Cursor()
+
+class TestChunked(TestCase):
+    def test_online_ranges(self):
+        self.assertEqual(literal(5), '5')
+        self.assertEqual(literal("o'neil"), "'o''neil'")
+        self.assertEqual(literal(date(2020, 5, 4)), "date '2020-05-04'")
+        self.assertEqual(range_condition('"id"'), '')
+        self.assertEqual(range_condition('"id"', '10'), '"id" > 10')
+        self.assertEqual(range_condition('"id"', '10', "'b'"), '"id" > 10 and "id" <= \'b\'')
+        names = OnlineTable.from_directive('shop."Orders"', 'sys')
+        self.assertEqual((names.schema, names.table), ('shop', 'Orders'))
+        self.assertEqual(OnlineTable.from_directive('orders', 'sys').name, '"sys"."orders"')
+        self.assertRaises(ValueError, OnlineTable.from_directive, 'orders; drop', 'sys')
+
+    def test_next_bound(self):
+        conn = SqliteConn()
+        conn.conn.execute('create table t (id int, name text)')
+        conn.conn.executemany('insert into t values (?, ?)', [(i, 'n{:03d}'.format(i)) for i in range(0, 250, 2)])
+        # integer keys step batch_rows values from the first key past lower
+        self.assertEqual(next_bound(conn, 't', 'id', None, 10, True), '9')
+        self.assertEqual(next_bound(conn, 't', 'id', '9', 10, True), '19')
+        self.assertEqual(next_bound(conn, 't', 'id', '239', 10, True), None)
+        conn.conn.execute("insert into t values (100000, 'z')")
+        # a gap is skipped over, not stepped through
+        self.assertEqual(next_bound(conn, 't', 'id', '248', 10, True), None)
+        self.assertEqual(next_bound(conn, 't', 'id', '239', 10, True), '249')
+        self.assertEqual(next_bound(conn, 't', 'name', None, 10), "'n018'")
+        self.assertEqual(next_bound(conn, 't', 'name', "'n018'", 10), "'n038'")
+        self.assertEqual(next_bound(conn, 't', 'name', "'n238'", 10), None)
+
+    def test_backfill_restrict(self):
+        cond = '"id" > 10 and "id" <= 20'
+        self.assertEqual(restrict('update orders set total = 0;', cond),
+            'update orders set total = 0 where "id" > 10 and "id" <= 20;')
+        stmt = """update orders set total = (select sum(x) from items where items.o = orders.id)
+            where status = 'where' and id in (select o from late where d > 1) -- open ones
+            ;"""
+        self.assertEqual(stmt.index('where status'), top_level_where(stmt))
+        self.assertEqual(restrict(stmt, cond), stmt[:stmt.index('where status')]
+            + 'where ("id" > 10 and "id" <= 20) and (status = \'where\' and id in (select o from late where d > 1) -- open ones\n);')
+        self.assertEqual(restrict('delete from orders WHERE total < 0', cond),
+            'delete from orders where ("id" > 10 and "id" <= 20) and (total < 0\n);')
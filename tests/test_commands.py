@@ -7,7 +7,7 @@ import pymonetdb
 
 from mroll import __version__
 from mroll.commands import *
-from mroll.migration import Revision, gen_rev_id
+from mroll.migration import Revision, WorkDirectory, gen_rev_id
 from mroll.config import MROLL_CONFIG_DIR
 from mroll.databases import create_migration_ctx
 
@@ -0,0 +1,60 @@
+from unittest import TestCase
+from mroll.migration import Revision
+from mroll.exceptions import RevisionOperationError
+from mroll.databases.common import execute_stmts, run_in_transaction
+
+class RecordingConn:
+    """
+    Records the requests sent, failing those holding 'fail'.
+    """
+    def __init__(self):
+        self.sent = []
+        self.log = []
+
+    def execute(self, sql):
+        self.sent.append(sql)
+        if 'fail' in sql:
+            raise Exception('syntax error in: ' + sql)
+
+    def commit(self):
+        self.log.append('commit')
+
+    def rollback(self):
+        self.log.append('rollback')
+
+class TestCommon(TestCase):
+    rev = Revision('a', 'a', '2020-05-04T23:14:31', upgrade_sql='', downgrade_sql='')
+
+    def test_execute_stmts_batches(self):
+        conn = RecordingConn()
+        done = []
+        stmts = ['create table a (i int);', 'insert into a values (1);', 'insert into a values (2);',
+            'create function f() returns int begin return 1; end', 'insert into a values (3);']
+        durations = execute_stmts(conn, self.rev, stmts, batch_size=2, on_stmt=done.append)
+        # statements not ending in ';' go on their own
+        self.assertEqual(conn.sent, ['\n'.join(stmts[:2]), stmts[2], stmts[3], stmts[4]])
+        self.assertEqual(len(durations), 5)
+        self.assertEqual(done, [2, 3, 4, 5])
+        conn = RecordingConn()
+        execute_stmts(conn, self.rev, stmts, batch_size=1)
+        self.assertEqual(conn.sent, stmts)
+
+    def test_run_in_transaction_fallback(self):
+        conn = RecordingConn()
+        stmts = ['create table a (i int);', 'insert into a values (fail);', 'insert into a values (2);']
+        sizes = []
+
+        def run(batch_size):
+            sizes.append(batch_size)
+            execute_stmts(conn, self.rev, stmts, batch_size)
+
+        with self.assertRaises(RevisionOperationError) as cm:
+            run_in_transaction(conn, run, batch_size=3)
+        # the failed batch is replayed one statement at a time, naming the failing one
+        self.assertEqual(sizes, [3, 1])
+        self.assertEqual(conn.sent, ['\n'.join(stmts)] + stmts[:2])
+        self.assertEqual(cm.exception.stmt, stmts[1])
+        self.assertEqual(conn.log, ['rollback', 'rollback'])
+        conn = RecordingConn()
+        run_in_transaction(conn, lambda batch_size: execute_stmts(conn, self.rev, stmts[::2], batch_size), 3)
+        self.assertEqual((conn.sent, conn.log), (['\n'.join(stmts[::2])], ['commit']))
@@ -0,0 +1,35 @@
+from unittest import TestCase
+from mroll.databases.cost import estimate_statement, bound_columns, RevisionCost
+
+class TestCost(TestCase):
+    sizes = {('sys', 'sales'): 2000000000, ('sys', 'small'): 10, ('shop', 'Orders'): 50000000}
+
+    def test_bound_columns(self):
+        mal = [
+            '    X_5:bat[:int] := sql.bind(X_4:int, "sys":str, "sales":str, "amount":str, 0:int);',
+            '    X_8:bat[:int] := sql.bind(X_4:int, "sys":str, "sales":str, "amount":str, 1:int);',
+            '    X_9:bat[:str] := sql.bind(X_4:int, "sys":str, "small":str, "name":str, 0:int);']
+        self.assertEqual(bound_columns(mal), {('sys', 'sales', 'amount'), ('sys', 'small', 'name')})
+        cost = estimate_statement('update sales set amount = amount * 2;', self.sizes, mal)
+        self.assertTrue(cost.explained)
+        self.assertEqual(cost.cost, 2000000010)
+        self.assertEqual(len(cost.flags), 1)
+        self.assertIn('full table update of sys.sales', cost.flags[0])
+        cost = estimate_statement('update sales set amount = 0 where id = 1;', self.sizes, mal[:1])
+        self.assertEqual(cost.flags, [])
+
+    def test_ddl(self):
+        cost = estimate_statement('-- widen\nalter table shop."Orders" alter column total type bigint;', self.sizes)
+        self.assertEqual(cost.cost, 50000000)
+        self.assertIn('column type change on shop.Orders', cost.flags[0])
+        cost = estimate_statement('alter table small add column b int;', self.sizes)
+        self.assertEqual((cost.cost, cost.flags), (10, []))
+        cost = estimate_statement('create index sales_at on sales (at);', self.sizes)
+        self.assertIn('index build', cost.flags[0])
+        self.assertEqual(estimate_statement('create table foo (a int);', self.sizes).cost, 0)
+        # refers to a table created by the working set
+        unknown = estimate_statement('alter table foo add column b int;', self.sizes)
+        self.assertIsNone(unknown.cost)
+        rev_cost = RevisionCost(None, [cost, unknown])
+        self.assertEqual((rev_cost.cost, rev_cost.unknown, len(rev_cost.flags)), (2000000000, 1, 1))
+
@@ -0,0 +1,33 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+from mroll.migration import Revision, WorkDirectory
+from mroll.dag import build_dependencies, topological_order
+
+class TestDependencies(TestCase):
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'versions'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_revision_dependencies(self):
+        ts = '2020-05-04T23:14:3{}'
+        a = Revision('a', 'a', ts.format(1))
+        b = Revision('b', 'b', ts.format(2), depends_on=('a',))
+        c = Revision('c', 'c', ts.format(3), depends_on=('a',))
+        d = Revision('d', 'd', ts.format(4))
+        deps = build_dependencies([a, b, c, d])
+        self.assertEqual(deps, {'a': (), 'b': ('a',), 'c': ('a',), 'd': ('b', 'c')})
+        self.assertEqual(topological_order([a, b, c, d], deps), [a, b, c, d])
+        self.assertRaises(ValueError, build_dependencies, [Revision('e', 'e', ts.format(5), depends_on=('x',))])
+        self.assertRaises(ValueError, topological_order, [a, b], {'a': ('b',), 'b': ('a',)})
+        # header survives serialization and the revision cache
+        wd = WorkDirectory(self.work_dir)
+        wd.add_revision(a)
+        wd.add_revision(b)
+        for _ in range(2):
+            revisions = WorkDirectory(self.work_dir).revisions
+            self.assertEqual([r.depends_on for r in revisions], [None, ('a',)])
@@ -2,10 +2,12 @@ import os
 import shutil
 from unittest import TestCase
 from click.testing import CliRunner
-from mroll.migration import Revision, WorkDirectory, gen_rev_id
-from mroll.commands import setup, revision
+from mroll.migration import Revision, RevisionTiming, WorkDirectory, gen_rev_id
+from mroll.commands import setup, revision, upgrade, rollback
 from mroll.config import MROLL_CONFIG_DIR
 from mroll.databases import create_migration_ctx
+from mroll.exceptions import RevisionOperationError
+from mroll.databases.monetdb import insert_revision_records, delete_revision_records
 import pymonetdb
 from datetime import datetime
 
@@ -33,6 +35,7 @@ class TestMonetMigrationContext(TestCase):
         conn = pymonetdb.connect(self.db_name)
         try:
             conn.execute("drop table if exists sys.mroll_revisions;")
+            conn.execute("drop table if exists sys.mroll_revisions_state;")
             conn.execute("drop schema test cascade")
             conn.commit()
         except Exception as e:
@@ -53,16 +56,54 @@ class TestMonetMigrationContext(TestCase):
         ctx = create_migration_ctx(wd.get_migration_ctx_config())
         self.assertIsNotNone(ctx)
 
+    def test_shared_conn(self):
+        wd = WorkDirectory(path=self.work_dir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        # opened on first use only
+        self.assertIsNone(ctx._conn)
+        ctx.create_revisions_tbl()
+        conn = ctx.conn
+        self.assertIsNotNone(conn)
+        rev = Revision(gen_rev_id(), "table a", datetime.now(),
+            upgrade_sql="create table test.a (i int);", downgrade_sql="drop table test.a;")
+        ctx.add_revisions([rev])
+        self.assertEqual(ctx.head.id, rev.id)
+        self.assertEqual(len(ctx.revisions), 1)
+        # one connection serves every call
+        self.assertIs(ctx.conn, conn)
+        ctx.close()
+        self.assertIsNone(ctx._conn)
+        # reopened after close
+        with ctx:
+            self.assertEqual(ctx.head.id, rev.id)
+            self.assertIsNot(ctx.conn, conn)
+        self.assertIsNone(ctx._conn)
+
+    def test_unix_socket(self):
+        socket = os.environ.get('TEST_DB_SOCKET', '/tmp/.s.monetdb.50000')
+        if not os.path.exists(socket):
+            self.skipTest('no MonetDB socket {}'.format(socket))
+        wd = WorkDirectory(path=self.work_dir)
+        wd._set_config('host', 'unix_socket', socket)
+        # hostname and port are not needed then
+        wd._set_config('host', 'hostname', '')
+        wd._set_config('host', 'port', '')
+        with create_migration_ctx(wd.get_migration_ctx_config()) as ctx:
+            ctx.create_revisions_tbl()
+            self.assertIsNone(ctx.head)
+            cur = ctx.conn.cursor()
+            cur.execute('select 1')
+            self.assertEqual(cur.fetchone()[0], 1)
+
     def test_migr_ctx_head(self):
         wd = WorkDirectory(path=self.work_dir)
         ctx = create_migration_ctx(wd.get_migration_ctx_config())
         ctx.create_revisions_tbl()
         self.assertIsNone(ctx.head)
-        conn = pymonetdb.connect(self.db_name)
-        sql = """insert into sys.mroll_revisions values ('{}', '{}', '{}')""".format(gen_rev_id(), "bla bla", datetime.now())
-        conn.execute(sql)
-        conn.commit()
-        self.assertIsNotNone(ctx.head)
+        rev = Revision(gen_rev_id(), "bla bla", datetime.now(), upgrade_sql="select 1;")
+        ctx.add_revisions([rev])
+        self.assertEqual(ctx.head.id, rev.id)
+        self.assertEqual(ctx.state.applied_count, 1)
 
     def test_ctx_revisions(self):
         wd = WorkDirectory(path=self.work_dir)
@@ -70,7 +111,7 @@ class TestMonetMigrationContext(TestCase):
         ctx.create_revisions_tbl()
         self.assertTrue(len(ctx.revisions) == 0)
         conn = pymonetdb.connect(self.db_name)
-        sql = """insert into sys.mroll_revisions values ('{}', '{}', '{}'), ('{}', '{}', '{}');""".format(gen_rev_id(), "revision 1", datetime.now(), gen_rev_id(), "revision 2", datetime.now())
+        sql = """insert into sys.mroll_revisions (id, description, ts) values ('{}', '{}', '{}'), ('{}', '{}', '{}');""".format(gen_rev_id(), "revision 1", datetime.now(), gen_rev_id(), "revision 2", datetime.now())
         conn.execute(sql)
         conn.commit()
         self.assertTrue(len(ctx.revisions) == 2)
@@ -105,10 +146,255 @@ class TestMonetMigrationContext(TestCase):
         d_1 = datetime.now()
         d_2 = datetime.now()
         conn = pymonetdb.connect(self.db_name)
-        sql = """insert into sys.mroll_revisions values ('{}', '{}', '{}'), ('{}', '{}', '{}');""".format(id_1, "revision 1", d_1, id_2, "revision 2", d_2)
+        sql = """insert into sys.mroll_revisions (id, description, ts) values ('{}', '{}', '{}'), ('{}', '{}', '{}');""".format(id_1, "revision 1", d_1, id_2, "revision 2", d_2)
         conn.execute(sql)
         conn.commit()
         self.assertTrue(len(ctx.revisions) == 2)
         revisions = [Revision(id_1, "revision 1", d_1),Revision(id_2, "revision 2", d_2)]
         ctx.remove_revisions(revisions)
         self.assertTrue(len(ctx.revisions) == 0)
+
+    def test_bookkeeping_chunks(self):
+        wd = WorkDirectory(path=self.work_dir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        ctx.create_revisions_tbl()
+        # spans three chunks of BOOKKEEPING_CHUNK records, the last one partial
+        revisions = [Revision('{:012x}'.format(i), 'revision {}'.format(i), '2020-05-04T23:14:31')
+            for i in range(2500)]
+        insert_revision_records(ctx.conn, [RevisionTiming(rev, datetime.now(), 0.1, [0.1]) for rev in revisions])
+        ctx.conn.commit()
+        self.assertEqual(len(ctx.revisions), 2500)
+        self.assertEqual(ctx.timings[revisions[-1].id][2], 1)
+        delete_revision_records(ctx.conn, revisions[:2100])
+        ctx.conn.commit()
+        self.assertEqual(sorted(rev.id for rev in ctx.revisions), [rev.id for rev in revisions[2100:]])
+        ctx.close()
+
+    def test_ctx_timings(self):
+        wd = WorkDirectory(path=self.work_dir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        ctx.create_revisions_tbl()
+        rev = Revision(
+            gen_rev_id(), "adding table foo", datetime.now(),
+            upgrade_sql="create table test.foo (a string); insert into test.foo values ('a');",
+            downgrade_sql="drop table test.foo;"
+            )
+        ctx.add_revisions([rev])
+        self.assertEqual(len(ctx.last_timings), 1)
+        applied_at, duration, stmt_count = ctx.timings[rev.id]
+        self.assertIsNotNone(applied_at)
+        self.assertTrue(duration >= 0)
+        self.assertEqual(stmt_count, 2)
+
+    def test_copy_into_on_client(self):
+        wd = WorkDirectory(path=self.work_dir)
+        with open(os.path.join(self.work_dir, 'versions', 'foo.csv'), 'w') as f:
+            f.write('1,a\n2,b\n3,c\n')
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        ctx.create_revisions_tbl()
+        rev = Revision(
+            gen_rev_id(), "load foo", datetime.now(),
+            upgrade_sql="""create table test.foo (a int, b string);
+            copy into test.foo from 'foo.csv' on client using delimiters ',';""",
+            downgrade_sql="drop table test.foo;"
+            )
+        ctx.add_revisions([rev])
+        conn = pymonetdb.connect(self.db_name)
+        cur = conn.cursor()
+        cur.execute('select count(*) from test.foo')
+        self.assertEqual(cur.fetchone()[0], 3)
+        conn.close()
+
+    def test_online_alter(self):
+        wd = WorkDirectory(path=self.work_dir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        ctx.create_revisions_tbl()
+        create = Revision(
+            gen_rev_id(), "create orders", datetime.now(),
+            upgrade_sql="""create table test.orders (id int primary key, total int not null default 0,
+                note varchar(20), constraint orders_note unique (note));
+            create ordered index orders_total on test.orders (total);
+            comment on column test.orders.note is 'free text';
+            insert into test.orders (id, total) select value, value from generate_series(0, 1000);""",
+            downgrade_sql="drop table test.orders;")
+        widen = Revision(
+            gen_rev_id(), "widen total", datetime.now(),
+            upgrade_sql="alter table test.orders alter column total type bigint;",
+            directives={'online_alter': 'test.orders', 'batch_key': 'id', 'batch_rows': '100'})
+        ctx.add_revisions([create, widen])
+        # one duration per committed chunk
+        self.assertTrue(len(ctx.last_timings[1].stmt_durations) >= 10)
+        conn = pymonetdb.connect(self.db_name)
+        cur = conn.cursor()
+        cur.execute("""select c.type from sys.columns c join sys.tables t on c.table_id = t.id
+            where t.name = 'orders' and c.name = 'total'""")
+        self.assertEqual(cur.fetchone()[0], 'bigint')
+        cur.execute('select count(*), sum(total) from test.orders')
+        self.assertEqual(cur.fetchone(), (1000, 499500))
+        # the definition carries over, keys and indexes under their own names
+        cur.execute("""select c."null", c."default" from sys.columns c join sys.tables t on c.table_id = t.id
+            where t.name = 'orders' and c.name = 'total'""")
+        self.assertEqual(cur.fetchone(), (False, '0'))
+        cur.execute("""select name from sys.keys where table_id = (select id from sys.tables where name = 'orders')
+            union all select name from sys.idxs where table_id = (select id from sys.tables where name = 'orders')
+            and name = 'orders_total'""")
+        names = sorted(row[0] for row in cur.fetchall())
+        self.assertIn('orders_note', names)
+        self.assertIn('orders_total', names)
+        self.assertFalse([name for name in names if name.endswith('_mroll')])
+        cur.execute("""select remark from sys.comments where id = (select c.id from sys.columns c
+            join sys.tables t on c.table_id = t.id where t.name = 'orders' and c.name = 'note')""")
+        self.assertEqual(cur.fetchone()[0], 'free text')
+        conn.close()
+        self.assertEqual(ctx.head.id, widen.id)
+        ctx.remove_revisions([widen])
+        conn = pymonetdb.connect(self.db_name)
+        cur = conn.cursor()
+        cur.execute("""select c.type from sys.columns c join sys.tables t on c.table_id = t.id
+            where t.name = 'orders' and c.name = 'total'""")
+        self.assertEqual(cur.fetchone()[0], 'int')
+        cur.execute('select count(*) from test.orders')
+        self.assertEqual(cur.fetchone()[0], 1000)
+        conn.close()
+
+    def test_online_alter_nullable_key(self):
+        wd = WorkDirectory(path=self.work_dir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        ctx.create_revisions_tbl()
+        create = Revision(
+            gen_rev_id(), "create orders", datetime.now(),
+            upgrade_sql="""create table test.orders (id int, total int);
+            insert into test.orders select value, value from generate_series(0, 1000);
+            insert into test.orders values (null, 1);""",
+            downgrade_sql="drop table test.orders;")
+        widen = Revision(
+            gen_rev_id(), "widen total", datetime.now(),
+            upgrade_sql="alter table test.orders alter column total type bigint;",
+            directives={'online_alter': 'test.orders', 'batch_key': 'id', 'batch_rows': '100'})
+        ctx.add_revisions([create])
+        # key ranges would miss the NULL key row
+        with self.assertRaises(RevisionOperationError) as cm:
+            ctx.add_revisions([widen])
+        self.assertIn('must be not null', str(cm.exception))
+        self.assertEqual(ctx.head.id, create.id)
+        conn = pymonetdb.connect(self.db_name)
+        cur = conn.cursor()
+        cur.execute('select count(*), count(id) from test.orders')
+        self.assertEqual(cur.fetchone(), (1002, 1001))
+        conn.close()
+
+    def test_rollback_online_alter(self):
+        wd = WorkDirectory(path=self.work_dir)
+        create = Revision('000000000001', 'create orders', '2020-05-04T23:14:01', depends_on=(),
+            upgrade_sql="""create table test.orders (id int primary key, total int);
+            insert into test.orders select value, value from generate_series(0, 1000);""",
+            downgrade_sql="drop table test.orders;")
+        widen = Revision('000000000002', 'widen total', '2020-05-04T23:14:02', depends_on=(),
+            upgrade_sql="alter table test.orders alter column total type bigint;",
+            directives={'online_alter': 'test.orders', 'batch_key': 'id', 'batch_rows': '100'})
+        for rev in (create, widen):
+            wd.add_revision(rev)
+        res = CliRunner().invoke(upgrade, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0, res.output)
+        # no downgrade sql, the rows go back into the table kept by the online change
+        res = CliRunner().invoke(rollback, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0, res.output)
+        conn = pymonetdb.connect(self.db_name)
+        cur = conn.cursor()
+        cur.execute("""select c.type from sys.columns c join sys.tables t on c.table_id = t.id
+            where t.name = 'orders' and c.name = 'total'""")
+        self.assertEqual(cur.fetchone()[0], 'int')
+        cur.execute('select count(*), sum(total) from test.orders')
+        self.assertEqual(cur.fetchone(), (1000, 499500))
+        cur.execute("select type from sys.keys where table_id = (select id from sys.tables where name = 'orders')")
+        self.assertEqual(cur.fetchall(), [(0,)])
+        conn.close()
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        self.assertEqual(ctx.head.id, create.id)
+        ctx.close()
+
+    def test_backfill(self):
+        wd = WorkDirectory(path=self.work_dir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        ctx.create_revisions_tbl()
+        create = Revision(
+            gen_rev_id(), "create orders", datetime.now(),
+            upgrade_sql="""create table test.orders (id int primary key, total int);
+            insert into test.orders select value, 0 from generate_series(0, 1000);""",
+            downgrade_sql="drop table test.orders;")
+        ctx.add_revisions([create])
+        fill = Revision(
+            gen_rev_id(), "fill total", datetime.now(),
+            upgrade_sql="update test.orders set total = id * 2 where total = 0;",
+            directives={'backfill': 'test.orders', 'batch_key': 'id', 'batch_rows': '100'})
+        # as if interrupted after the first 500 rows
+        conn = pymonetdb.connect(self.db_name)
+        conn.execute("""create table if not exists sys.mroll_revisions_progress (id string primary key,
+            last_key string, chunks int, updated_at timestamp)""")
+        conn.execute("insert into sys.mroll_revisions_progress values ('{}', '499', 5, now())".format(fill.id))
+        conn.commit()
+        ctx.add_revisions([fill])
+        # 5 ranges left, seeked by key value, the last one open ended
+        self.assertEqual(len(ctx.last_timings[0].stmt_durations), 5)
+        self.assertEqual(ctx.head.id, fill.id)
+        cur = conn.cursor()
+        cur.execute('select count(*), sum(total) from test.orders where total > 0')
+        self.assertEqual(cur.fetchone(), (500, 2 * sum(range(500, 1000))))
+        cur.execute('select count(*) from sys.mroll_revisions_progress')
+        self.assertEqual(cur.fetchone()[0], 0)
+        conn.close()
+
+    def test_backfill_nullable_key(self):
+        wd = WorkDirectory(path=self.work_dir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        ctx.create_revisions_tbl()
+        create = Revision(
+            gen_rev_id(), "create orders", datetime.now(),
+            upgrade_sql="""create table test.orders (id int, total int);
+            insert into test.orders select value, 0 from generate_series(0, 1000);
+            insert into test.orders values (null, 0);""",
+            downgrade_sql="drop table test.orders;")
+        ctx.add_revisions([create])
+        # one range holding the whole table, and many ranges skipping the NULL key
+        for batch_rows in ('5000', '100'):
+            fill = Revision(
+                gen_rev_id(), "fill total", datetime.now(),
+                upgrade_sql="update test.orders set total = 1 where total = 0;",
+                directives={'backfill': 'test.orders', 'batch_key': 'id', 'batch_rows': batch_rows})
+            with self.assertRaises(RevisionOperationError) as cm:
+                ctx.add_revisions([fill])
+            self.assertIn('must be not null', str(cm.exception))
+            self.assertEqual(ctx.head.id, create.id)
+        conn = pymonetdb.connect(self.db_name)
+        cur = conn.cursor()
+        cur.execute('select count(*) from test.orders where total > 0')
+        self.assertEqual(cur.fetchone()[0], 0)
+        conn.close()
+
+    def test_upgrade_parallel(self):
+        wd = WorkDirectory(path=self.work_dir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        ctx.create_revisions_tbl()
+        revisions = [Revision('{:012x}'.format(i), 'table t{}'.format(i), '2020-05-04T23:14:{:02d}'.format(i),
+            depends_on=(), upgrade_sql="""create table test.t{i} (i int);
+            insert into test.t{i} select value from generate_series(0, 100000);""".format(i=i),
+            downgrade_sql="drop table test.t{};".format(i)) for i in range(8)]
+        for rev in revisions:
+            wd.add_revision(rev)
+        # independent branches commit concurrently over separate connections
+        res = CliRunner().invoke(upgrade, ['-d', self.work_dir, '-p', '4'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        self.assertIn('8 applied, 0 failed, 0 skipped', res.output)
+        state = ctx.state
+        self.assertEqual((state.head.id, state.applied_count), (revisions[-1].id, 8))
+        ctx.close()
+
+    def test_upgrade_revisions_tbl(self):
+        wd = WorkDirectory(path=self.work_dir)
+        ctx = create_migration_ctx(wd.get_migration_ctx_config())
+        conn = pymonetdb.connect(self.db_name)
+        conn.execute("create table sys.mroll_revisions(id string primary key, description string, ts timestamp)")
+        conn.commit()
+        self.assertEqual(ctx.upgrade_revisions_tbl(), ['applied_at', 'duration', 'stmt_count', 'checksum'])
+        self.assertEqual(ctx.upgrade_revisions_tbl(), [])
+        self.assertEqual(ctx.state.applied_count, 0)
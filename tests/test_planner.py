@@ -0,0 +1,19 @@
+from unittest import TestCase
+from mroll.migration import Revision
+from mroll.planner import make_plan
+
+class TestPlanner(TestCase):
+    def test_plan(self):
+        revs = [Revision('r{}'.format(i), 'rev {}'.format(i), '2020-05-04T23:14:3{}'.format(i)) for i in range(4)]
+        plan = make_plan(revs, iter(['r0', 'r2', 'gone']))
+        self.assertEqual(plan.applied, [revs[0], revs[2]])
+        self.assertEqual(plan.pending, [revs[1], revs[3]])
+        self.assertEqual(plan.head, revs[2])
+        self.assertEqual(plan.missing, ['gone'])
+        self.assertEqual(plan.out_of_order, [revs[1]])
+        self.assertEqual(len(plan.warnings()), 2)
+        baseline = Revision('base', 'baseline', revs[1].ts, squashes=('r0', 'r1'))
+        plan = make_plan([baseline] + revs[2:], ['r0', 'r1'])
+        self.assertEqual(plan.applied, [baseline])
+        self.assertEqual(plan.missing, [])
+        self.assertRaises(ValueError, make_plan, [baseline], ['r0'])
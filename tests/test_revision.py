@@ -0,0 +1,31 @@
+from unittest import TestCase
+from mroll.migration import Revision, gen_rev_id, parse_commit_every, commit_units, squash
+
+class TestRevision(TestCase):
+    def test_commit_units(self):
+        revs = [Revision(gen_rev_id(), 'rev {}'.format(i), '2020-05-04T23:14:37.498799') for i in range(5)]
+        self.assertEqual(parse_commit_every('all'), None)
+        self.assertEqual(parse_commit_every('revision'), 1)
+        self.assertEqual(parse_commit_every('2'), 2)
+        self.assertRaises(ValueError, parse_commit_every, '0')
+        self.assertRaises(ValueError, parse_commit_every, 'bla')
+        self.assertEqual(commit_units(revs), [revs])
+        self.assertEqual(commit_units([]), [])
+        self.assertEqual(commit_units(revs, 1), [[r] for r in revs])
+        self.assertEqual(commit_units(revs, 2), [revs[:2], revs[2:4], revs[4:]])
+
+    def test_online_alter_directives(self):
+        rev = Revision('099c9a23ab3b', 'widen total', '2020-05-04T23:14:37.498799',
+            upgrade_sql='alter table orders alter column total type bigint;',
+            directives={'online_alter': 'orders', 'batch_key': 'id', 'batch_rows': '50000'})
+        fn = '/tmp/online.sql'
+        with open(fn, 'wt') as f:
+            f.write(rev.serialize())
+        res = Revision.from_file(fn)
+        self.assertEqual(res.directives, {'online_alter': 'orders', 'batch_key': 'id', 'batch_rows': '50000'})
+        self.assertTrue(res.chunked)
+        self.assertEqual(res.upgrade_stmts, ['alter table orders alter column total type bigint;'])
+        revs = [Revision(gen_rev_id(), 'rev {}'.format(i), '2020-05-04T23:14:37.498799') for i in range(3)]
+        revs.insert(1, res)
+        self.assertEqual(commit_units(revs), [revs[:1], [res], revs[2:]])
+        self.assertRaises(ValueError, squash, revs, revs[-1].id)
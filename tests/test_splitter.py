@@ -0,0 +1,61 @@
+import os
+import shutil
+from contextlib import contextmanager
+from tempfile import mkdtemp
+from unittest import TestCase
+from mroll.migration import Revision, WorkDirectory, gen_rev_id
+from mroll.splitter import split
+from mroll import migration
+
+@contextmanager
+def stream_threshold(size):
+    saved = migration.STREAM_THRESHOLD
+    migration.STREAM_THRESHOLD = size
+    try:
+        yield
+    finally:
+        migration.STREAM_THRESHOLD = saved
+
+class TestSplitter(TestCase):
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'versions'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_split_statements(self):
+        sql = """
+        insert into foo values ('a;b', 'it''s;', E'x\\';y'); -- one; two
+        /* block; comment */ select "odd;name" from foo;
+        create function f(x int) returns int
+        begin
+            declare y int;
+            set y = case when x > 1 then 1 else 2 end;
+            if y = 1 then return 3; end if;
+            return y;
+        end;
+        create function g() returns int language python { return 1; };
+        copy 2 records into foo from stdin;
+        1|a;
+        2|b
+        select 1
+        """
+        stmts = split(sql)
+        self.assertEqual(len(stmts), 6)
+        self.assertTrue(stmts[2].startswith('create function f') and stmts[2].endswith('end;'))
+        self.assertTrue(stmts[4].endswith('2|b'))
+        self.assertEqual(stmts[5], 'select 1')
+        self.assertEqual(split('-- only a comment\n'), [])
+        # large files are split while iterating
+        rev = Revision(gen_rev_id(), 'large', '2020-05-04T23:14:37.498799',
+            upgrade_sql=sql, downgrade_sql='drop table foo;')
+        wd = WorkDirectory(self.work_dir)
+        wd.add_revision(rev)
+        rev = WorkDirectory(self.work_dir).revisions[0]
+        with stream_threshold(0):
+            self.assertTrue(rev.is_large)
+            self.assertEqual(list(rev.iter_stmts()), stmts)
+            self.assertEqual(list(rev.iter_stmts(upgrade=False)), ['drop table foo;'])
+            self.assertTrue(rev.has_sql(upgrade=False))
+        self.assertFalse(rev.is_large)
@@ -0,0 +1,405 @@
+import io
+import os
+import time
+import json
+import shutil
+import sqlite3
+import configparser
+from tempfile import mkdtemp
+from unittest import TestCase
+from datetime import datetime
+from click.testing import CliRunner
+from mroll.migration import Revision, RevisionTiming, WorkDirectory, gen_rev_id
+from mroll.progress import Progress
+from mroll import progress as progress_mod
+from mroll.commands import (get_templates_dir, init, upgrade, rollback, history, pending, squash, status, verify,
+    plan_revisions)
+from mroll.databases import create_migration_ctx
+from mroll.databases.sqlite import SqliteMigrCtx, resolve_db_path
+from mroll.cache import RevisionCache
+from mroll.exceptions import RevisionOperationError
+
+def make_sqlite_work_dir(execute='true'):
+    """
+    Creates work directory using the sqlite backend, needs no database server.
+    """
+    work_dir = mkdtemp()
+    os.mkdir(os.path.join(work_dir, 'versions'))
+    shutil.copy(os.path.join(get_templates_dir(), 'mroll.ini'), work_dir)
+    configfile = os.path.join(work_dir, 'mroll.ini')
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    config['mroll']['backend'] = 'sqlite'
+    config['sqlite'] = dict(sqlite_db='history.sqlite', sqlite_execute=execute)
+    with open(configfile, 'w') as f:
+        config.write(f)
+    return work_dir
+
+class TestSqliteMigrationContext(TestCase):
+    def setUp(self):
+        self.work_dir = make_sqlite_work_dir()
+        self.wd = WorkDirectory(self.work_dir)
+        self.ctx = create_migration_ctx(self.wd.get_migration_ctx_config())
+        self.ctx.create_revisions_tbl()
+
+    def tearDown(self):
+        self.ctx.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_config(self):
+        # the template leaves [db][db_name] empty, the sqlite backend does not use it
+        self.wd.config_validate()
+        config = self.wd.get_migration_ctx_config()
+        config.sqlite_db = None
+        self.assertEqual(resolve_db_path(config), os.path.join(self.work_dir, 'history.sqlite'))
+        config.tbl_name = 'missing'
+        with create_migration_ctx(config) as ctx:
+            with self.assertRaises(RuntimeError) as cm:
+                ctx.state
+        self.assertIn('revisions table missing', str(cm.exception))
+
+    def test_init_targets(self):
+        self.wd._set_config('db:a', 'sqlite_db', 'a.sqlite')
+        self.wd._set_config('db:b', 'sqlite_db', 'b.sqlite')
+        runner = CliRunner()
+        res = runner.invoke(init, ['-d', self.work_dir, '-t', 'all'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        self.assertIn('[a] ok', res.output)
+        self.assertIn('mroll_revisions table created', res.output)
+        for _, config in WorkDirectory(self.work_dir).get_target_configs(['all']):
+            with create_migration_ctx(config) as ctx:
+                self.assertIsNone(ctx.head)
+        res = runner.invoke(init, ['-d', self.work_dir, '-t', 'a'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        self.assertIn('Nothing to do', res.output)
+
+    def make_revisions(self):
+        return [
+            Revision(
+                gen_rev_id(), "adding table foo", datetime.now(),
+                upgrade_sql="create table foo (a text);",
+                downgrade_sql="drop table foo;"
+                ),
+            Revision(
+                gen_rev_id(), "adding table bar", datetime.now(),
+                upgrade_sql="create table bar (a text); insert into bar values ('a');",
+                downgrade_sql="drop table bar;"
+                )
+        ]
+
+    def test_create_migr_ctx(self):
+        self.assertIsInstance(self.ctx, SqliteMigrCtx)
+        self.assertEqual(self.ctx.path, os.path.join(self.work_dir, 'history.sqlite'))
+        self.assertIsNone(self.ctx.head)
+
+    def test_ctx_add_remove_revisions(self):
+        revisions = self.make_revisions()
+        self.ctx.add_revisions(revisions)
+        self.assertEqual([r.id for r in self.ctx.revisions], [r.id for r in revisions])
+        self.assertEqual(self.ctx.head.id, revisions[-1].id)
+        self.assertEqual(self.ctx.timings[revisions[1].id][2], 2)
+        self.ctx.conn.execute('select * from bar').fetchall()
+        self.ctx.remove_revisions(list(reversed(revisions)))
+        self.assertIsNone(self.ctx.head)
+        self.assertRaises(sqlite3.OperationalError, self.ctx.conn.execute, 'select * from bar')
+
+    def test_ctx_failing_revision(self):
+        revisions = self.make_revisions()
+        revisions[1] = Revision(gen_rev_id(), "broken", datetime.now(), upgrade_sql="create table foo (a text);")
+        with self.assertRaises(RevisionOperationError) as cm:
+            self.ctx.add_revisions(revisions)
+        self.assertEqual(cm.exception.revision.id, revisions[1].id)
+        self.assertIsNone(self.ctx.head)
+
+    def test_ctx_commit_every(self):
+        revisions = self.make_revisions()
+        revisions[1] = Revision(gen_rev_id(), "broken", datetime.now(), upgrade_sql="create table foo (a text);")
+        self.assertRaises(RevisionOperationError, self.ctx.add_revisions, revisions, commit_every=1)
+        self.assertEqual([r.id for r in self.ctx.revisions], [revisions[0].id])
+
+    def test_upgrade_rollback_cmd(self):
+        for rev in self.make_revisions():
+            self.wd.add_revision(rev)
+        runner = CliRunner()
+        res = runner.invoke(pending, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0)
+        self.assertEqual(res.output.count('\n'), 2)
+        res = runner.invoke(upgrade, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0)
+        self.assertEqual(len(self.ctx.revisions), 2)
+        res = runner.invoke(history, ['-d', self.work_dir, '--timings'])
+        self.assertEqual(res.exit_code, 0)
+        self.assertEqual(res.output.count('statements='), 2)
+        res = runner.invoke(rollback, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0)
+        self.assertEqual(len(self.ctx.revisions), 1)
+
+    def test_progress(self):
+        revisions = self.make_revisions()
+        for rev in revisions:
+            self.wd.add_revision(rev)
+        runner = CliRunner()
+        res = runner.invoke(upgrade, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0)
+        self.assertIn('[1/2] {} statement 0/1'.format(revisions[0]), res.output)
+        # nothing to estimate from on the first run
+        self.assertIn('ETA ?', res.output)
+        self.assertEqual(set(WorkDirectory(self.work_dir).durations()), set(r.id for r in revisions))
+        res = runner.invoke(rollback, ['-d', self.work_dir, '-n', '2'])
+        self.assertEqual(res.exit_code, 0)
+        self.assertIn('[1/2] {} statement 0/1'.format(revisions[1]), res.output)
+        self.assertNotIn('ETA ?', res.output)
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '--no-progress'])
+        self.assertEqual(res.output, 'Done\n')
+        progress = Progress(revisions, expected={revisions[0].id: 2.0}, stmt_rate=0.5, out=io.StringIO())
+        self.assertEqual(progress.eta(), 3.0)
+        progress.finish_revision(RevisionTiming(revisions[0], duration=1.0, stmt_durations=[1.0]))
+        # measured seconds per statement replace those of the history
+        self.assertEqual(progress.eta(), 2.0)
+        durations, stmt_rate = self.ctx.timing_estimates([revisions[0].id])
+        self.assertEqual(list(durations), [revisions[0].id])
+        self.assertIsNotNone(stmt_rate)
+
+    def test_progress_refresh(self):
+        revisions = self.make_revisions()
+        out = io.StringIO()
+        saved = progress_mod.LOG_INTERVAL
+        progress_mod.LOG_INTERVAL = 0.01
+        try:
+            progress = Progress(revisions, out=out)
+            progress.start_revision(revisions[0])
+            # no statement finishes, the status is still logged
+            time.sleep(0.2)
+            progress.close()
+        finally:
+            progress_mod.LOG_INTERVAL = saved
+        self.assertGreater(len(out.getvalue().splitlines()), 2)
+
+    def test_verify(self):
+        for rev in self.make_revisions():
+            self.wd.add_revision(rev)
+        runner = CliRunner()
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '--no-progress'])
+        self.assertEqual(res.exit_code, 0)
+        res = runner.invoke(verify, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0)
+        self.assertIn('2 applied: 2 ok, 0 changed, 0 missing, 0 without checksum', res.output)
+        first, second = WorkDirectory(self.work_dir).revisions
+        with open(first.path) as f:
+            content = f.read()
+        # reindenting is not a change
+        with open(first.path, 'w') as f:
+            f.write(content.replace('create table foo (a text);', '  create  table foo (a text);\n'))
+        res = runner.invoke(verify, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0)
+        with open(first.path, 'w') as f:
+            f.write(content.replace('create table foo (a text);', 'create table foo (a text, b int);'))
+        res = runner.invoke(verify, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 1)
+        self.assertIn('changed: {}'.format(first), res.output)
+        with open(first.path, 'w') as f:
+            f.write(content)
+        # applied before checksums were recorded
+        self.ctx.conn.execute('update mroll_revisions set checksum = null where id = ?', (second.id,))
+        res = runner.invoke(verify, ['-d', self.work_dir])
+        self.assertIn('1 ok, 0 changed, 0 missing, 1 without checksum', res.output)
+        res = runner.invoke(verify, ['-d', self.work_dir, '--record-missing'])
+        self.assertIn('1 checksums recorded', res.output)
+        res = runner.invoke(verify, ['-d', self.work_dir])
+        self.assertIn('2 applied: 2 ok', res.output)
+        os.remove(second.path)
+        res = runner.invoke(verify, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 1)
+        self.assertIn('missing from work dir: {}'.format(second.id), res.output)
+
+    def test_plan_unsupported(self):
+        for rev in self.make_revisions():
+            self.wd.add_revision(rev)
+        res = CliRunner().invoke(plan_revisions, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 1)
+        self.assertIn('Error: cost estimation needs MonetDB', res.output)
+
+    def test_upgrade_targets(self):
+        for rev in self.make_revisions():
+            self.wd.add_revision(rev)
+        self.wd._set_config('db:a', 'sqlite_db', 'a.sqlite')
+        self.wd._set_config('db:b', 'sqlite_db', 'b.sqlite')
+        wd = WorkDirectory(self.work_dir)
+        (_, config_a), (_, config_b) = wd.get_target_configs(['all'])
+        with create_migration_ctx(config_a) as ctx:
+            ctx.create_revisions_tbl()
+        runner = CliRunner()
+        # b is not initialized
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '-t', 'all'])
+        self.assertEqual(res.exit_code, 2)
+        self.assertIn('[a] ok', res.output)
+        self.assertIn('[b] FAILED', res.output)
+        with create_migration_ctx(config_b) as ctx:
+            ctx.create_revisions_tbl()
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '-t', 'a', '-t', 'b'])
+        self.assertEqual(res.exit_code, 0)
+        self.assertIn('2 targets: 2 ok, 0 failed', res.output)
+        for config in (config_a, config_b):
+            with create_migration_ctx(config) as ctx:
+                self.assertEqual(len(ctx.revisions), 2)
+        self.assertEqual(len(self.ctx.revisions), 0)
+        res = runner.invoke(rollback, ['-d', self.work_dir, '-t', 'missing'])
+        self.assertEqual(res.exit_code, 1)
+
+    def test_upgrade_targets_prefetch(self):
+        first, second = self.make_revisions()
+        for rev in (first, second):
+            self.wd.add_revision(rev)
+        self.wd._set_config('db:a', 'sqlite_db', 'a.sqlite')
+        (_, config_a), = WorkDirectory(self.work_dir).get_target_configs(['a'])
+        with create_migration_ctx(config_a) as ctx:
+            ctx.create_revisions_tbl()
+            ctx.add_revisions([first])
+        res = CliRunner().invoke(upgrade, ['-d', self.work_dir, '-t', 'a'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        revisions = WorkDirectory(self.work_dir).revisions
+        cache = RevisionCache.open(self.work_dir)
+        # only the pending revision of the target was split
+        self.assertIsNone(cache.get_statements(revisions[0]))
+        self.assertIsNotNone(cache.get_statements(revisions[1]))
+        cache.close()
+
+    def test_upgrade_parallel(self):
+        ts = '2020-05-04T23:14:3{}'
+        revisions = [
+            Revision('a', 'table a', ts.format(1), depends_on=(),
+                upgrade_sql="create table a (i int);", downgrade_sql="drop table a;"),
+            # fails whichever branch runs first
+            Revision('b', 'broken', ts.format(2), depends_on=(),
+                upgrade_sql="insert into missing values (1);", downgrade_sql="delete from missing;"),
+            Revision('c', 'after broken', ts.format(3), depends_on=('b',),
+                upgrade_sql="create table c (i int);", downgrade_sql="drop table c;"),
+            Revision('d', 'after a', ts.format(4), depends_on=('a',),
+                upgrade_sql="insert into a values (1);", downgrade_sql="delete from a;"),
+        ]
+        for rev in revisions:
+            self.wd.add_revision(rev)
+        runner = CliRunner()
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '-p', '2'])
+        self.assertEqual(res.exit_code, 1)
+        self.assertIn('2 applied, 1 failed, 1 skipped', res.output)
+        self.assertEqual(sorted(r.id for r in self.ctx.revisions), ['a', 'd'])
+        self.assertEqual(self.ctx.conn.execute('select count(*) from a').fetchone()[0], 1)
+        state = self.ctx.state
+        self.assertEqual((state.head.id, state.applied_count), ('d', 2))
+
+    def test_squash(self):
+        ts = '2020-05-04T23:14:3{}'
+        revisions = [
+            Revision('a', 'table a', ts.format(1), upgrade_sql="create table a (i int);", downgrade_sql="drop table a;"),
+            Revision('b', 'table b', ts.format(2), upgrade_sql="create table b (i int);", downgrade_sql="drop table b;"),
+            Revision('c', 'table c', ts.format(3), upgrade_sql="create table c (i int);", downgrade_sql="drop table c;"),
+        ]
+        for rev in revisions:
+            self.wd.add_revision(rev)
+        self.wd._set_config('db:old', 'sqlite_db', 'old.sqlite')
+        self.wd._set_config('db:new', 'sqlite_db', 'new.sqlite')
+        (_, old_config), (_, new_config) = WorkDirectory(self.work_dir).get_target_configs(['all'])
+        for config in (old_config, new_config):
+            with create_migration_ctx(config) as ctx:
+                ctx.create_revisions_tbl()
+        runner = CliRunner()
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '-n', '2'])
+        self.assertEqual(res.exit_code, 0)
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '-t', 'old'])
+        self.assertEqual(res.exit_code, 0)
+        # a target holding part of the range would be stuck, nothing changes
+        self.wd._set_config('db:part', 'sqlite_db', 'part.sqlite')
+        [(_, part_config)] = WorkDirectory(self.work_dir).get_target_configs(['part'])
+        with create_migration_ctx(part_config) as ctx:
+            ctx.create_revisions_tbl()
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '-t', 'part', '-n', '1'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        res = runner.invoke(squash, ['-d', self.work_dir, '-r', 'b'])
+        self.assertEqual(res.exit_code, 1)
+        self.assertIn('target part holds only part', res.output)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.work_dir, 'versions'))), sorted(
+            os.path.basename(rev.path) for rev in WorkDirectory(self.work_dir).revisions))
+        self.assertEqual(len(WorkDirectory(self.work_dir).revisions), 3)
+        self.assertEqual([r.id for r in self.ctx.revisions], ['a', 'b'])
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '-t', 'part', '-n', '1'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        res = runner.invoke(squash, ['-d', self.work_dir, '-r', 'b'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        self.assertFalse([f for f in os.listdir(os.path.join(self.work_dir, 'versions')) if f.endswith('.pending')])
+        revisions = WorkDirectory(self.work_dir).revisions
+        self.assertEqual(len(revisions), 2)
+        baseline = revisions[0]
+        self.assertEqual(baseline.squashes, ('a', 'b'))
+        self.assertEqual(len(baseline.upgrade_stmts), 2)
+        self.assertEqual([r.id for r in self.ctx.revisions], [baseline.id])
+        # databases migrated before the squash pick up the baseline record
+        res = runner.invoke(upgrade, ['-d', self.work_dir, '-t', 'all'])
+        self.assertEqual(res.exit_code, 0, res.output)
+        with create_migration_ctx(old_config) as ctx:
+            self.assertEqual([r.id for r in ctx.revisions], [baseline.id, 'c'])
+        with create_migration_ctx(new_config) as ctx:
+            self.assertEqual([r.id for r in ctx.revisions], [baseline.id, 'c'])
+            ctx.conn.execute('select * from b').fetchall()
+
+    def test_state(self):
+        ts = '2020-05-04T23:14:31'
+        # equal ts, the last applied one is head
+        revisions = [Revision('a', 'a', ts), Revision('b', 'b', ts), Revision('c', 'c', '2020-05-04T23:14:30')]
+        self.ctx.add_revisions(revisions[:2])
+        self.ctx.add_revisions(revisions[2:])
+        state = self.ctx.state
+        self.assertEqual((state.head.id, state.applied_count), ('b', 3))
+        self.ctx.remove_revisions([revisions[1]])
+        self.assertEqual((self.ctx.head.id, self.ctx.state.applied_count), ('a', 2))
+        # history tables without state table are only upgraded on request, reads point there
+        self.ctx.conn.execute('drop table mroll_revisions_state')
+        with self.assertRaises(RuntimeError) as cm:
+            self.ctx.head
+        self.assertIn('run mroll init', str(cm.exception))
+        res = CliRunner().invoke(history, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 1)
+        self.assertIsNone(self.ctx.conn.execute(
+            "select name from sqlite_master where name = 'mroll_revisions_state'").fetchone())
+        self.ctx.upgrade_revisions_tbl()
+        self.assertEqual((self.ctx.head.id, self.ctx.state.applied_count), ('a', 2))
+
+    def test_status_cmd(self):
+        for rev in self.make_revisions():
+            self.wd.add_revision(rev)
+        runner = CliRunner()
+        res = runner.invoke(upgrade, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0)
+        res = runner.invoke(status, ['-d', self.work_dir])
+        self.assertEqual(res.exit_code, 0)
+        self.assertIn('applied: 2', res.output)
+        self.assertIn('2 revisions, unchanged', res.output)
+        self.wd.add_revision(self.make_revisions()[0])
+        res = runner.invoke(status, ['-d', self.work_dir])
+        self.assertIn('3 revisions, changed', res.output)
+
+    def test_history_filters(self):
+        revisions = [Revision('r{}'.format(i), 'rev {}'.format(i), '2020-05-04T23:14:3{}'.format(i)) for i in range(5)]
+        self.ctx.add_revisions(revisions)
+        ids = lambda rows: [row[0] for row in rows]
+        self.assertEqual(ids(self.ctx.history(since='r1', limit=2)), ['r2', 'r3'])
+        self.assertEqual(ids(self.ctx.history(last=2)), ['r3', 'r4'])
+        self.assertEqual(len(list(self.ctx.history(since=datetime(2000, 1, 1)))), 5)
+        self.assertRaises(ValueError, list, self.ctx.history(since='nope'))
+        runner = CliRunner()
+        res = runner.invoke(history, ['-d', self.work_dir, '--last', '3', '--format', 'ndjson'])
+        self.assertEqual(res.exit_code, 0)
+        self.assertEqual([json.loads(l)['id'] for l in res.output.splitlines()], ['r2', 'r3', 'r4'])
+        res = runner.invoke(history, ['-d', self.work_dir, '--since', 'r3', '--format', 'json'])
+        self.assertEqual([r['id'] for r in json.loads(res.output)], ['r4'])
+        res = runner.invoke(history, ['-d', self.work_dir, '--since', 'r4', '--format', 'json'])
+        self.assertEqual(json.loads(res.output), [])
+        res = runner.invoke(history, ['-d', self.work_dir, '--limit', '1', '--last', '1'])
+        self.assertNotEqual(res.exit_code, 0)
+        # revisions sharing a ts follow each other by id
+        same_ts = [Revision('s{}'.format(i), 'same ts {}'.format(i), '2020-05-04T23:15:00') for i in range(3)]
+        self.ctx.add_revisions(same_ts)
+        self.assertEqual(ids(self.ctx.history(since='r4')), ['s0', 's1', 's2'])
+        self.assertEqual(ids(self.ctx.history(since='s0')), ['s1', 's2'])
+        self.assertEqual(ids(self.ctx.history(since='s1', limit=1)), ['s2'])
+        self.assertEqual(ids(self.ctx.history(last=2)), ['s1', 's2'])
@@ -2,7 +2,8 @@ import os
 import shutil
 from unittest import TestCase
 from click.testing import CliRunner
-from mroll.migration import Revision, get_all_upgrade_sql, gen_rev_id
+from mroll.migration import Revision, WorkDirectory, get_all_upgrade_sql, gen_rev_id
+from mroll.bench import generate_work_dir
 from mroll.commands import setup, revision
 from mroll.config import MROLL_CONFIG_DIR
 
@@ -95,5 +96,17 @@ class TestMigrationContext(TestCase):
         res = get_all_upgrade_sql(self.work_dir)
         self.assertNotEqual(res, '')
 
-
-
+    def test_parallel_parse(self):
+        path = os.path.join(self.work_dir, 'bench')
+        generate_work_dir(path, 20, 'small')
+        serial = WorkDirectory(path, use_cache=False, parse_threshold=0).revisions
+        for use_cache in (False, True):
+            revisions = WorkDirectory(path, use_cache=use_cache, parse_threshold=2).revisions
+            self.assertEqual([r.id for r in revisions], [r.id for r in serial])
+            self.assertEqual(revisions[3].upgrade_stmts, serial[3].upgrade_stmts)
+        # statements split by workers are cached
+        revisions = WorkDirectory(path).revisions
+        self.assertEqual(revisions[3].downgrade_stmts, serial[3].downgrade_stmts)
+        with open(os.path.join(path, 'versions', 'broken.sql'), 'w') as f:
+            f.write('-- migration:upgrade\n')
+        self.assertRaises(AssertionError, WorkDirectory(path, use_cache=False, parse_threshold=2).load_revisions)